@@ -1,4 +1,5 @@
 import os
+import sys
 from pathlib import Path
 
 
@@ -29,6 +30,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'notes.metrics.MetricsMiddleware',  # Request latency and query counts for /metrics; first, so it sees everything
     'corsheaders.middleware.CorsMiddleware',  # CORS Middleware
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -124,6 +126,10 @@ LOGGING = {
         'handlers': ['console'],
         'level': 'INFO',
     },
+    'loggers': {
+        # httpx logs every LLM request at INFO
+        'httpx': {'level': 'WARNING'},
+    },
     'django': {
         'handlers': ['console'],
         'level': 'DEBUG' if DEBUG else 'INFO',
@@ -135,13 +141,153 @@ LOGGING = {
 # Other settings
 DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
 
-# Notes directory configuration
-NOTES_DIR = os.path.join(BASE_DIR, 'notes_files')
-os.makedirs(NOTES_DIR, exist_ok=True)  # Create the directory if it doesn't exist
+# Notes are searched as overlapping passages of PASSAGE_WORDS words
+PASSAGE_WORDS = 200
+PASSAGE_OVERLAP_WORDS = 50
+QA_PASSAGES = 20  # Passages retrieved per question
+QA_CONTEXT_TOKENS = 1500  # Budget of the context sent to the LLM
+
+# Persisted passage search index (memory-mapped by every worker)
+PASSAGE_INDEX_DIR = os.path.join(BASE_DIR, 'passage_index')
+PASSAGE_INDEX_PUBLISH_EVERY = 2000  # Passages held in memory before a new generation is written
+PASSAGE_INDEX_CATCH_UP_WINDOW = 1000  # Recent passage ids re-read on each catch-up, for transactions that commit late
+
+# Passage retrieval backend: 'tfidf' (exact TF-IDF cosine) or 'dense' (sentence
+# embeddings searched through an IVF index, see notes/dense_index.py). After
+# switching, run python manage.py build_note_index to build the new index.
+SEMANTIC_SEARCH_BACKEND = 'tfidf'
+DENSE_INDEX_DIR = os.path.join(BASE_DIR, 'dense_index')
+DENSE_EMBEDDING_MODEL = 'sentence-transformers/all-MiniLM-L6-v2'
+DENSE_EMBEDDING_DTYPE = 'float16'  # Stored vectors: 'float16' or 'int8' (half the size and faster to scan, but recall@10 drops to ~0.9)
+DENSE_BATCH_SIZE = 32  # Passages per forward pass
+DENSE_MAX_TOKENS = 256  # Longer passages are truncated by the tokenizer
+DENSE_IVF_PROBES = 16  # Inverted lists scanned per query (more is slower and more exact)
+
+# Hybrid search (notes/retrieve/): tag and passage rankings fused by reciprocal rank
+HYBRID_CANDIDATES = 100  # Candidates taken from each retriever
+HYBRID_RRF_K = 60  # Damps the weight of top ranks; 60 is the usual choice
+HYBRID_PAGE_SIZE = 20
+HYBRID_RETRIEVER_THREADS = int(os.environ.get('KMSIMBA_THREADS', 1))  # Passage searches run at once: one per request thread
+
+# In-memory tag search index (python manage.py build_tag_index writes the snapshot)
+TAG_INDEX_ENABLED = True
+TAG_INDEX_SNAPSHOT = os.path.join(BASE_DIR, 'tag_index', 'postings.npz')
+TAG_INDEX_SYNC_INTERVAL = 10  # Seconds between catching up with writes from other processes
+TAG_INDEX_CHANGE_WINDOW = 1000  # Recent change ids re-read on each catch-up, for transactions that commit late
+TAG_INDEX_CHANGE_RETENTION = 7 * 86400  # Seconds file changes are kept; build_tag_index prunes older ones
+
+# Background ingestion (python manage.py run_ingest_worker)
+INGEST_WORKER_PROCESSES = None  # Defaults to the number of CPU cores
+INGEST_JOB_TIMEOUT = 1800  # Seconds before a running job is considered abandoned
+INGEST_RETRY_BACKOFF = 30  # Seconds before the first retry, doubled per attempt
+
+# Resolution PDF pages are rasterized at for detection and OCR
+PDF_RASTER_DPI = 72
+
+# OCR of images and scanned PDF pages
+OCR_DPI = 300
+OCR_PROCESSES = None  # Defaults to the number of CPU cores; ingest workers split them (notes/ocr.py)
+OCR_CACHE_ALIAS = 'ocr'
+
+# Answers of the notes chat (see notes/answer_cache.py)
+ANSWER_CACHE_ALIAS = 'answers'
+ANSWER_CACHE_TIMEOUT = 60 * 60 * 24
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # File based so OCR results are shared by every worker process
+    'ocr': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache', 'ocr'),
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    },
+    # Shared by every worker; the least recently used answers are culled first
+    'answers': {
+        'BACKEND': 'notes.cache_backends.LRUFileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache', 'answers'),
+        'OPTIONS': {'MAX_ENTRIES': 10000, 'CULL_FREQUENCY': 10},
+    },
+}
+
+# spaCy tagging of extracted text
+SPACY_BATCH_SIZE = 8  # Text chunks per nlp.pipe batch
+SPACY_N_PROCESS = 1  # Processes nlp.pipe fans out to
+
+# Models and their CPU inference runtimes (notes/inference.py): 'eager', 'int8',
+# 'onnx' or 'onnx-int8'. Check a runtime with `manage.py check_inference_runtime`
+# before switching it on.
+QA_MODEL = 'distilbert-base-cased-distilled-squad'
+YOLOS_MODEL = 'hustvl/yolos-tiny'
+INFERENCE_RUNTIME = {'qa': 'eager', 'yolos': 'eager'}
+
+# Object detection (YOLOS) inference
+TORCH_NUM_THREADS = None  # Leave torch's default unless set
+YOLOS_BATCH_SIZE = 8  # Images per forward pass
+
+# LLM used by the chat search (notes/llm.py): 'gemini', 'local' (LOCAL_LLM_MODEL
+# on CPU) or 'fake' (deterministic replies, no network).
+LLM_BACKEND = os.environ.get('LLM_BACKEND', 'gemini')
+LLM_REQUEST_BUDGET = 30  # Seconds from question to reply, queueing and retries included
+LLM_MAX_CONCURRENCY = 64  # LLM calls in flight per process
+LLM_RETRIES = 2  # Retries of timeouts, 429 and 5xx while the budget allows
+LLM_RETRY_BASE_MS = 250  # Backoff before retry n is uniform in [0, base * 2**n)
+LLM_BATCH_SIZE = 8  # Prompts per call for backends that batch ('local', 'fake'); 1 disables
+LLM_BATCH_WAIT_MS = 10  # How long the batcher waits to fill a batch (requests only share one under ASGI)
+
+# Gemini API. Point GEMINI_API_BASE at benchmarks/fake_llm_server.py to run
+# the HTTP path without network.
+GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY', 'GeminiKey')
+GEMINI_API_BASE = os.environ.get('GEMINI_API_BASE', 'https://generativelanguage.googleapis.com')
+GEMINI_MODEL = 'gemini-1.5-flash-latest'
+LLM_CONNECT_TIMEOUT = 5
+LLM_MAX_CONNECTIONS = 200  # Pooled connections per process
+
+LOCAL_LLM_MODEL = 'google/flan-t5-small'
+LOCAL_LLM_MAX_TOKENS = 128
+
+# Latency of the 'fake' backend: time to the first word, then per word
+FAKE_LLM_FIRST_TOKEN_MS = float(os.environ.get('FAKE_LLM_FIRST_TOKEN_MS', 0))
+FAKE_LLM_TOKEN_MS = float(os.environ.get('FAKE_LLM_TOKEN_MS', 0))
+FAKE_LLM_TOKENS = int(os.environ.get('FAKE_LLM_TOKENS', 60))
+
+# Chat search under ASGI (notes/chat.py)
+RETRIEVAL_WORKERS = 8  # Threads running passage retrieval
+QA_WORKERS = 2  # Concurrent DistilBERT inferences
+QA_EXTRACT_ANSWER = True  # False answers with the LLM reply itself
+
+# Models loaded by the gunicorn master before forking workers (see gunicorn.conf.py),
+# any of 'spacy', 'yolos', 'qa', 'embedder', 'local_llm'. Everything else loads on first use.
+MODEL_PRELOAD = []
 
 # Hugging Face Transformers cache directory
 TRANSFORMERS_CACHE = os.path.join(BASE_DIR, 'transformers_cache')
 os.environ['TRANSFORMERS_CACHE'] = TRANSFORMERS_CACHE
 
 # Large file upload settings
-DATA_UPLOAD_MAX_MEMORY_SIZE = 10485760  # 10 MB
\ No newline at end of file
+DATA_UPLOAD_MAX_MEMORY_SIZE = 10485760  # 10 MB
+
+# Chunked, resumable uploads (notes/uploads.py)
+UPLOAD_MAX_SIZE = 20 * 1024 ** 3  # Largest file a session accepts
+UPLOAD_CHUNK_MAX_SIZE = 64 * 1024 ** 2  # Largest chunk per request
+UPLOAD_STREAM_BLOCK = 1024 ** 2  # Bytes copied from the request at a time
+UPLOAD_CHUNK_LEASE = 600  # Seconds a chunk may take before another request may write at its offset
+UPLOAD_SESSION_TTL = 86400  # Seconds an idle session is kept before its bytes are deleted
+
+# File downloads (notes/downloads.py)
+DOWNLOAD_OFFLOAD = None  # 'x-accel-redirect' (nginx) or 'x-sendfile' (Apache, lighttpd) to let the web server send files
+DOWNLOAD_ACCEL_PREFIX = '/protected-media/'  # nginx internal location aliased to MEDIA_ROOT
+DOWNLOAD_BLOCK_SIZE = 512 * 1024  # Bytes per read when Python streams a file
+DOWNLOAD_MAX_RANGES = 16  # Requests with more ranges get the whole file
+
+# Metrics (notes/metrics.py), served at /metrics in the Prometheus text format
+# Shared by every process (on one host); None for per-process metrics, as under manage.py test
+METRICS_DIR = None if sys.argv[1:2] == ['test'] else os.path.join(BASE_DIR, 'cache', 'metrics')
+METRICS_FLUSH_INTERVAL = 5  # Seconds between writes of a process's values to METRICS_DIR
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']  # Clients allowed to scrape /metrics
+
+# Sampling profiles of slow requests (notes/profiler.py)
+PROFILE_SLOW_REQUEST_MS = None  # e.g. 2000 to profile every request and keep those slower than 2s
+PROFILE_SAMPLE_INTERVAL_MS = 5  # Stack samples per request thread every this many ms
+PROFILE_DIR = os.path.join(BASE_DIR, 'cache', 'profiles')  # Collapsed stacks, for flamegraph.pl or speedscope
@@ -1,7 +1,10 @@
 from django.contrib import admin
 from django.urls import include, path
 
+from notes.metrics import metrics_view
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('notes/', include('notes.urls')),
+    path('metrics', metrics_view, name='metrics'),  # Prometheus scrape endpoint
 ]
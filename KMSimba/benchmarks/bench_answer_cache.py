@@ -0,0 +1,69 @@
+"""Cost of an answer cache lookup compared with the work a hit skips.
+
+Run from the project root (no database access is needed):
+
+    python benchmarks/bench_answer_cache.py [--entries N]
+
+A file-based LRU answer cache is filled to ``--entries`` answers, then
+repeated questions over ``QA_PASSAGES`` synthetic passages of
+``PASSAGE_WORDS`` words are looked up. The reported hit time covers
+hashing the key and reading the entry. A miss costs a Gemini call plus a
+DistilBERT pass, which is seconds rather than milliseconds.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'KMSimba.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.conf import settings  # noqa: E402
+
+from notes.answer_cache import answer_key  # noqa: E402
+from notes.cache_backends import LRUFileBasedCache  # noqa: E402
+
+LOOKUPS = 2000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--entries', type=int, default=10_000)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    words = " ".join(["lorem"] * settings.PASSAGE_WORDS)
+    passages = [SimpleNamespace(id=i, text=f"{i} {words}") for i in range(settings.QA_PASSAGES)]
+
+    with tempfile.TemporaryDirectory() as location:
+        cache = LRUFileBasedCache(location, {'OPTIONS': {'MAX_ENTRIES': args.entries * 2}})
+        started = time.perf_counter()
+        for number in range(args.entries):
+            cache.set(answer_key(f"question {number}", passages, 1), {'answer': "an answer", 'ms': 2500}, None)
+        print(f"filled {args.entries} entries in {time.perf_counter() - started:.1f}s")
+
+        timings = []
+        for number in rng.integers(args.entries, size=LOOKUPS):
+            started = time.perf_counter()
+            cache.get(answer_key(f"question {number}", passages, 1))
+            timings.append(time.perf_counter() - started)
+        timings = np.array(timings) * 1000
+        print(f"hit: p50 {np.percentile(timings, 50):.3f} ms, p99 {np.percentile(timings, 99):.3f} ms")
+
+        cache._max_entries = args.entries
+        started = time.perf_counter()
+        cache._cull()
+        print(f"cull of {args.entries // cache._cull_frequency} least recently used entries: "
+              f"{time.perf_counter() - started:.2f}s")
+
+
+if __name__ == '__main__':
+    main()
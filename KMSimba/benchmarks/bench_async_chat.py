@@ -0,0 +1,86 @@
+"""Concurrent chat load test against a running KMSimba server.
+
+Start the fake LLM and the app, then run the load:
+
+    python benchmarks/fake_llm_server.py --port 8100 &
+    GEMINI_API_BASE=http://127.0.0.1:8100 uvicorn KMSimba.asgi:application --port 8000 &
+    python benchmarks/bench_async_chat.py --url http://127.0.0.1:8000/notes/search/stream/ --concurrency 200
+
+Every client posts questions back to back, each one different so the answer
+cache is bypassed (``--repeat`` reuses one question to measure cache hits).
+On the streaming endpoint, time to the first ``token`` event is reported as
+well as time to the final ``answer``. The same run against
+``/notes/search/`` measures the non-streaming view, e.g. served by sync
+gunicorn workers for comparison.
+
+``LLM_BACKEND=fake`` (with ``FAKE_LLM_FIRST_TOKEN_MS`` and
+``FAKE_LLM_TOKEN_MS``) replaces the fake server with replies generated in
+the app process, so no HTTP hop to an LLM is made at all.
+"""
+import argparse
+import asyncio
+import time
+
+import httpx
+import numpy as np
+
+
+async def chat(client, url, question, stream):
+    started = time.perf_counter()
+    first_token = None
+    if not stream:
+        response = await client.post(url, data={'message': question})
+        response.raise_for_status()
+        return time.perf_counter() - started, None
+    async with client.stream('POST', url, data={'message': question}) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if first_token is None and line.startswith('event: '):
+                first_token = time.perf_counter() - started
+            if line == 'event: error':
+                raise RuntimeError("server reported an error")
+    return time.perf_counter() - started, first_token
+
+
+async def client_loop(client, args, number, totals, firsts, errors):
+    for request in range(args.requests):
+        question = "what did I write about the project" if args.repeat else f"question {number}-{request} about the project"
+        try:
+            total, first = await chat(client, args.url, question, args.url.rstrip('/').endswith('stream'))
+        except (httpx.HTTPError, RuntimeError):
+            errors.append(1)
+            continue
+        totals.append(total)
+        if first is not None:
+            firsts.append(first)
+
+
+async def run(args):
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=120) as client:
+        totals, firsts, errors = [], [], []
+        started = time.perf_counter()
+        await asyncio.gather(*[
+            client_loop(client, args, number, totals, firsts, errors) for number in range(args.concurrency)
+        ])
+        elapsed = time.perf_counter() - started
+
+    print(f"{args.concurrency} concurrent chats, {len(totals)} answered, {len(errors)} errors in {elapsed:.1f}s "
+          f"({len(totals) / elapsed:.1f} chats/s)")
+    for label, values in (('answer', totals), ('first token', firsts)):
+        if values:
+            values = np.array(values) * 1000
+            print(f"{label:>12}: p50 {np.percentile(values, 50):7.0f} ms  p99 {np.percentile(values, 99):7.0f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default='http://127.0.0.1:8000/notes/search/stream/')
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--requests', type=int, default=5, help="Questions per client")
+    parser.add_argument('--repeat', action='store_true', help="Ask the same question every time")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""Memory and throughput of chunked uploads compared with reading a file whole.
+
+Run from the project root (uses a throwaway test database and media root):
+
+    python benchmarks/bench_chunked_upload.py [--size-mb 1024] [--chunk-mb 64]
+
+A file of ``--size-mb`` random bytes is sent to the upload session endpoint
+in ``--chunk-mb`` chunks through Django's WSGI handler. The request bodies
+are produced on the fly, so the only copies of the data in the process are
+the ones the server makes. Peak Python allocations (tracemalloc) are
+reported per request. The last chunk is sent after the running digest is
+dropped, as on a worker that did not receive the earlier chunks, to show the
+cost of hashing the file once at completion. For comparison, the finished file is hashed
+the old way, ``sha256(file.read())``.
+"""
+import argparse
+import io
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from hashlib import sha256
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'KMSimba.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.core.handlers.wsgi import WSGIHandler  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test.utils import override_settings, setup_test_environment  # noqa: E402
+from django.urls import reverse  # noqa: E402
+
+from notes import uploads  # noqa: E402
+from notes.models import IngestJob  # noqa: E402
+
+MB = 1024 * 1024
+
+
+class RandomBody(io.RawIOBase):
+    """``length`` pseudo-random bytes, generated as they are read."""
+
+    def __init__(self, length, digest):
+        self.remaining = length
+        self.digest = digest
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        size = self.remaining if size is None or size < 0 else min(size, self.remaining)
+        block = os.urandom(size)
+        self.digest.update(block)
+        self.remaining -= size
+        return block
+
+
+def put_chunk(handler, url, start, length, size, digest):
+    environ = {
+        'REQUEST_METHOD': 'PUT', 'PATH_INFO': url, 'SERVER_NAME': 'localhost', 'SERVER_PORT': '80',
+        'wsgi.url_scheme': 'http', 'wsgi.input': RandomBody(length, digest), 'wsgi.errors': sys.stderr,
+        'CONTENT_TYPE': 'application/octet-stream', 'CONTENT_LENGTH': str(length),
+        'HTTP_CONTENT_RANGE': f"bytes {start}-{start + length - 1}/{size}", 'HTTP_HOST': 'localhost',
+    }
+    statuses = []
+    body = b''.join(handler(environ, lambda status, headers: statuses.append(status)))
+    if not statuses[0].startswith('200'):
+        raise RuntimeError(f"{statuses[0]}: {body[:200]}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size-mb', type=int, default=1024)
+    parser.add_argument('--chunk-mb', type=int, default=64)
+    args = parser.parse_args()
+    size, chunk = args.size_mb * MB, args.chunk_mb * MB
+
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        with tempfile.TemporaryDirectory() as media_root, override_settings(
+            MEDIA_ROOT=media_root, ALLOWED_HOSTS=['localhost'], UPLOAD_CHUNK_MAX_SIZE=chunk,
+        ):
+            handler = WSGIHandler()
+            session = uploads.start_upload("scan.pdf", size)
+            url = reverse('upload_session', args=[session.token])
+            digest = sha256()
+            peaks = []
+            started = time.perf_counter()
+            for start in range(0, size, chunk):
+                if start == size - chunk:
+                    # The last chunk on a "different worker": the whole file is hashed at completion.
+                    uploads._digests.clear()
+                    resume_started = time.perf_counter()
+                tracemalloc.start()
+                put_chunk(handler, url, start, min(chunk, size - start), size, digest)
+                peaks.append(tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+            elapsed = time.perf_counter() - started
+            resume = time.perf_counter() - resume_started
+
+            job = IngestJob.objects.get()
+            assert job.content_hash == digest.hexdigest()
+            print(f"{args.size_mb} MB in {args.chunk_mb} MB chunks: {elapsed:.1f}s ({args.size_mb / elapsed:.0f} MB/s), "
+                  f"peak allocations per request {max(peaks) / MB:.1f} MB")
+            print(f"last chunk without the running digest, hashing {size // MB} MB on disk: {resume:.2f}s")
+
+            tracemalloc.start()
+            started = time.perf_counter()
+            with job.upload.open('rb') as f:
+                sha256(f.read()).hexdigest()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f"sha256(file.read()) for comparison: {time.perf_counter() - started:.1f}s, peak allocations {peak / MB:.0f} MB")
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""Recall and latency of dense IVF retrieval against brute-force TF-IDF.
+
+Run from the project root (no database access is needed):
+
+    python benchmarks/bench_dense_retrieval.py [--sizes 10000 100000 1000000] [--tfidf-max N]
+
+Embedding a million passages on CPU takes hours, so the dense index is
+filled with synthetic unit vectors clustered around topics (the shape ANN
+indexes are sensitive to) instead of model output. Recall@10 is the share of
+the exact top 10 (brute-force inner product over the ``float32`` vectors,
+before they are stored) that the IVF search returns, for ``float16`` and
+``int8`` storage and a few probe counts, so it includes the quantization
+loss. Brute-force TF-IDF over synthetic 200-word passages is timed at the
+same sizes up to ``--tfidf-max``, above which it does not fit in memory here.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'KMSimba.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from notes.dense_index import DenseIndex, assign_lists, target_lists, train_centroids  # noqa: E402
+from notes.search_index import IncrementalTfidfIndex  # noqa: E402
+
+DIM = 384
+TOPICS = 2000
+QUERIES = 300
+CHUNK = 100_000
+VOCABULARY = np.array([f"term{i}" for i in range(30_000)])
+
+
+def normalize(vectors):
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def make_vectors(size, topics, queries, rng, dtype):
+    """Return ``size`` vectors stored as ``dtype`` and the ids of each query's exact top 10 in ``float32``."""
+    vectors = np.empty((size, DIM), dtype=dtype)
+    best_scores = np.full((len(queries), 10), -np.inf, dtype=np.float32)
+    best_ids = np.zeros((len(queries), 10), dtype=np.int64)
+    for start in range(0, size, CHUNK):
+        rows = min(CHUNK, size - start)
+        noisy = topics[rng.integers(len(topics), size=rows)] + rng.normal(scale=0.04, size=(rows, DIM))
+        chunk = normalize(noisy).astype(np.float32)
+        vectors[start:start + rows] = np.rint(chunk * 127) if dtype == np.int8 else chunk
+        # Running top 10: the best so far come first, then this chunk's rows.
+        scores = np.concatenate([best_scores, queries @ chunk.T], axis=1)
+        top = np.argpartition(-scores, 9, axis=1)[:, :10]
+        best_ids = np.where(top < 10, np.take_along_axis(best_ids, np.minimum(top, 9), axis=1), start + top - 10 + 1)
+        best_scores = np.take_along_axis(scores, top, axis=1)
+    return vectors, [set(ids.tolist()) for ids in best_ids]
+
+
+def make_index(vectors, dtype):
+    index = DenseIndex(dtype=dtype, encode=lambda texts: None)
+    n_lists = target_lists(len(vectors))
+    if n_lists:
+        centroids = train_centroids(vectors, n_lists)
+        labels = assign_lists(vectors, centroids)
+        order = np.argsort(labels, kind='stable')
+        vectors = vectors[order]
+        offsets = np.searchsorted(labels[order], np.arange(n_lists + 1))
+    else:
+        centroids, order = np.zeros((0, DIM), dtype=np.float32), np.arange(len(vectors))
+        offsets = np.array([0, len(vectors)])
+    arrays = {'vectors': vectors, 'doc_ids': order + 1, 'centroids': centroids, 'list_offsets': offsets}
+    return DenseIndex.from_arrays(arrays, index.meta(), encode=index.encode)
+
+
+def percentiles(timings):
+    timings = np.array(timings) * 1000
+    return np.percentile(timings, 50), np.percentile(timings, 99)
+
+
+def bench_dense(size, rng):
+    topics = normalize(rng.normal(size=(TOPICS, DIM)))
+    queries = normalize(topics[rng.integers(TOPICS, size=QUERIES)] + rng.normal(scale=0.04, size=(QUERIES, DIM)))
+    queries = queries.astype(np.float32)
+    for dtype in (np.float16, np.int8):
+        # The same seed for both dtypes, so they store the same float32 vectors.
+        vectors, truth = make_vectors(size, topics, queries, np.random.default_rng(size), dtype)
+        started = time.perf_counter()
+        index = make_index(vectors, dtype)
+        built = time.perf_counter() - started
+        for n_probe in (4, 16, 64):
+            index.n_probe = n_probe
+            timings, hits = [], 0
+            for query, expected in zip(queries, truth):
+                started = time.perf_counter()
+                results = index.search_vector(query, top_k=10)
+                timings.append(time.perf_counter() - started)
+                hits += len({doc_id for doc_id, _ in results} & expected)
+            p50, p99 = percentiles(timings)
+            print(f"{size:>9} {'dense ' + np.dtype(dtype).name:>13} {n_probe:>6} {hits / (10 * QUERIES):>9.3f} "
+                  f"{p50:>8.2f} {p99:>8.2f}   built in {built:.1f}s")
+        del vectors, index
+
+
+def bench_tfidf(size, rng):
+    index = IncrementalTfidfIndex()
+    topics = rng.integers(len(VOCABULARY), size=(TOPICS, 300))
+    for start in range(0, size, 10_000):
+        rows = min(10_000, size - start)
+        words = topics[rng.integers(TOPICS, size=rows)]
+        texts = [" ".join(VOCABULARY[row[rng.integers(300, size=200)]]) for row in words]
+        index.add_many(range(start + 1, start + rows + 1), texts)
+    index.refresh()
+    queries = [" ".join(VOCABULARY[topics[rng.integers(TOPICS)][rng.integers(300, size=5)]]) for _ in range(QUERIES)]
+    timings = []
+    for query in queries:
+        started = time.perf_counter()
+        index.search(query, top_k=10)
+        timings.append(time.perf_counter() - started)
+    p50, p99 = percentiles(timings)
+    print(f"{size:>9} {'tfidf':>13} {'all':>6} {1.0:>9.3f} {p50:>8.2f} {p99:>8.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--tfidf-max', type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f"{'passages':>9} {'index':>13} {'probes':>6} {'recall@10':>9} {'p50 ms':>8} {'p99 ms':>8}")
+    for size in args.sizes:
+        if size <= args.tfidf_max:
+            bench_tfidf(size, rng)
+        bench_dense(size, rng)
+
+
+if __name__ == '__main__':
+    main()
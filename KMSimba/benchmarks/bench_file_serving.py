@@ -0,0 +1,120 @@
+"""Throughput and CPU per GB of the ways a download body can be sent.
+
+Run from the project root (no database access is needed):
+
+    python benchmarks/bench_file_serving.py [--size-mb 1024] [--repeat 3]
+
+A temporary file of ``--size-mb`` random bytes is sent over a local socket
+pair, drained by a second thread, by:
+
+``FileResponse, 4 KB reads``
+    the previous download view: Django's default block size;
+``serve_file, Python``
+    ``notes.downloads.serve_file`` iterated as a WSGI server without
+    ``wsgi.file_wrapper`` does (``DOWNLOAD_BLOCK_SIZE`` reads; under ASGI
+    each read also hops to a worker thread);
+``serve_file, os.sendfile``
+    the same response sent the way gunicorn's ``wsgi.file_wrapper`` does,
+    from the file's offset for ``Content-Length`` bytes.
+
+CPU is the sending thread's own time (``time.thread_time``), so the drain
+side is excluded. Building an ``X-Accel-Redirect`` response, which leaves
+the body to nginx, is timed per request.
+"""
+import argparse
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'KMSimba.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.http import FileResponse  # noqa: E402
+from django.test import RequestFactory, override_settings  # noqa: E402
+
+from notes.downloads import serve_file  # noqa: E402
+
+MB = 1024 * 1024
+
+
+def drain(sock, total):
+    buffer = bytearray(4 * MB)
+    received = 0
+    while received < total:
+        received += sock.recv_into(buffer)
+
+
+def send_iter(sock, response):
+    for chunk in response:
+        sock.sendall(chunk)
+    response.close()
+
+
+def send_file(sock, response):
+    file = response.file_to_stream
+    remaining = int(response['Content-Length'])
+    offset = os.lseek(file.fileno(), 0, os.SEEK_CUR)
+    while remaining:
+        sent = os.sendfile(sock.fileno(), file.fileno(), offset, remaining)
+        offset += sent
+        remaining -= sent
+    response.close()
+
+
+def measure(make_response, send, size):
+    sender, receiver = socket.socketpair()
+    sender.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4 * MB)
+    drainer = threading.Thread(target=drain, args=(receiver, size))
+    drainer.start()
+    started, cpu = time.perf_counter(), time.thread_time()
+    send(sender, make_response())
+    cpu = time.thread_time() - cpu
+    drainer.join()
+    elapsed = time.perf_counter() - started
+    sender.close()
+    receiver.close()
+    return elapsed, cpu
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size-mb', type=int, default=1024)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    size = args.size_mb * MB
+    gigabytes = size / 1024 ** 3
+    request = RequestFactory().get('/notes/download/1/')
+
+    with tempfile.TemporaryDirectory() as media_root:
+        path = os.path.join(media_root, 'scan.pdf')
+        with open(path, 'wb') as f:
+            for _ in range(args.size_mb):
+                f.write(os.urandom(MB))
+
+        methods = [
+            ("FileResponse, 4 KB reads", lambda: FileResponse(open(path, 'rb')), send_iter),
+            ("serve_file, Python", lambda: serve_file(request, path, 'scan.pdf', 'abc'), send_iter),
+            ("serve_file, os.sendfile", lambda: serve_file(request, path, 'scan.pdf', 'abc'), send_file),
+        ]
+        print(f"{args.size_mb} MB file, best of {args.repeat}")
+        for name, make_response, send in methods:
+            elapsed, cpu = min(measure(make_response, send, size) for _ in range(args.repeat))
+            print(f"{name:>26}: {args.size_mb / elapsed:6.0f} MB/s, {cpu / gigabytes:6.3f} CPU s/GB")
+
+        with override_settings(DOWNLOAD_OFFLOAD='x-accel-redirect', MEDIA_ROOT=media_root):
+            started = time.perf_counter()
+            for _ in range(1000):
+                serve_file(request, path, 'scan.pdf', 'abc')
+            print(f"{'X-Accel-Redirect response':>26}: {(time.perf_counter() - started):.3f} ms per request, "
+                  f"body sent by nginx")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""Precision and latency of hybrid (RRF) search against each retriever alone.
+
+Run from the project root (uses a throwaway test database):
+
+    python benchmarks/bench_hybrid_search.py [--files N]
+
+Synthetic files belong to one of ``TOPICS`` topics whose vocabularies
+overlap. Each file gets noisy tags (half drawn from its topic, half from the
+whole vocabulary) and half of them also a note drawn from its topic. A
+query is three words of one topic; a result is relevant when it comes from a
+file of that topic. Query tags are taken as the query words rather than spaCy
+lemmas, since the words are already in base form.
+
+Precision@10 of the tag ranking, the passage ranking and the fused ranking
+is reported, along with the stage timings of ``hybrid_search``: the two
+retrievers run concurrently, so ``total`` is compared with the sum of both.
+"""
+import argparse
+import os
+import statistics
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'KMSimba.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.db import connection  # noqa: E402
+from django.test.utils import override_settings, setup_test_environment  # noqa: E402
+
+from notes import hybrid_search as hybrid, note_search, utils  # noqa: E402
+from notes.models import File  # noqa: E402
+from notes.services import NoteService  # noqa: E402
+from notes.utils import save_file_tags  # noqa: E402
+
+TOPICS = 40
+TOPIC_WORDS = 60
+VOCABULARY = np.array([f"word{i}" for i in range(1500)])
+QUERIES = 200
+
+
+def make_corpus(files, rng):
+    topic_words = [rng.choice(len(VOCABULARY), TOPIC_WORDS, replace=False) for _ in range(TOPICS)]
+    topic_of = {}
+    notes = []
+    for number in range(files):
+        topic = number % TOPICS
+        file = File.objects.create(
+            file_name=f"file{number}.txt", file_content=f"file{number}.txt", content_hash=str(number),
+        )
+        topic_of[file.id] = topic
+        tags = np.concatenate([
+            VOCABULARY[rng.choice(topic_words[topic], 4)], VOCABULARY[rng.integers(len(VOCABULARY), size=4)],
+        ])
+        save_file_tags(file, set(tags.tolist()))
+        if number % 2:
+            notes.append((" ".join(VOCABULARY[rng.choice(topic_words[topic], 80)]), file))
+    NoteService.ingest_many(notes)
+    return topic_words, topic_of
+
+
+def precision(keys, topic, topic_of):
+    return sum(1 for kind, key in keys[:10] if kind == 'file' and topic_of.get(key) == topic) / 10
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=2000)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    utils.query_tags = lambda query: frozenset(query.split())
+    try:
+        with override_settings(TAG_INDEX_ENABLED=True, TAG_INDEX_SNAPSHOT='/nonexistent/postings.npz'):
+            topic_words, topic_of = make_corpus(args.files, rng)
+            note_search.load_passage_index()
+            scores = {'tags': [], 'passages': [], 'fused': []}
+            timings = {'tags': [], 'passages': [], 'fuse': [], 'total': []}
+            for _ in range(QUERIES):
+                topic = int(rng.integers(TOPICS))
+                query = " ".join(VOCABULARY[rng.choice(topic_words[topic], 3, replace=False)])
+                response = hybrid.hybrid_search(query, per_page=10)
+                fused = [(r['type'], r['file_id'] or r['note_id']) for r in response['results']]
+                tag_keys = [('file', file_id) for file_id, _ in hybrid._search_files(query, 10)]
+                passage_keys = []
+                for passage_id, _ in hybrid._search_passages(query, 50):
+                    file_id = File.objects.filter(notes__passages__id=passage_id).values_list('id', flat=True).first()
+                    if ('file', file_id) not in passage_keys:
+                        passage_keys.append(('file', file_id))
+                scores['tags'].append(precision(tag_keys, topic, topic_of))
+                scores['passages'].append(precision(passage_keys, topic, topic_of))
+                scores['fused'].append(precision(fused, topic, topic_of))
+                for stage, value in response['timings'].items():
+                    timings[stage].append(value)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    print(f"{args.files} files, {QUERIES} queries")
+    for name, values in scores.items():
+        print(f"precision@10 {name:>9}: {statistics.mean(values):.3f}")
+    for stage, values in timings.items():
+        print(f"{stage:>9} p50 {statistics.median(values):7.2f} ms   p99 {np.percentile(values, 99):7.2f} ms")
+    serial = [t + p for t, p in zip(timings['tags'], timings['passages'])]
+    print(f"tags + passages run one after the other would be p50 {statistics.median(serial):.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""Save latency of the incremental note index as the corpus grows.
+
+Run from the project root:
+
+    python benchmarks/bench_incremental_index.py
+
+For each corpus size the index is pre-filled with synthetic notes, then a
+batch of single-note saves is timed (append + the refresh the next query
+triggers is reported separately). A full TfidfVectorizer refit, which is what
+every save used to cost, is timed at the same sizes for comparison.
+
+Query latency is then measured while a writer thread keeps adding notes:
+searches served with the last IDF weights (refreshed in the background) are
+compared with recomputing the weights before every query, which is what a
+search after a write used to cost.
+"""
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sklearn.feature_extraction.text import TfidfVectorizer  # noqa: E402
+
+from notes.search_index import IncrementalTfidfIndex  # noqa: E402
+
+SIZES = (1_000, 10_000, 100_000)
+SAVES = 200
+QUERIES = 100
+QUERY_TEXTS = ("term1 term2 term3", "term42 term4242", "term7 term77 term777 term7777")
+VOCABULARY = [f"term{i}" for i in range(20_000)]
+
+
+def make_notes(count, rng):
+    return [" ".join(rng.choices(VOCABULARY, k=rng.randint(20, 120))) for _ in range(count)]
+
+
+def bench_size(size, rng, refit=True):
+    corpus = make_notes(size, rng)
+    index = IncrementalTfidfIndex()
+    index.add_many(range(size), corpus)
+    index.refresh()
+
+    new_notes = make_notes(SAVES, rng)
+    timings = []
+    for offset, text in enumerate(new_notes):
+        start = time.perf_counter()
+        index.add(size + offset, text)
+        timings.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    index.search("term1 term2 term3")
+    first_query = time.perf_counter() - start
+
+    refit_time = None
+    if refit:
+        start = time.perf_counter()
+        TfidfVectorizer(stop_words='english').fit_transform(corpus + new_notes)
+        refit_time = time.perf_counter() - start
+
+    return timings, first_query, refit_time
+
+
+def percentiles(timings):
+    timings = sorted(timings)
+    return statistics.median(timings) * 1000, timings[int(len(timings) * 0.95)] * 1000
+
+
+def bench_queries_under_writes(size, rng, refresh_every_query):
+    index = IncrementalTfidfIndex()
+    index.add_many(range(size), make_notes(size, rng))
+    index.refresh()
+    new_notes = make_notes(QUERIES * 10, rng)
+    stop = threading.Event()
+
+    def write():
+        for offset, text in enumerate(new_notes):
+            if stop.is_set():
+                break
+            index.add(size + offset, text)
+            time.sleep(0.001)
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    timings = []
+    try:
+        for i in range(QUERIES):
+            start = time.perf_counter()
+            if refresh_every_query:
+                index.refresh()
+            index.search(QUERY_TEXTS[i % len(QUERY_TEXTS)])
+            timings.append(time.perf_counter() - start)
+    finally:
+        stop.set()
+        writer.join()
+    return percentiles(timings)
+
+
+def main():
+    rng = random.Random(42)
+    print(f"{'notes':>8} {'save p50 ms':>12} {'save p95 ms':>12} {'1st query ms':>13} {'full refit ms':>14}")
+    for size in SIZES:
+        timings, first_query, refit_time = bench_size(size, rng)
+        p50, p95 = percentiles(timings)
+        refit = f"{refit_time * 1000:14.1f}" if refit_time is not None else f"{'-':>14}"
+        print(f"{size:>8} {p50:12.3f} {p95:12.3f} {first_query * 1000:13.1f} {refit}")
+
+    print()
+    print("query latency while notes are being added")
+    print(f"{'notes':>8} {'weights':>18} {'p50 ms':>9} {'p95 ms':>9}")
+    for size in SIZES:
+        for label, refresh_every_query in (('background refresh', False), ('every query', True)):
+            p50, p95 = bench_queries_under_writes(size, rng, refresh_every_query)
+            print(f"{size:>8} {label:>18} {p50:9.2f} {p95:9.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+"""Load time, memory, latency and accuracy parity of the CPU inference runtimes.
+
+Run from the project root (downloads the models on first use):
+
+    python benchmarks/bench_inference_runtime.py [--runtimes eager int8 onnx onnx-int8]
+        [--questions 50] [--images 16] [--images-dir DIR] [--threads N]
+        [--qa-model ID_OR_PATH] [--yolos-model ID_OR_PATH]
+
+Each runtime of ``notes.inference`` is measured in a fresh process, so the
+peak RSS (``ru_maxrss``) is that of the two models and their inputs alone.
+The ONNX exports are built first, in a process of their own, and the time
+that takes is reported separately from loading.
+
+QA answers ``--questions`` questions about generated passages of about 300
+tokens; YOLOS detects objects one image at a time, as an upload does, on the
+images in ``--images-dir`` or on synthetic page-sized ones (which rarely
+contain anything a trained model detects, so use real images to judge label
+parity). Latencies are p50/p99 per call. Parity with eager is the QA exact
+match rate and the mean overlap of detected labels, as checked by
+``manage.py check_inference_runtime``.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'KMSimba.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.conf import settings  # noqa: E402
+
+from notes import inference  # noqa: E402
+from notes.utils import detect_objects  # noqa: E402
+
+NAMES = ("Ada", "Grace", "Alan", "Edsger", "Barbara", "Donald")
+PLACES = ("London", "Zurich", "Boston", "Nairobi", "Lisbon", "Osaka")
+QUESTIONS = ("Who wrote the report?", "Where was the meeting held?", "When was the budget approved?",
+             "What was decided?")
+
+
+def make_questions(count, rng):
+    samples = []
+    for index in range(count):
+        sentences = []
+        for _ in range(12):
+            sentences.append(
+                f"{rng.choice(NAMES)} wrote the report on {int(rng.integers(1, 28))} March {int(rng.integers(1990, 2024))} "
+                f"after the meeting held in {rng.choice(PLACES)}, where the budget was approved and the team "
+                f"decided to move the archive to the new storage cluster."
+            )
+        samples.append((QUESTIONS[index % len(QUESTIONS)], " ".join(sentences)))
+    return samples
+
+
+def load_images(count, images_dir, rng):
+    if images_dir:
+        names = sorted(os.listdir(images_dir))[:count]
+        return [os.path.join(images_dir, name) for name in names]
+    # 612x792 is a US letter page rendered at 72 dpi, fitz's default.
+    return [rng.integers(0, 255, size=(792, 612, 3), dtype=np.uint8) for _ in range(count)]
+
+
+def percentiles(latencies):
+    return [float(np.percentile(latencies, 50)) * 1000, float(np.percentile(latencies, 99)) * 1000]
+
+
+def run_child(args):
+    if args.threads:
+        settings.TORCH_NUM_THREADS = args.threads
+        import torch
+
+        torch.set_num_threads(args.threads)
+    if args.child == 'export':
+        started = time.perf_counter()
+        inference.load_question_answerer(args.qa_model, 'onnx-int8')
+        inference.load_detector(args.yolos_model, 'onnx-int8')
+        print(json.dumps({'export': time.perf_counter() - started}))
+        return
+
+    rng = np.random.default_rng(0)
+    started = time.perf_counter()
+    qa = inference.load_question_answerer(args.qa_model, args.child)
+    detector = inference.load_detector(args.yolos_model, args.child)
+    load = time.perf_counter() - started
+
+    samples = make_questions(args.questions, rng)
+    images = load_images(args.images, args.images_dir, rng)
+    qa(question=samples[0][0], context=samples[0][1])  # warm up (opens ONNX sessions)
+    detect_objects(images[:1], detector=detector)
+
+    answers, qa_latencies = [], []
+    for question, context in samples:
+        started = time.perf_counter()
+        answers.append(qa(question=question, context=context)['answer'].strip())
+        qa_latencies.append(time.perf_counter() - started)
+    labels, yolos_latencies = [], []
+    for image in images:
+        started = time.perf_counter()
+        labels.extend(detect_objects([image], detector=detector))
+        yolos_latencies.append(time.perf_counter() - started)
+
+    print(json.dumps({
+        'load': load,
+        'rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'qa': percentiles(qa_latencies),
+        'yolos': percentiles(yolos_latencies),
+        'answers': answers,
+        'labels': labels,
+    }))
+
+
+def spawn(runtime_name):
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), *sys.argv[1:], '--child', runtime_name],
+        check=True, capture_output=True, text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runtimes', nargs='+', default=list(inference.RUNTIMES))
+    parser.add_argument('--questions', type=int, default=50)
+    parser.add_argument('--images', type=int, default=16)
+    parser.add_argument('--images-dir')
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--qa-model', default=settings.QA_MODEL)
+    parser.add_argument('--yolos-model', default=settings.YOLOS_MODEL)
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        run_child(args)
+        return
+
+    if any(name.startswith('onnx') for name in args.runtimes):
+        print(f"ONNX export (plain and int8, both models): {spawn('export')['export']:.1f}s")
+    results = {name: spawn(name) for name in ['eager'] + [name for name in args.runtimes if name != 'eager']}
+    baseline = results['eager']
+
+    print(f"{args.questions} questions, {args.images} images")
+    print(f"{'runtime':>10} {'load s':>7} {'RSS MB':>7} {'QA p50/p99 ms':>15} {'YOLOS p50/p99 ms':>17} "
+          f"{'QA EM':>6} {'labels':>7}")
+    for name in args.runtimes:
+        result = results[name]
+        exact_match = np.mean([a == b for a, b in zip(baseline['answers'], result['answers'])])
+        overlap = inference.detection_parity(baseline['labels'], result['labels'])
+        print(f"{name:>10} {result['load']:7.1f} {result['rss']:7.0f} "
+              f"{result['qa'][0]:7.1f}/{result['qa'][1]:<7.1f} {result['yolos'][0]:8.1f}/{result['yolos'][1]:<8.1f} "
+              f"{exact_match:6.0%} {overlap:7.0%}")
+
+
+if __name__ == '__main__':
+    main()
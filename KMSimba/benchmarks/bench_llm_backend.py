@@ -0,0 +1,142 @@
+"""Tail latency of LLM calls under open-loop load, without network.
+
+Run from the project root (no database access is needed):
+
+    python benchmarks/bench_llm_backend.py [--rate 40] [--seconds 20] [--capacity 16] [--budget 10]
+
+Questions arrive as a Poisson process at ``--rate`` per second and each
+prompt is built by ``chat.build_prompt`` from ``QA_PASSAGES`` synthetic
+passages. Replies come from a simulated model server that shares its
+throughput between the calls in flight: up to ``--capacity`` calls each run
+at full speed (``FAKE_LLM_FIRST_TOKEN_MS`` + ``FAKE_LLM_TOKEN_MS`` per word),
+beyond that they all slow down, like a GPU or a rate-limited API. A batch
+costs one reply plus ``--batch-item-cost`` of a reply per extra prompt.
+
+Three setups are compared: no concurrency limit, ``LLM_MAX_CONCURRENCY`` set
+to the server's capacity, and the limit plus micro-batching. Every call has
+``--budget`` seconds; those that exceed it fail. Latency percentiles are
+over the calls that succeeded.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'KMSimba.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.conf import settings  # noqa: E402
+from django.test import override_settings  # noqa: E402
+
+from notes import llm  # noqa: E402
+from notes.chat import build_prompt  # noqa: E402
+
+TICK = 0.01
+
+
+class SimulatedServer(llm.FakeBackend):
+    """Fake backend whose ``capacity`` is shared among the calls in flight."""
+
+    def __init__(self, capacity, batch_item_cost):
+        self.capacity = capacity
+        self.batch_item_cost = batch_item_cost
+        self.in_flight = 0
+
+    def reply_seconds(self):
+        return (settings.FAKE_LLM_FIRST_TOKEN_MS + settings.FAKE_LLM_TOKEN_MS * (settings.FAKE_LLM_TOKENS - 1)) / 1000
+
+    async def work(self, seconds):
+        self.in_flight += 1
+        try:
+            while seconds > 0:
+                await asyncio.sleep(TICK)
+                seconds -= TICK * min(1, self.capacity / self.in_flight)
+        finally:
+            self.in_flight -= 1
+
+    async def stream(self, prompt, timeout):
+        await self.work(self.reply_seconds())
+        for word in self.reply_words(prompt):
+            yield word + ' '
+
+    async def generate_batch(self, prompts, timeout):
+        await self.work(self.reply_seconds() * (1 + self.batch_item_cost * (len(prompts) - 1)))
+        return [' '.join(self.reply_words(prompt)) for prompt in prompts]
+
+
+async def timed_call(prompt, latencies, failures):
+    started = time.perf_counter()
+    try:
+        await llm.generate(prompt)
+    except llm.LLMError:
+        failures.append(time.perf_counter() - started)
+        return
+    latencies.append(time.perf_counter() - started)
+
+
+async def run_load(prompts, rate, seconds, rng):
+    latencies, failures, calls = [], [], []
+    started = time.perf_counter()
+    for prompt in prompts:
+        calls.append(asyncio.create_task(timed_call(prompt, latencies, failures)))
+        await asyncio.sleep(rng.exponential(1 / rate))
+        if time.perf_counter() - started > seconds:
+            break
+    await asyncio.gather(*calls)
+    return latencies, failures
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rate', type=float, default=40, help="Questions per second")
+    parser.add_argument('--seconds', type=float, default=20)
+    parser.add_argument('--capacity', type=int, default=16, help="Calls the server runs at full speed")
+    parser.add_argument('--budget', type=float, default=10, help="LLM_REQUEST_BUDGET in seconds")
+    parser.add_argument('--batch-item-cost', type=float, default=0.15)
+    parser.add_argument('--first-token-ms', type=float, default=400)
+    parser.add_argument('--token-ms', type=float, default=5)
+    args = parser.parse_args()
+
+    words = " ".join(["lorem"] * settings.PASSAGE_WORDS)
+    passages = [
+        SimpleNamespace(id=i, note_id=i, start=0, end=len(words), text=f"{i} {words}")
+        for i in range(settings.QA_PASSAGES)
+    ]
+    prompts = [build_prompt(f"question {number}", passages) for number in range(int(args.rate * args.seconds * 2))]
+
+    setups = [
+        ("unbounded", {'LLM_MAX_CONCURRENCY': 100_000, 'LLM_BATCH_SIZE': 1}),
+        (f"limit {args.capacity}", {'LLM_MAX_CONCURRENCY': args.capacity, 'LLM_BATCH_SIZE': 1}),
+        (f"limit {args.capacity} + batch 8", {'LLM_MAX_CONCURRENCY': args.capacity, 'LLM_BATCH_SIZE': 8}),
+    ]
+    print(f"{args.rate:.0f} questions/s for {args.seconds:.0f}s, server capacity {args.capacity}, "
+          f"budget {args.budget:.0f}s")
+    for name, overrides in setups:
+        llm.BACKENDS['simulated'] = lambda: SimulatedServer(args.capacity, args.batch_item_cost)
+        llm._backends.pop('simulated', None)
+        with override_settings(
+            LLM_BACKEND='simulated', LLM_REQUEST_BUDGET=args.budget,
+            FAKE_LLM_FIRST_TOKEN_MS=args.first_token_ms, FAKE_LLM_TOKEN_MS=args.token_ms, **overrides,
+        ):
+            latencies, failures = asyncio.run(run_load(prompts, args.rate, args.seconds, np.random.default_rng(0)))
+        total = len(latencies) + len(failures)
+        line = f"{name:>20}: {len(latencies)}/{total} answered"
+        if latencies:
+            values = np.array(latencies) * 1000
+            line += (f", p50 {np.percentile(values, 50):6.0f} ms  p99 {np.percentile(values, 99):6.0f} ms  "
+                     f"max {values.max():6.0f} ms")
+        if failures:
+            line += f", failures after p50 {np.percentile(np.array(failures) * 1000, 50):6.0f} ms"
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
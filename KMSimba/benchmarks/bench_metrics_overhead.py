@@ -0,0 +1,149 @@
+"""Cost of the metrics instrumentation on the search hot paths.
+
+Run from the project root (uses a throwaway test database):
+
+    python benchmarks/bench_metrics_overhead.py [--files N] [--rounds N]
+
+First the cost of one timing (``with timed(...)``, a decorated call) is
+measured on its own. Then the same requests are timed with metrics recorded
+and with recording switched off (``observe_stage`` replaced by a no-op and
+``MetricsMiddleware`` taken out of ``MIDDLEWARE``), alternating the two
+(and which goes first) every round so drift affects both alike:
+
+``tag search``
+    ``perform_search`` on the in-memory tag index, left untimed because a
+    timing cost over 1% of it;
+``hybrid search``
+    ``hybrid_search``, which times itself and both retrievers;
+``GET notes/retrieve/``
+    the hybrid search view through Django's WSGI handler and the middleware;
+``GET notes/jobs/``
+    a view doing a single query, the cheapest request with a DB query.
+
+Files and tags are synthetic, as in ``bench_hybrid_search.py``, and query
+tags are the query words instead of spaCy lemmas. With the project settings
+values are written to ``METRICS_DIR`` as in production.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+from unittest import mock
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'KMSimba.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.conf import settings  # noqa: E402
+from django.core.handlers.wsgi import WSGIHandler  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test.utils import override_settings, setup_test_environment  # noqa: E402
+
+from notes import hybrid_search as hybrid, metrics, note_search, utils  # noqa: E402
+from notes.models import File  # noqa: E402
+from notes.services import NoteService  # noqa: E402
+from notes.utils import save_file_tags  # noqa: E402
+
+VOCABULARY = np.array([f"word{i}" for i in range(1500)])
+CALLS = 100_000
+
+
+def make_corpus(files, rng):
+    notes = []
+    for number in range(files):
+        file = File.objects.create(file_name=f"file{number}.txt", file_content=f"file{number}.txt", content_hash=str(number))
+        save_file_tags(file, set(VOCABULARY[rng.integers(len(VOCABULARY), size=8)].tolist()))
+        if number % 2:
+            notes.append((" ".join(VOCABULARY[rng.integers(len(VOCABULARY), size=80)]), file))
+    NoteService.ingest_many(notes)
+
+
+def per_call_us(func):
+    started = time.perf_counter()
+    for _ in range(CALLS):
+        func()
+    return (time.perf_counter() - started) / CALLS * 1e6
+
+
+def get(handler, path, query):
+    environ = {
+        'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': query, 'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80', 'HTTP_HOST': 'localhost', 'REMOTE_ADDR': '127.0.0.1',
+        'wsgi.url_scheme': 'http', 'wsgi.input': sys.stdin.buffer, 'wsgi.errors': sys.stderr,
+    }
+    statuses = []
+    b''.join(handler(environ, lambda status, headers: statuses.append(status)))
+    if not statuses[0].startswith('200'):
+        raise RuntimeError(f"{path}: {statuses[0]}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=2000)
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--requests', type=int, default=100, help="Calls per round")
+    args = parser.parse_args()
+
+    def noop(*args):
+        pass
+
+    print(f"metrics {'shared in ' + settings.METRICS_DIR if settings.METRICS_DIR else 'per process'}")
+    print(f"{'empty call':>22}: {per_call_us(noop):6.2f} us")
+
+    def block():
+        with metrics.timed('bench_block'):
+            pass
+
+    print(f"{'with timed(...)':>22}: {per_call_us(block):6.2f} us")
+    print(f"{'@timed call':>22}: {per_call_us(metrics.timed('bench_call')(noop)):6.2f} us")
+
+    rng = np.random.default_rng(0)
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    utils.query_tags = lambda query: frozenset(query.split())
+    without_middleware = [name for name in settings.MIDDLEWARE if name != 'notes.metrics.MetricsMiddleware']
+    try:
+        with override_settings(
+            TAG_INDEX_ENABLED=True, TAG_INDEX_SNAPSHOT='/nonexistent/postings.npz', ALLOWED_HOSTS=['localhost'],
+        ):
+            make_corpus(args.files, rng)
+            note_search.load_passage_index()
+            queries = [" ".join(VOCABULARY[rng.integers(len(VOCABULARY), size=3)]) for _ in range(args.requests)]
+            handlers = {True: WSGIHandler()}
+            with override_settings(MIDDLEWARE=without_middleware):
+                handlers[False] = WSGIHandler()
+
+            paths = {
+                'tag search': lambda on, query: utils.perform_search(query),
+                'hybrid search': lambda on, query: hybrid.hybrid_search(query),
+                'GET notes/retrieve/': lambda on, query: get(handlers[on], '/notes/retrieve/', f"query={query}"),
+                'GET notes/jobs/': lambda on, query: get(handlers[on], '/notes/jobs/', ''),
+            }
+            print(f"{args.files} files, {args.rounds} rounds of {args.requests} calls, median per call")
+            print(f"{'':>22} {'metrics on':>11} {'off':>9} {'overhead':>9}")
+            for name, call in paths.items():
+                for query in queries[:10]:
+                    call(True, query)
+                    call(False, query)
+                timings = {True: [], False: []}
+                for number in range(args.rounds):
+                    for on in ((True, False) if number % 2 else (False, True)):
+                        with mock.patch.object(metrics, 'observe_stage', metrics.observe_stage if on else noop):
+                            started = time.perf_counter()
+                            for query in queries:
+                                call(on, query)
+                            timings[on].append((time.perf_counter() - started) / len(queries) * 1000)
+                on, off = statistics.median(timings[True]), statistics.median(timings[False])
+                print(f"{name:>22} {on:8.3f} ms {off:6.3f} ms {(on - off) / off:8.2%}")
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
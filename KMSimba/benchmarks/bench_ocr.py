@@ -0,0 +1,83 @@
+"""OCR throughput on a mixed scanned/digital PDF.
+
+Run from the project root (needs Tesseract installed):
+
+    python benchmarks/bench_ocr.py [--pages 40] [--scanned-ratio 0.5]
+
+Builds a PDF where some pages have a text layer and the rest are images of
+text, then reports pages/sec for the text-layer pass plus OCR with one
+process and with the full pool. The OCR cache is disabled so every run does
+the work.
+"""
+import argparse
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'KMSimba.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+import fitz  # noqa: E402
+from django.conf import settings  # noqa: E402
+from PIL import Image, ImageDraw  # noqa: E402
+
+from notes.ocr import ocr_pdf_pages  # noqa: E402
+from notes.utils import pdf_page_texts  # noqa: E402
+
+LINE = "The quick brown fox jumps over the lazy dog while the notes are indexed."
+
+
+def scanned_page_png(number):
+    image = Image.new('RGB', (1700, 2200), 'white')
+    draw = ImageDraw.Draw(image)
+    for row in range(40):
+        draw.text((100, 100 + row * 50), f"{number}: {LINE}", fill='black')
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def build_pdf(path, pages, scanned_ratio):
+    doc = fitz.open()
+    scanned_every = round(1 / scanned_ratio) if scanned_ratio else 0
+    for number in range(pages):
+        page = doc.new_page()
+        if scanned_every and number % scanned_every == 0:
+            page.insert_image(page.rect, stream=scanned_page_png(number))
+        else:
+            page.insert_textbox(page.rect + (72, 72, -72, -72), (LINE + " ") * 30)
+    doc.save(path)
+
+
+def timed(path, processes):
+    start = time.perf_counter()
+    with open(path, 'rb') as f:
+        texts = pdf_page_texts(f)
+    ocr_pdf_pages(path, texts, processes=processes)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pages', type=int, default=40)
+    parser.add_argument('--scanned-ratio', type=float, default=0.5)
+    args = parser.parse_args()
+
+    settings.CACHES[settings.OCR_CACHE_ALIAS] = {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, 'mixed.pdf')
+        build_pdf(path, args.pages, args.scanned_ratio)
+        print(f"{'processes':>9} {'seconds':>9} {'pages/sec':>10}")
+        for processes in (1, os.cpu_count() or 1):
+            elapsed = timed(path, processes)
+            print(f"{processes:>9} {elapsed:9.2f} {args.pages / elapsed:10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""Prompt size with whole-note vs. passage retrieval.
+
+Run from the project root (uses a throwaway test database):
+
+    python benchmarks/bench_passage_context.py
+
+Synthetic notes of growing length are saved through ``NoteService``. For
+each size the old context (the five best whole notes) and the new one
+(the best passages packed into ``QA_CONTEXT_TOKENS``) are built for the same
+queries, and their estimated token counts and build times are reported. The
+context length is what drives LLM and QA latency.
+"""
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'KMSimba.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.conf import settings  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test.utils import setup_test_environment  # noqa: E402
+
+from notes.models import Note  # noqa: E402
+from notes.passages import build_context, estimate_tokens, fetch_passages  # noqa: E402
+from notes.search_index import IncrementalTfidfIndex  # noqa: E402
+from notes.services import NoteService  # noqa: E402
+
+NOTE_WORDS = (500, 5_000, 50_000)
+NOTES_PER_SIZE = 20
+QUERIES = 20
+VOCABULARY = [f"term{i}" for i in range(5_000)]
+
+
+def make_note(words, rng):
+    return " ".join(rng.choices(VOCABULARY, k=words))
+
+
+def main():
+    rng = random.Random(7)
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        print(f"{'note words':>10} {'context':>9} {'tokens p50':>11} {'tokens max':>11} {'build ms':>9}")
+        for words in NOTE_WORDS:
+            Note.objects.all().delete()
+            NoteService.ingest_many([make_note(words, rng) for _ in range(NOTES_PER_SIZE)])
+            queries = [" ".join(rng.sample(VOCABULARY, 3)) for _ in range(QUERIES)]
+
+            note_index = IncrementalTfidfIndex()
+            notes = list(Note.objects.values_list('id', 'content'))
+            note_index.add_many([note_id for note_id, _ in notes], [content for _, content in notes])
+            passage_index = IncrementalTfidfIndex()
+            for note in Note.objects.prefetch_related('passages'):
+                passages = list(note.passages.all())
+                passage_index.add_many([p.id for p in passages], [note.content[p.start:p.end] for p in passages])
+
+            for label, build in (
+                ('notes', lambda q: "\n\n".join(
+                    Note.objects.get(id=note_id).content for note_id, _ in note_index.search(q, top_k=5))),
+                ('passages', lambda q: build_context(
+                    fetch_passages(passage_index.search(q, top_k=settings.QA_PASSAGES)))),
+            ):
+                tokens, timings = [], []
+                for query in queries:
+                    start = time.perf_counter()
+                    context = build(query)
+                    timings.append(time.perf_counter() - start)
+                    tokens.append(estimate_tokens(context))
+                print(f"{words:>10} {label:>9} {statistics.median(tokens):>11.0f} {max(tokens):>11} "
+                      f"{statistics.median(timings) * 1000:>9.2f}")
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
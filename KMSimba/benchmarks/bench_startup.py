@@ -0,0 +1,52 @@
+"""Import time and memory of a fresh Django process.
+
+Run from the project root:
+
+    python benchmarks/bench_startup.py
+
+Each scenario runs in a new interpreter and reports wall time and peak RSS
+for setting Django up and importing the notes views and URLs, then for
+loading each model from the registry on top.
+"""
+import os
+import subprocess
+import sys
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCRIPT = """
+import os, resource, sys, time
+start = time.perf_counter()
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'KMSimba.settings')
+import django
+django.setup()
+import notes.urls
+for name in sys.argv[1:]:
+    from notes.registry import registry
+    registry.get(name)
+elapsed = time.perf_counter() - start
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(elapsed, rss / 1024 if sys.platform != 'darwin' else rss / 1024 / 1024)
+"""
+
+SCENARIOS = [
+    ('import views + urls', []),
+    ('+ spaCy', ['spacy']),
+    ('+ YOLOS', ['yolos']),
+    ('+ DistilBERT QA', ['qa']),
+]
+
+
+def main():
+    print(f"{'scenario':<22} {'seconds':>8} {'peak RSS MB':>12}")
+    for label, models in SCENARIOS:
+        output = subprocess.run(
+            [sys.executable, '-c', SCRIPT, *models],
+            cwd=PROJECT_ROOT, capture_output=True, text=True, check=True,
+        ).stdout.split()
+        elapsed, rss = float(output[-2]), float(output[-1])
+        print(f"{label:<22} {elapsed:8.2f} {rss:12.1f}")
+
+
+if __name__ == '__main__':
+    main()
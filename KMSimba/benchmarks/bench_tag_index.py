@@ -0,0 +1,102 @@
+"""Query latency of the in-memory tag index at 1M file tags.
+
+Run from the project root (no database access is needed):
+
+    python benchmarks/bench_tag_index.py [--files N] [--tags-per-file N]
+
+A synthetic corpus with Zipf-distributed tag popularity is loaded straight
+into a ``TagPostingsIndex`` and 1-, 2- and 3-tag queries drawn from the same
+distribution are timed, along with the cost of the first query after a
+write to each tag and of writing and loading a snapshot.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'KMSimba.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from notes.tag_index import TagPostingsIndex, load_snapshot, save_snapshot  # noqa: E402
+
+VOCABULARY = 50_000
+QUERIES = 2000
+
+
+def make_index(files, tags_per_file, rng):
+    popularity = 1 / np.arange(1, VOCABULARY + 1)
+    popularity /= popularity.sum()
+    tag_col = rng.choice(VOCABULARY, size=files * tags_per_file, p=popularity)
+    file_col = np.repeat(np.arange(1, files + 1, dtype=np.int32), tags_per_file)
+    pairs = np.unique(np.stack([tag_col, file_col], axis=1), axis=0)
+    posting_tag_ids, starts = np.unique(pairs[:, 0], return_index=True)
+    return TagPostingsIndex.from_arrays({
+        'tag_ids': np.arange(VOCABULARY, dtype=np.int64),
+        'tag_names': np.frombuffer(json.dumps([f"tag{i}" for i in range(VOCABULARY)]).encode(), dtype=np.uint8),
+        'posting_tag_ids': posting_tag_ids,
+        'indptr': np.append(starts, len(pairs)),
+        'file_ids': pairs[:, 1].astype(np.int32),
+        'weights': rng.uniform(0.3, 1.8, size=len(pairs)).astype(np.float32),
+        'file_name_ids': np.arange(1, files + 1, dtype=np.int64),
+        'file_names': np.frombuffer(json.dumps([f"file{i}.pdf" for i in range(1, files + 1)]).encode(), dtype=np.uint8),
+        'change_ids': np.zeros(0, dtype=np.int64),
+        'caught_up_at': time.time(),
+    }), popularity, len(pairs)
+
+
+def percentiles(timings):
+    timings = np.array(timings) * 1000
+    return np.percentile(timings, 50), np.percentile(timings, 99)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=25_000)
+    parser.add_argument('--tags-per-file', type=int, default=50)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    start = time.perf_counter()
+    index, popularity, rows = make_index(args.files, args.tags_per_file, rng)
+    print(f"{args.files} files, {rows} file tags, built in {time.perf_counter() - start:.2f}s")
+
+    print(f"{'query tags':>10} {'p50 ms':>8} {'p99 ms':>8}")
+    for size in (1, 2, 3):
+        queries = [[f"tag{t}" for t in rng.choice(VOCABULARY, size=size, replace=False, p=popularity)] for _ in range(QUERIES)]
+        timings = []
+        for query in queries:
+            started = time.perf_counter()
+            index.search(query, limit=50)
+            timings.append(time.perf_counter() - started)
+        p50, p99 = percentiles(timings)
+        print(f"{size:>10} {p50:8.3f} {p99:8.3f}")
+
+    timings = []
+    for tag in rng.choice(VOCABULARY, size=200, p=popularity):
+        index.add_posting(int(tag), args.files + 1, 1.0)
+        started = time.perf_counter()
+        index.search([f"tag{tag}"], limit=50)
+        timings.append(time.perf_counter() - started)
+    p50, p99 = percentiles(timings)
+    print(f"first query after a write: p50 {p50:.3f} ms, p99 {p99:.3f} ms")
+
+    with tempfile.TemporaryDirectory() as root:
+        path = os.path.join(root, 'postings.npz')
+        started = time.perf_counter()
+        save_snapshot(index, path)
+        saved = time.perf_counter() - started
+        started = time.perf_counter()
+        load_snapshot(path)
+        print(f"snapshot: write {saved:.2f}s, load {time.perf_counter() - started:.2f}s, {os.path.getsize(path) / 2 ** 20:.1f} MiB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""Top-10 quality and latency of tag search: match count vs. BM25.
+
+Run from the project root (uses a throwaway test database):
+
+    python benchmarks/bench_tag_ranking.py [--files N]
+
+A synthetic corpus is generated where every file belongs to one topic and
+repeats a few of that topic's terms, on top of common background terms. A
+share of the files are long "dumps" that mention a little of every topic,
+which is what used to crowd out the relevant files. Each query is three terms
+of one topic; a hit is relevant when it belongs to that topic. Precision@10
+and query latency are reported for the old match-count ranking and for
+``perform_search``.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'KMSimba.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.core.cache import cache  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.db.models import Count  # noqa: E402
+from django.test.utils import setup_test_environment  # noqa: E402
+
+from notes.models import File, FileTag, Tag  # noqa: E402
+from notes.utils import bm25_term_weight, perform_search  # noqa: E402
+
+TOPICS = 50
+TOPIC_TERMS = 20
+BACKGROUND_TERMS = 500
+DUMP_SHARE = 0.1
+QUERIES = 200
+
+
+def make_corpus(files, rng):
+    topics = [[f"topic{t}_{i}" for i in range(TOPIC_TERMS)] for t in range(TOPICS)]
+    background = [f"common{i}" for i in range(BACKGROUND_TERMS)]
+    documents = []
+    for _ in range(files):
+        counts = {}
+        if rng.random() < DUMP_SHARE:
+            topic = None
+            for terms in topics:
+                for term in rng.sample(terms, 6):
+                    counts[term] = 1
+        else:
+            topic = rng.randrange(TOPICS)
+            for term in rng.sample(topics[topic], 8):
+                counts[term] = rng.randint(1, 6)
+        for term in rng.sample(background, rng.randint(20, 60)):
+            counts[term] = rng.randint(1, 3)
+        documents.append((topic, counts))
+    return topics, documents
+
+
+def load_corpus(documents):
+    names = {name for _, counts in documents for name in counts}
+    Tag.objects.bulk_create([Tag(name=name) for name in names], batch_size=500)
+    tag_ids = dict(Tag.objects.values_list('name', 'id'))
+    files = File.objects.bulk_create(
+        [
+            File(file_name=f"file{i}.txt", file_content=f"file{i}.txt", content_hash=str(i), doc_length=sum(counts.values()))
+            for i, (_, counts) in enumerate(documents)
+        ],
+        batch_size=500,
+    )
+    avg_doc_length = sum(file.doc_length for file in files) / len(files)
+    links = []
+    for file, (_, counts) in zip(files, documents):
+        for name, term_frequency in counts.items():
+            links.append(FileTag(
+                file_id=file.id, tag_id=tag_ids[name], term_frequency=term_frequency,
+                weight=bm25_term_weight(term_frequency, file.doc_length, avg_doc_length),
+            ))
+    FileTag.objects.bulk_create(links, batch_size=2000)
+    return {file.id: topic for file, (topic, _) in zip(files, documents)}
+
+
+def match_count_search(query, page=1, per_page=50):
+    start = (max(page, 1) - 1) * per_page
+    return list(
+        File.objects.filter(filetag__tag__name__in=set(query.split()))
+        .annotate(hits=Count('filetag__tag', distinct=True))
+        .order_by('-hits', 'id')
+        .only('id', 'file_name')[start:start + per_page]
+    )
+
+
+def evaluate(search, queries, file_topics):
+    precisions = []
+    timings = []
+    for topic, query in queries:
+        start = time.perf_counter()
+        hits = search(query, per_page=10)
+        timings.append(time.perf_counter() - start)
+        precisions.append(sum(file_topics[hit.id] == topic for hit in hits) / 10)
+    return statistics.mean(precisions), timings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=5000)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    topics, documents = make_corpus(args.files, rng)
+    queries = []
+    for _ in range(QUERIES):
+        topic = rng.randrange(TOPICS)
+        queries.append((topic, " ".join(rng.sample(topics[topic], 3))))
+
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        file_topics = load_corpus(documents)
+        cache.clear()
+        print(f"{args.files} files, {FileTag.objects.count()} file tags, {QUERIES} queries")
+        print(f"{'ranking':>12} {'P@10':>6} {'p50 ms':>8} {'p95 ms':>8}")
+        with mock.patch('notes.utils.query_tags', side_effect=lambda query: set(query.split())):
+            for label, search in (('match count', match_count_search), ('bm25', perform_search)):
+                precision, timings = evaluate(search, queries, file_topics)
+                timings.sort()
+                p50 = timings[len(timings) // 2] * 1000
+                p95 = timings[int(len(timings) * 0.95)] * 1000
+                print(f"{label:>12} {precision:6.3f} {p50:8.2f} {p95:8.2f}")
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
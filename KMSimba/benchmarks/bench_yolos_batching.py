@@ -0,0 +1,59 @@
+"""CPU throughput of YOLOS object detection, per page vs. batched.
+
+Run from the project root (downloads hustvl/yolos-tiny on first use):
+
+    python benchmarks/bench_yolos_batching.py [--threads N]
+
+Synthetic page-sized images are run through ``detect_objects`` with the old
+one-image-per-call pattern and in micro-batches of 8 and 32, reporting
+pages/sec for 1-, 8- and 32-page documents.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'KMSimba.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.conf import settings  # noqa: E402
+
+from notes.utils import detect_objects  # noqa: E402
+
+PAGE_COUNTS = (1, 8, 32)
+BATCH_SIZES = (1, 8, 32)
+
+
+def make_pages(count, rng):
+    # 612x792 is a US letter page rendered at 72 dpi, fitz's default.
+    return [rng.integers(0, 255, size=(792, 612, 3), dtype=np.uint8) for _ in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+    if args.threads:
+        settings.TORCH_NUM_THREADS = args.threads
+
+    rng = np.random.default_rng(0)
+    detect_objects(make_pages(1, rng))  # load the model and warm up
+
+    print(f"{'pages':>6} {'batch':>6} {'seconds':>9} {'pages/sec':>10}")
+    for pages in PAGE_COUNTS:
+        images = make_pages(pages, rng)
+        for batch_size in BATCH_SIZES:
+            start = time.perf_counter()
+            detect_objects(images, batch_size=batch_size)
+            elapsed = time.perf_counter() - start
+            print(f"{pages:>6} {batch_size:>6} {elapsed:9.2f} {pages / elapsed:10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""Local stand-in for the Gemini REST API, for offline runs and load tests.
+
+    python benchmarks/fake_llm_server.py [--port 8100] [--first-token-ms 400] [--token-ms 20] [--tokens 60]
+
+then start KMSimba with ``GEMINI_API_BASE=http://127.0.0.1:8100``.
+
+``generateContent`` and ``streamGenerateContent?alt=sse`` are served with
+the response shapes ``notes.llm`` parses. The reply repeats words from the
+prompt's context, so DistilBERT can extract a span from it. Latency follows
+a real model: ``--first-token-ms`` before the first chunk, then
+``--token-ms`` per word. The server is a bare ASGI app on uvicorn, so it
+can hold thousands of concurrent streams without becoming the bottleneck.
+"""
+import argparse
+import asyncio
+import json
+import os
+
+CONFIG = {
+    'first_token_ms': float(os.environ.get('FAKE_LLM_FIRST_TOKEN_MS', 400)),
+    'token_ms': float(os.environ.get('FAKE_LLM_TOKEN_MS', 20)),
+    'tokens': int(os.environ.get('FAKE_LLM_TOKENS', 60)),
+}
+
+
+def reply_words(prompt):
+    lines = prompt.split('\n')
+    context = ' '.join(line for line in lines[1:] if not line.startswith('Based on the above information'))
+    words = context.split() or ['No', 'notes', 'matched.']
+    return (words * (CONFIG['tokens'] // len(words) + 1))[:CONFIG['tokens']]
+
+
+def chunk(text):
+    return {'candidates': [{'content': {'role': 'model', 'parts': [{'text': text}]}, 'index': 0}]}
+
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    path = scope['path']
+    if scope['method'] != 'POST' or ':' not in path:
+        await send({'type': 'http.response.start', 'status': 404, 'headers': []})
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+    request = json.loads(await read_body(receive))
+    words = reply_words(request['contents'][-1]['parts'][0]['text'])
+
+    await asyncio.sleep(CONFIG['first_token_ms'] / 1000)
+    if path.endswith(':streamGenerateContent'):
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [(b'content-type', b'text/event-stream')]})
+        for number, word in enumerate(words):
+            if number:
+                await asyncio.sleep(CONFIG['token_ms'] / 1000)
+            event = f"data: {json.dumps(chunk(word + ' '))}\r\n\r\n".encode()
+            await send({'type': 'http.response.body', 'body': event, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    else:
+        await asyncio.sleep(CONFIG['token_ms'] * (len(words) - 1) / 1000)
+        body = json.dumps(chunk(' '.join(words))).encode()
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [(b'content-type', b'application/json')]})
+        await send({'type': 'http.response.body', 'body': body})
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8100)
+    parser.add_argument('--first-token-ms', type=float, default=CONFIG['first_token_ms'])
+    parser.add_argument('--token-ms', type=float, default=CONFIG['token_ms'])
+    parser.add_argument('--tokens', type=int, default=CONFIG['tokens'])
+    args = parser.parse_args()
+    CONFIG.update(first_token_ms=args.first_token_ms, token_ms=args.token_ms, tokens=args.tokens)
+    uvicorn.run(app, host='127.0.0.1', port=args.port, log_level='warning', backlog=4096)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""Gunicorn settings for KMSimba.
+
+Run two pools of workers, one per interface, behind nginx:
+
+    gunicorn KMSimba.wsgi -c gunicorn.conf.py
+    KMSIMBA_BIND=127.0.0.1:8001 gunicorn KMSimba.asgi -k uvicorn.workers.UvicornWorker -c gunicorn.conf.py
+
+and send only the chat search to the ASGI pool:
+
+    location /notes/search/ { proxy_pass http://127.0.0.1:8001; proxy_buffering off; }
+    location / { proxy_pass http://127.0.0.1:8000; }
+
+The chat search views are async (see ``notes.chat``), so under ASGI one
+worker serves many concurrent chats while they wait on the LLM. Every other
+view is sync, and under ASGI Django runs all sync views of a worker on one
+shared thread: a slow download, chunk write or upload there would hold up
+every other request of that worker. They are therefore served by WSGI
+workers, each request on its own worker (or thread, with
+``KMSIMBA_THREADS``), where downloads also go out with ``sendfile``. A
+single ``gunicorn KMSimba.wsgi`` pool serves everything too, with one chat
+per worker thread.
+
+With ``preload_app`` the Django app is imported once in the master, which
+then loads the models listed in ``MODEL_PRELOAD`` before forking, so every
+worker shares the same weights copy-on-write instead of loading its own.
+Set ``KMSIMBA_PRELOAD_APP=0`` to load them in each worker after the fork.
+"""
+import gc
+import multiprocessing
+import os
+
+bind = os.environ.get('KMSIMBA_BIND', '127.0.0.1:8000')
+workers = int(os.environ.get('KMSIMBA_WORKERS', multiprocessing.cpu_count()))
+threads = int(os.environ.get('KMSIMBA_THREADS', 1))  # Per WSGI worker; uvicorn workers ignore it
+preload_app = os.environ.get('KMSIMBA_PRELOAD_APP', '1') == '1'
+timeout = 120
+
+
+def _preload_models():
+    from django.conf import settings
+    from notes.registry import registry
+    registry.preload(settings.MODEL_PRELOAD)
+
+
+def when_ready(server):
+    if preload_app:
+        _preload_models()
+        # Keep the preloaded objects out of the collector so it does not
+        # touch (and copy) their pages in every worker.
+        gc.freeze()
+
+
+def post_fork(server, worker):
+    if not preload_app:
+        _preload_models()
@@ -0,0 +1,84 @@
+"""Cache of chat answers.
+
+An answer depends on the question and on the passages it was generated
+from, so it is keyed on the normalized question, the passage index
+generation and, for every retrieved passage, its id and text. Editing a
+note changes the text sliced out of it, and deleting one removes its
+passages, so answers built from a changed note are never served again;
+they age out of the cache by TTL (``ANSWER_CACHE_TIMEOUT``) or LRU eviction.
+
+Entries live in the ``ANSWER_CACHE_ALIAS`` cache, file-based by default so
+every worker shares them. Hits, misses and the time hits saved are counted
+in per-process counters of ``notes.metrics`` (also served at ``/metrics``);
+``cache_stats`` reads them summed over every process.
+"""
+import hashlib
+import json
+import re
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+from . import metrics, note_search
+
+LOOKUPS = metrics.Counter('kmsimba_answer_cache_lookups', "Chat answers served from the cache or computed.", ['result'])
+SAVED_SECONDS = metrics.Counter('kmsimba_answer_cache_saved_seconds', "Time the answers served from the cache took to produce.", [])
+
+
+def _cache():
+    return caches[settings.ANSWER_CACHE_ALIAS]
+
+
+def normalize_query(query):
+    return re.sub(r'\s+', ' ', query).strip().rstrip('?!. ').lower()
+
+
+def answer_key(query, passages, generation):
+    digest = hashlib.blake2b(json.dumps([normalize_query(query), generation]).encode('utf-8'), digest_size=20)
+    for passage in passages:
+        digest.update(f"\0{passage.id}\0".encode('utf-8'))
+        digest.update(passage.text.encode('utf-8'))
+    return f"answer:{digest.hexdigest()}"
+
+
+async def lookup(query, passages):
+    """Return ``(key, answer)``; ``answer`` is ``None`` on a miss."""
+    cache = _cache()
+    key = answer_key(query, passages, note_search.passage_index.generation)
+    entry = await cache.aget(key)
+    if entry is None:
+        return key, None
+    LOOKUPS.inc(('hit',))
+    SAVED_SECONDS.inc((), entry['ms'] / 1000)
+    return key, entry['answer']
+
+
+async def store(key, answer, elapsed_ms):
+    """Cache ``answer``, which took ``elapsed_ms`` to produce."""
+    cache = _cache()
+    await cache.aset(key, {'answer': answer, 'ms': round(elapsed_ms)}, settings.ANSWER_CACHE_TIMEOUT)
+    LOOKUPS.inc(('miss',))
+
+
+async def cached_answer(query, passages, compute):
+    """Return the answer to ``query`` over ``passages``, awaiting ``compute()`` on a miss."""
+    key, answer = await lookup(query, passages)
+    if answer is not None:
+        return answer
+    start = time.perf_counter()
+    answer = await compute()
+    await store(key, answer, (time.perf_counter() - start) * 1000)
+    return answer
+
+
+def cache_stats():
+    data = metrics.collect()
+    lookups = {tuple(labels): values[0] for labels, values in data[LOOKUPS.name]}
+    hits, misses = lookups.get(('hit',), 0), lookups.get(('miss',), 0)
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': round(hits / (hits + misses), 4) if hits + misses else 0.0,
+        'saved_seconds': round(sum(values[0] for _, values in data[SAVED_SECONDS.name]), 3),
+    }
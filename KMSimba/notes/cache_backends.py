@@ -0,0 +1,42 @@
+"""Cache backends used by the notes app."""
+import os
+
+from django.core.cache.backends.filebased import FileBasedCache
+
+
+class LRUFileBasedCache(FileBasedCache):
+    """File-based cache that culls the least recently used entries.
+
+    Django's file cache deletes a random sample once ``MAX_ENTRIES`` is
+    reached. Here every hit touches the entry's mtime (expiry is stored inside
+    the file, so mtime is free to track use), and culling removes the
+    ``1 / CULL_FREQUENCY`` oldest entries instead.
+    """
+
+    def get(self, key, default=None, version=None):
+        sentinel = object()
+        value = super().get(key, sentinel, version)
+        if value is sentinel:
+            return default
+        try:
+            os.utime(self._key_to_file(key, version))
+        except FileNotFoundError:
+            pass
+        return value
+
+    def _cull(self):
+        filelist = self._list_cache_files()
+        num_entries = len(filelist)
+        if num_entries < self._max_entries:
+            return
+        if self._cull_frequency == 0:
+            return self.clear()
+        accessed = []
+        for fname in filelist:
+            try:
+                accessed.append((os.path.getmtime(fname), fname))
+            except FileNotFoundError:
+                pass
+        accessed.sort()
+        for _, fname in accessed[:int(num_entries / self._cull_frequency)]:
+            self._delete(fname)
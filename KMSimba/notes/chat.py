@@ -0,0 +1,89 @@
+"""Question answering over notes for the async chat views.
+
+A question is answered in three steps, none of which blocks the event loop:
+
+1. passages are retrieved on a small thread pool (``RETRIEVAL_WORKERS``),
+   since the index and the ORM are synchronous;
+2. the LLM reply is awaited or streamed (see ``notes.llm``) within the
+   request's budget, which starts when the question arrives;
+3. DistilBERT extracts the answer span on a bounded pool (``QA_WORKERS``),
+   so at most that many inferences compete for the CPU however many chats
+   are waiting.
+
+Answers go through ``answer_cache``.
+"""
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+
+from . import answer_cache, llm
+from .metrics import timed
+from .note_search import semantic_search, sync_passage_index
+from .passages import build_context, fetch_passages
+from .registry import registry
+
+_executors = {}
+
+
+def _executor(name, workers):
+    if name not in _executors:
+        _executors[name] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+    return _executors[name]
+
+
+@timed('retrieve')
+def _retrieve(query):
+    # Pool threads outlive requests, so their connections are recycled here.
+    close_old_connections()
+    sync_passage_index()
+    return fetch_passages(semantic_search(query, top_k=settings.QA_PASSAGES))
+
+
+async def retrieve_passages(query):
+    executor = _executor('retrieval', settings.RETRIEVAL_WORKERS)
+    return await sync_to_async(_retrieve, thread_sensitive=False, executor=executor)(query)
+
+
+def build_prompt(query, passages):
+    now = datetime.now().strftime("%B %d, %Y %H:%M:%S")
+    return f"Today's date and time is: {now}\n{build_context(passages)}\n\nBased on the above information, {query}"
+
+
+@timed('qa')
+def _extract(query, reply):
+    return registry.get('qa')(question=query, context=reply)['answer']
+
+
+async def extract_answer(query, reply):
+    if not settings.QA_EXTRACT_ANSWER:
+        return reply
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor('qa', settings.QA_WORKERS), _extract, query, reply)
+
+
+async def answer(query, passages, deadline=None):
+    async def compute():
+        return await extract_answer(query, await llm.generate(build_prompt(query, passages), deadline))
+
+    return await answer_cache.cached_answer(query, passages, compute)
+
+
+async def stream_answer(query, passages, deadline=None):
+    """Yield ``(event, text)``: ``('token', chunk)`` for each piece of the LLM reply, then ``('answer', answer)``."""
+    key, cached = await answer_cache.lookup(query, passages)
+    if cached is not None:
+        yield 'answer', cached
+        return
+    start = time.perf_counter()
+    chunks = []
+    async for chunk in llm.stream_generate(build_prompt(query, passages), deadline):
+        chunks.append(chunk)
+        yield 'token', chunk
+    result = await extract_answer(query, ''.join(chunks))
+    await answer_cache.store(key, result, (time.perf_counter() - start) * 1000)
+    yield 'answer', result
@@ -0,0 +1,271 @@
+"""Dense passage retrieval: sentence embeddings in an IVF index.
+
+Passages are embedded on CPU in batches by the ``embedder`` model (mean-pooled,
+L2-normalised, so the inner product is the cosine similarity). Published
+vectors are stored as ``float16`` or ``int8`` (``DENSE_EMBEDDING_DTYPE``) and
+memory-mapped by every worker like the TF-IDF generations (see
+``index_store``).
+
+Once there are ``IVF_MIN_ROWS`` passages the vectors are clustered with
+spherical k-means into about ``sqrt(n)`` inverted lists, stored contiguously,
+and a query only scans the ``DENSE_IVF_PROBES`` lists whose centroids are
+closest to it. Passages added since the last publish are kept in memory as
+``float32`` and always scanned exhaustively.
+
+Passages are embedded when they are saved and their vectors stored in
+``Passage.embedding`` (``float16``), so catching the index up on the search
+path only reads vectors; ``build_note_index`` embeds any passage without one.
+"""
+import threading
+from array import array
+
+import numpy as np
+from django.conf import settings
+
+from .metrics import timed
+from .registry import registry
+
+IVF_MIN_ROWS = 20_000
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLE_PER_LIST = 64
+SCAN_CHUNK_ROWS = 65_536
+INT8_SCALE = 127.0
+
+
+@timed('embed')
+def embed_texts(texts, batch_size=None):
+    """Return L2-normalised ``float32`` embeddings of ``texts``, one row per text."""
+    import torch
+
+    model, tokenizer = registry.get('embedder')
+    batch_size = batch_size or settings.DENSE_BATCH_SIZE
+    embeddings = np.zeros((len(texts), model.config.hidden_size), dtype=np.float32)
+    # Texts of similar length share a batch so little of each forward pass is padding.
+    order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+    with torch.inference_mode():
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            encoded = tokenizer(
+                [texts[i] for i in batch],
+                padding=True,
+                truncation=True,
+                max_length=settings.DENSE_MAX_TOKENS,
+                return_tensors='pt',
+            )
+            hidden = model(**encoded).last_hidden_state
+            mask = encoded['attention_mask'].unsqueeze(-1).to(hidden.dtype)
+            pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+            embeddings[batch] = torch.nn.functional.normalize(pooled, dim=1).numpy()
+    return embeddings
+
+
+def encode_embedding(vector):
+    """The bytes stored in ``Passage.embedding``."""
+    return np.asarray(vector, dtype=np.float16).tobytes()
+
+
+def decode_embeddings(embeddings):
+    """Stack stored ``Passage.embedding`` values into a ``float32`` matrix."""
+    return np.frombuffer(b''.join(embeddings), dtype=np.float16).reshape(len(embeddings), -1).astype(np.float32)
+
+
+def _quantize(vectors, dtype):
+    if dtype == np.int8:
+        return np.clip(np.rint(vectors * INT8_SCALE), -INT8_SCALE, INT8_SCALE).astype(np.int8)
+    return vectors.astype(dtype)
+
+
+def _dequantize(vectors):
+    if vectors.dtype == np.int8:
+        return vectors.astype(np.float32) / INT8_SCALE
+    return vectors.astype(np.float32)
+
+
+def assign_lists(vectors, centroids):
+    """Return the index of the closest centroid of every row of ``vectors``."""
+    labels = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), SCAN_CHUNK_ROWS):
+        chunk = _dequantize(vectors[start:start + SCAN_CHUNK_ROWS])
+        labels[start:start + len(chunk)] = np.argmax(chunk @ centroids.T, axis=1)
+    return labels
+
+
+def _scan(vectors, centroids, offsets, query_vec, n_probe):
+    """Return ``(rows, scores)`` for the rows of ``vectors`` in the lists closest to ``query_vec``."""
+    if vectors is None or not len(vectors):
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+    if centroids is None:
+        ranges = [(0, len(vectors))]
+    else:
+        n_probe = min(n_probe, len(centroids))
+        probes = np.argpartition(-(centroids @ query_vec), n_probe - 1)[:n_probe]
+        ranges = [(offsets[probe], offsets[probe + 1]) for probe in np.sort(probes)]
+    rows, scores = [], []
+    for start, end in ranges:
+        for chunk_start in range(start, end, SCAN_CHUNK_ROWS):
+            chunk_end = min(chunk_start + SCAN_CHUNK_ROWS, end)
+            rows.append(np.arange(chunk_start, chunk_end))
+            scores.append(_dequantize(vectors[chunk_start:chunk_end]) @ query_vec)
+    if not rows:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+    return np.concatenate(rows), np.concatenate(scores)
+
+
+def train_centroids(vectors, n_lists, rng=None):
+    """Cluster a sample of ``vectors`` into ``n_lists`` unit-length centroids (spherical k-means)."""
+    rng = rng or np.random.default_rng(0)
+    sample_size = min(len(vectors), n_lists * KMEANS_SAMPLE_PER_LIST)
+    sample = _dequantize(vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))])
+    centroids = sample[rng.choice(sample_size, n_lists, replace=False)]
+    for _ in range(KMEANS_ITERATIONS):
+        labels = assign_lists(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, sample)
+        empty = np.flatnonzero(np.bincount(labels, minlength=n_lists) == 0)
+        sums[empty] = sample[rng.choice(sample_size, len(empty), replace=False)]
+        centroids = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+    return centroids.astype(np.float32)
+
+
+def target_lists(rows):
+    return int(np.sqrt(rows)) if rows >= IVF_MIN_ROWS else 0
+
+
+class DenseIndex:
+    """Append-only embedding index with the interface of ``IncrementalTfidfIndex``."""
+
+    ARRAYS = ('vectors', 'doc_ids', 'centroids', 'list_offsets')
+
+    def __init__(self, dtype=None, n_probe=None, encode=None):
+        self.dtype = np.dtype(dtype or settings.DENSE_EMBEDDING_DTYPE)
+        self.n_probe = n_probe or settings.DENSE_IVF_PROBES
+        self.encode = encode or embed_texts
+        self.generation = 0
+        self._lock = threading.RLock()
+        self._vectors = None
+        self._doc_ids = np.zeros(0, dtype=np.int64)
+        self._centroids = None
+        self._list_offsets = np.zeros(1, dtype=np.int64)
+        self._pending = []
+        self._delta = None
+        self._delta_ids = array('q')
+        self._max_doc_id = 0
+
+    @classmethod
+    def from_arrays(cls, arrays, meta, generation=0, **kwargs):
+        """Build an index backed by the (memory-mapped) ``arrays`` of a generation."""
+        if meta['model'] != settings.DENSE_EMBEDDING_MODEL:
+            raise ValueError(f"generation was embedded with {meta['model']}, not {settings.DENSE_EMBEDDING_MODEL}")
+        index = cls(dtype=meta['dtype'], **kwargs)
+        index.generation = generation
+        index._vectors = arrays['vectors']
+        index._doc_ids = arrays['doc_ids']
+        index._centroids = arrays['centroids'] if len(arrays['centroids']) else None
+        index._list_offsets = arrays['list_offsets']
+        index._max_doc_id = int(arrays['doc_ids'].max()) if len(arrays['doc_ids']) else 0
+        return index
+
+    def __len__(self):
+        return len(self._doc_ids) + len(self._delta_ids)
+
+    @property
+    def max_doc_id(self):
+        return self._max_doc_id
+
+    @property
+    def delta_size(self):
+        return len(self._delta_ids)
+
+    def doc_ids_above(self, low):
+        """Return the set of indexed ids greater than ``low``."""
+        with self._lock:
+            ids = np.concatenate([self._doc_ids, np.frombuffer(self._delta_ids, dtype=np.int64)])
+            return set(ids[ids > low].tolist())
+
+    def meta(self):
+        return {'model': settings.DENSE_EMBEDDING_MODEL, 'dtype': self.dtype.name}
+
+    def add_many(self, doc_ids, texts):
+        doc_ids = list(doc_ids)
+        if not doc_ids:
+            return
+        self.add_vectors(doc_ids, self.encode(list(texts)))
+
+    def add_vectors(self, doc_ids, vectors):
+        with self._lock:
+            self._pending.append(np.asarray(vectors, dtype=np.float32))
+            self._delta_ids.extend(doc_ids)
+            self._max_doc_id = max(self._max_doc_id, max(doc_ids))
+
+    def skip_to(self, doc_id):
+        """Move ``max_doc_id`` to ``doc_id`` without indexing the rows up to it."""
+        with self._lock:
+            self._max_doc_id = max(self._max_doc_id, doc_id)
+
+    def _delta_matrix(self):
+        with self._lock:
+            if self._pending:
+                self._delta = np.vstack(([self._delta] if self._delta is not None else []) + self._pending)
+                self._pending = []
+            return self._delta
+
+    def to_arrays(self):
+        """Merge base and delta into lists, (re)training the centroids once the lists have grown too long."""
+        with self._lock:
+            delta = self._delta_matrix()
+            parts = [np.asarray(self._vectors)] if self._vectors is not None else []
+            if delta is not None:
+                parts.append(_quantize(delta, self.dtype))
+            vectors = np.concatenate(parts) if parts else np.zeros((0, 0), dtype=self.dtype)
+            doc_ids = np.concatenate([self._doc_ids, np.frombuffer(self._delta_ids, dtype=np.int64)])
+            centroids = self._centroids
+            n_lists = target_lists(len(doc_ids))
+
+        if not n_lists:
+            centroids = np.zeros((0, vectors.shape[1]), dtype=np.float32)
+            return {'vectors': vectors, 'doc_ids': doc_ids, 'centroids': centroids,
+                    'list_offsets': np.array([0, len(doc_ids)], dtype=np.int64)}
+        if centroids is None or len(centroids) < n_lists // 2:
+            centroids = train_centroids(vectors, n_lists)
+            labels = assign_lists(vectors, centroids)
+        else:
+            centroids = np.asarray(centroids)
+            base_labels = np.repeat(np.arange(len(centroids)), np.diff(self._list_offsets))
+            labels = np.concatenate([base_labels, assign_lists(vectors[len(base_labels):], centroids)])
+        order = np.argsort(labels, kind='stable')
+        return {
+            'vectors': vectors[order],
+            'doc_ids': doc_ids[order],
+            'centroids': centroids,
+            'list_offsets': np.searchsorted(labels[order], np.arange(len(centroids) + 1)).astype(np.int64),
+        }
+
+    def search(self, query, top_k=5, offset=0, min_score=0.0):
+        """Return ``[(doc_id, score), ...]`` for the passages closest to ``query``."""
+        return self.search_vector(self.encode([query])[0], top_k, offset=offset, min_score=min_score)
+
+    def search_vector(self, query_vec, top_k=5, offset=0, min_score=0.0):
+        query_vec = np.asarray(query_vec, dtype=np.float32)
+        with self._lock:
+            if not len(self):
+                return []
+            delta = self._delta_matrix()
+            vectors, centroids, offsets = self._vectors, self._centroids, self._list_offsets
+            doc_ids, delta_ids = self._doc_ids, self._delta_ids
+
+        rows, scores = _scan(vectors, centroids, offsets, query_vec, self.n_probe)
+        if delta is not None:
+            rows = np.concatenate([rows, len(doc_ids) + np.arange(len(delta))])
+            scores = np.concatenate([scores, delta @ query_vec])
+        candidates = np.flatnonzero(scores > min_score)
+        limit = offset + top_k
+        if len(candidates) > limit:
+            candidates = candidates[np.argpartition(-scores[candidates], limit - 1)[:limit]]
+        ranked = candidates[np.argsort(-scores[candidates], kind='stable')][offset:limit]
+
+        n_base = len(doc_ids)
+        results = []
+        for idx in ranked:
+            row = rows[idx]
+            results.append((int(doc_ids[row]) if row < n_base else delta_ids[row - n_base], float(scores[idx])))
+        return results
@@ -0,0 +1,217 @@
+"""Serving stored files with validators, byte ranges and web server offload.
+
+Stored files are content-addressed, so ``File.content_hash`` is a strong
+``ETag`` for the bytes; ``Last-Modified`` is the file's mtime. Conditional
+requests (``If-None-Match``, ``If-Modified-Since``, ...) are answered with
+304/412 by ``django.utils.cache.get_conditional_response`` before the file
+is opened.
+
+``Range`` requests get 206 with a single part, or ``multipart/byteranges``
+for several; overlapping ranges are merged, and more than
+``DOWNLOAD_MAX_RANGES`` of them are ignored in favour of the whole file, as
+RFC 9110 allows. ``If-Range`` drops the range unless the validator matches.
+
+Bodies sent from Python are read in ``DOWNLOAD_BLOCK_SIZE`` blocks. A whole
+file or a single range is handed over as a file object, so a WSGI server
+with ``wsgi.file_wrapper`` (e.g. gunicorn's sync workers) sends it with
+``os.sendfile`` without copying it through Python.
+
+Under ASGI there is no ``sendfile``, and Django would collect a sync
+iterator into a list before sending a byte, so the body is an async
+iterator instead: each block is read in a worker thread and sent before the
+next is read, and memory stays at one block per download. Large files are
+still better left to the web server. With ``DOWNLOAD_OFFLOAD`` the body is left to the web server entirely:
+``x-accel-redirect`` (nginx, internal location ``DOWNLOAD_ACCEL_PREFIX``
+aliased to ``MEDIA_ROOT``) or ``x-sendfile`` (Apache, lighttpd). The web
+server then also handles ranges.
+"""
+import mimetypes
+import os
+import secrets
+from urllib.parse import quote
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, quote_etag
+from django.utils.http import content_disposition_header, http_date, parse_http_date_safe
+
+
+class RangeFile:
+    """``length`` bytes of ``file`` from ``start``, readable like a file.
+
+    The underlying file is positioned at ``start`` and ``fileno`` is exposed,
+    so ``wsgi.file_wrapper`` can ``sendfile`` it bounded by Content-Length.
+    """
+
+    def __init__(self, file, start, length):
+        file.seek(start)
+        self.file = file
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+
+def parse_ranges(header, size):
+    """Return the ``(start, end)`` ranges (``end`` inclusive) of a ``Range`` header.
+
+    ``None`` means the header should be ignored and the whole file sent; an
+    empty list means no range can be satisfied. Ranges come back sorted with
+    overlapping and adjacent ones merged.
+    """
+    if not header or not header.startswith('bytes='):
+        return None
+    ranges = []
+    for spec in header[len('bytes='):].split(','):
+        first, dash, last = spec.strip().partition('-')
+        if not dash or not (first or last) or (first and not first.isdigit()) or (last and not last.isdigit()):
+            return None
+        if not first:
+            # Suffix range: the last ``last`` bytes.
+            if int(last) == 0:
+                continue
+            ranges.append((max(size - int(last), 0), size - 1))
+            continue
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        if start < size:
+            ranges.append((start, min(int(last), size - 1) if last else size - 1))
+    if len(ranges) > settings.DOWNLOAD_MAX_RANGES:
+        return None
+
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _if_range_matches(request, etag, last_modified):
+    if_range = request.headers.get('If-Range')
+    if if_range is None:
+        return True
+    if if_range.startswith(('"', 'W/')):
+        return if_range == etag
+    return parse_http_date_safe(if_range) == last_modified
+
+
+def _blocks(path, start, length):
+    with open(path, 'rb') as f:
+        part = RangeFile(f, start, length)
+        while data := part.read(settings.DOWNLOAD_BLOCK_SIZE):
+            yield data
+
+
+async def _async_blocks(blocks):
+    """Iterate the generator ``blocks`` a block at a time, off the event loop."""
+    try:
+        while (data := await sync_to_async(next, thread_sensitive=False)(blocks, None)) is not None:
+            yield data
+    finally:
+        await sync_to_async(blocks.close, thread_sensitive=False)()
+
+
+def _multipart(path, ranges, size, content_type, boundary):
+    for start, end in ranges:
+        yield (
+            f"\r\n--{boundary}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n"
+        ).encode('ascii')
+        yield from _blocks(path, start, end - start + 1)
+    yield f"\r\n--{boundary}--\r\n".encode('ascii')
+
+
+def _multipart_length(ranges, size, content_type, boundary):
+    length = len(f"\r\n--{boundary}--\r\n")
+    for start, end in ranges:
+        length += len(
+            f"\r\n--{boundary}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n"
+        ) + end - start + 1
+    return length
+
+
+def _offload(path, response):
+    if settings.DOWNLOAD_OFFLOAD == 'x-accel-redirect':
+        relative = os.path.relpath(path, settings.MEDIA_ROOT)
+        response['X-Accel-Redirect'] = settings.DOWNLOAD_ACCEL_PREFIX.rstrip('/') + '/' + quote(relative)
+    elif settings.DOWNLOAD_OFFLOAD == 'x-sendfile':
+        response['X-Sendfile'] = path
+    else:
+        raise ValueError(f"Unknown DOWNLOAD_OFFLOAD {settings.DOWNLOAD_OFFLOAD!r}")
+    return response
+
+
+def serve_file(request, path, file_name, content_hash):
+    """Response for downloading ``path`` as ``file_name``."""
+    stat = os.stat(path)
+    size = stat.st_size
+    etag = quote_etag(content_hash)
+    last_modified = int(stat.st_mtime)
+    content_type = mimetypes.guess_type(file_name)[0] or 'application/octet-stream'
+
+    def with_validators(response):
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        response['Accept-Ranges'] = 'bytes'
+        return response
+
+    not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if not_modified is not None:
+        return with_validators(not_modified)
+
+    if settings.DOWNLOAD_OFFLOAD:
+        response = HttpResponse(content_type=content_type)
+        response['Content-Disposition'] = content_disposition_header(True, file_name)
+        return with_validators(_offload(path, response))
+
+    ranges = None
+    if _if_range_matches(request, etag, last_modified):
+        ranges = parse_ranges(request.headers.get('Range'), size)
+    if ranges == []:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f"bytes */{size}"
+        return with_validators(response)
+
+    is_async = isinstance(request, ASGIRequest)
+    if ranges is not None and len(ranges) > 1:
+        boundary = secrets.token_hex(16)
+        body = _multipart(path, ranges, size, content_type, boundary)
+        response = StreamingHttpResponse(
+            _async_blocks(body) if is_async else body,
+            status=206, content_type=f"multipart/byteranges; boundary={boundary}",
+        )
+        response['Content-Length'] = _multipart_length(ranges, size, content_type, boundary)
+    else:
+        start, end = ranges[0] if ranges else (0, size - 1)
+        status = 206 if ranges else 200
+        if is_async:
+            response = StreamingHttpResponse(
+                _async_blocks(_blocks(path, start, end - start + 1)), status=status, content_type=content_type,
+            )
+        else:
+            response = FileResponse(
+                RangeFile(open(path, 'rb'), start, end - start + 1),
+                status=status, content_type=content_type, as_attachment=True, filename=file_name,
+            )
+            response.block_size = settings.DOWNLOAD_BLOCK_SIZE
+        response['Content-Length'] = end - start + 1
+        if ranges:
+            response['Content-Range'] = f"bytes {start}-{end}/{size}"
+    response['Content-Disposition'] = content_disposition_header(True, file_name)
+    return with_validators(response)
@@ -0,0 +1,150 @@
+"""Hybrid retrieval: tag-ranked files and passage-ranked notes in one list.
+
+``perform_search`` (BM25 over file tags) and ``semantic_search`` (passages)
+run concurrently, each returning up to ``HYBRID_CANDIDATES`` candidates: the
+tag search on the request thread, the passage search on a pool with one
+thread per request thread of the worker (``HYBRID_RETRIEVER_THREADS``), so
+concurrent searches never queue behind each other. The
+two rankings are combined with reciprocal rank fusion,
+``score = sum(1 / (HYBRID_RRF_K + rank))``, which needs no calibration between
+the BM25 and cosine scales. Passages of the same note, and notes saved from
+the same file, collapse into one result keyed by that file, so a file found
+by both its tags and its text ranks above files found by only one of them.
+"""
+import contextvars
+import logging
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .metrics import timed
+from .models import File, Passage
+from .note_search import semantic_search, sync_passage_index
+from .passages import fetch_passages
+from .utils import perform_search
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.HYBRID_RETRIEVER_THREADS, thread_name_prefix='retriever')
+        return _executor
+
+
+def _run_stage(timings, stage, func, *args):
+    start = time.perf_counter()
+    try:
+        return func(*args)
+    except Exception as e:
+        logger.error(f"Error in {stage} retrieval: {e}")
+        return []
+    finally:
+        timings[stage] = round((time.perf_counter() - start) * 1000, 2)
+
+
+def _run_pooled_stage(timings, stage, func, *args):
+    # Pool threads outlive requests, so their connections are recycled here.
+    close_old_connections()
+    return _run_stage(timings, stage, func, *args)
+
+
+def _search_files(query, limit):
+    return [(file.id, file.file_name) for file in perform_search(query, page=1, per_page=limit)]
+
+
+def _search_passages(query, limit):
+    sync_passage_index()
+    return semantic_search(query, top_k=limit)
+
+
+def reciprocal_rank_fusion(rankings, k=None):
+    """Fuse ``rankings`` (lists of keys, best first) into ``[(key, score), ...]``, best first."""
+    k = settings.HYBRID_RRF_K if k is None else k
+    scores = defaultdict(float)
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, start=1):
+            scores[key] += 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+
+
+@timed('hybrid_search')
+def hybrid_search(query, page=1, per_page=None):
+    """Return one page of fused file and note results with per-stage timings in ms."""
+    per_page = per_page or settings.HYBRID_PAGE_SIZE
+    page = max(page, 1)
+    # Enough candidates from each retriever to fill this page and tell whether another follows.
+    limit = max(settings.HYBRID_CANDIDATES, page * per_page + 1)
+    timings = {}
+    start = time.perf_counter()
+
+    # In a copy of the request's context, so its queries count towards the request.
+    passages_future = _get_executor().submit(
+        contextvars.copy_context().run, _run_pooled_stage, timings, 'passages', _search_passages, query, limit,
+    )
+    files = _run_stage(timings, 'tags', _search_files, query, limit)
+    passage_results = passages_future.result()
+
+    fuse_start = time.perf_counter()
+    file_names = dict(files)
+    passage_owners = {
+        passage_id: (note_id, file_id)
+        for passage_id, note_id, file_id in Passage.objects.filter(
+            id__in=[passage_id for passage_id, _ in passage_results]
+        ).values_list('id', 'note_id', 'note__source_file_id')
+    }
+    file_ranking = [('file', file_id) for file_id, _ in files]
+    passage_ranking, best_passage = [], {}
+    for passage_id, _ in passage_results:
+        if passage_id not in passage_owners:
+            continue
+        note_id, file_id = passage_owners[passage_id]
+        key = ('file', file_id) if file_id else ('note', note_id)
+        if key not in best_passage:
+            best_passage[key] = (passage_id, note_id)
+            passage_ranking.append(key)
+
+    fused = reciprocal_rank_fusion([file_ranking, passage_ranking])
+    page_items = fused[(page - 1) * per_page:page * per_page]
+    missing_names = [key[1] for key, _ in page_items if key[0] == 'file' and key[1] not in file_names]
+    file_names.update(File.objects.filter(id__in=missing_names).values_list('id', 'file_name'))
+    snippets = {
+        passage.id: passage.text
+        for passage in fetch_passages([(best_passage[key][0], 0.0) for key, _ in page_items if key in best_passage])
+    }
+    file_ranks = {key: rank for rank, key in enumerate(file_ranking, start=1)}
+    passage_ranks = {key: rank for rank, key in enumerate(passage_ranking, start=1)}
+
+    results = []
+    for key, score in page_items:
+        passage_id, note_id = best_passage.get(key, (None, None))
+        results.append({
+            'type': key[0],
+            'file_id': key[1] if key[0] == 'file' else None,
+            'file_name': file_names.get(key[1]) if key[0] == 'file' else None,
+            'note_id': note_id,
+            'snippet': snippets.get(passage_id),
+            'score': round(score, 6),
+            'tag_rank': file_ranks.get(key),
+            'passage_rank': passage_ranks.get(key),
+        })
+    timings['fuse'] = round((time.perf_counter() - fuse_start) * 1000, 2)
+    timings['total'] = round((time.perf_counter() - start) * 1000, 2)
+
+    return {
+        'query': query,
+        'page': page,
+        'per_page': per_page,
+        'total': len(fused),
+        'results': results,
+        'timings': timings,
+    }
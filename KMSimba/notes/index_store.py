@@ -0,0 +1,128 @@
+"""On-disk generations of the passage index.
+
+Layout under the index root::
+
+    CURRENT              name of the live generation, e.g. ``gen-000042``
+    gen-000042/
+        meta.json        generation number, n_features and hashing parameters
+        data.npy         CSR term counts
+        indices.npy
+        indptr.npy
+        doc_ids.npy      passage id of every row
+        df.npy           document frequency per hashed term
+        idf.npy
+        norms.npy
+
+A ``DenseIndex`` (see ``dense_index``) is published the same way with its own
+arrays (``vectors``, ``doc_ids``, ``centroids``, ``list_offsets``) and model
+parameters in ``meta.json``; ``ARRAYS`` on the index class names the files.
+
+A generation directory is written under a temporary name and renamed into
+place before ``CURRENT`` is swapped with ``os.replace``, so readers only ever
+see complete generations. Readers open the arrays with ``mmap_mode='r'``, which
+keeps loading cheap and lets every worker share the same page cache.
+"""
+import json
+import logging
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+import numpy as np
+
+from .search_index import IncrementalTfidfIndex
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+KEEP_GENERATIONS = 2
+
+
+def _generation_name(generation):
+    return f"gen-{generation:06d}"
+
+
+def current_generation(root):
+    """Return the live generation number, or 0 when nothing is published."""
+    try:
+        with open(os.path.join(root, 'CURRENT'), encoding='utf-8') as f:
+            return int(f.read().strip().split('-')[1])
+    except (FileNotFoundError, IndexError, ValueError):
+        return 0
+
+
+def load(root, index_class=IncrementalTfidfIndex):
+    """Memory-map the live generation, or return ``None`` if there is none."""
+    generation = current_generation(root)
+    if not generation:
+        return None
+    path = os.path.join(root, _generation_name(generation))
+    try:
+        with open(os.path.join(path, 'meta.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+        arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r') for name in index_class.ARRAYS}
+        return index_class.from_arrays(arrays, meta, generation=generation)
+    except (OSError, KeyError, ValueError) as e:
+        logger.warning(f"Could not load passage index generation {generation}: {e}")
+        return None
+
+
+@contextmanager
+def _writer_lock(root):
+    with open(os.path.join(root, '.lock'), 'w') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def publish(index, root):
+    """Write ``index`` as the next generation and make it live atomically."""
+    os.makedirs(root, exist_ok=True)
+    arrays = index.to_arrays()
+    with _writer_lock(root):
+        generation = current_generation(root) + 1
+        staging = tempfile.mkdtemp(prefix='.staging-', dir=root)
+        try:
+            for name in index.ARRAYS:
+                np.save(os.path.join(staging, f"{name}.npy"), arrays[name])
+            meta = {
+                'generation': generation,
+                'documents': len(arrays['doc_ids']),
+                **index.meta(),
+            }
+            with open(os.path.join(staging, 'meta.json'), 'w', encoding='utf-8') as f:
+                json.dump(meta, f)
+            os.rename(staging, os.path.join(root, _generation_name(generation)))
+        except Exception:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+        pointer = os.path.join(root, 'CURRENT.tmp')
+        with open(pointer, 'w', encoding='utf-8') as f:
+            f.write(_generation_name(generation))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(pointer, os.path.join(root, 'CURRENT'))
+        _prune(root, generation)
+    return generation
+
+
+def _prune(root, generation):
+    # Readers that still map an older generation keep their pages after unlink.
+    for name in os.listdir(root):
+        if name.startswith('gen-'):
+            try:
+                number = int(name.split('-')[1])
+            except ValueError:
+                continue
+            if number <= generation - KEEP_GENERATIONS:
+                shutil.rmtree(os.path.join(root, name), ignore_errors=True)
@@ -0,0 +1,259 @@
+"""CPU inference runtimes for the DistilBERT QA and YOLOS models.
+
+``INFERENCE_RUNTIME`` picks, per model, how it runs:
+
+``eager``
+    fp32 PyTorch as loaded from the hub, the baseline.
+``int8``
+    PyTorch with the ``Linear`` layers dynamically quantized to int8. The
+    quantization is redone at load time, which takes a few seconds.
+``onnx``
+    The model exported to ONNX and run by onnxruntime.
+``onnx-int8``
+    The ONNX export with dynamically quantized int8 ``MatMul``/``Gemm``
+    weights.
+
+ONNX exports are built on first use, or ahead of time with
+``manage.py export_onnx``, and cached under
+``TRANSFORMERS_CACHE/onnx/<model>/``. Every runtime keeps the eager
+interface:
+- QA is a callable ``qa(question=..., context=...)`` returning a dict with
+  ``answer``.
+- YOLOS is ``(model, image_processor)``, where ``model(pixel_values=...)``
+  has ``logits`` and ``pred_boxes`` and ``model.config`` the labels.
+
+So ``chat`` and ``utils.detect_objects`` do not change.
+
+onnxruntime sessions are not fork-safe. They are therefore opened in each
+process on first call; preloading in the gunicorn master only builds the
+export.
+
+``qa_parity`` and ``detection_parity`` compare a runtime with the eager
+baseline. ``manage.py check_inference_runtime`` runs them on stored notes and
+images before a runtime is switched on.
+"""
+import inspect
+import logging
+import os
+from types import SimpleNamespace
+
+import numpy as np
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+RUNTIMES = ('eager', 'int8', 'onnx', 'onnx-int8')
+
+# Question answering windows, as in the transformers pipeline
+QA_MAX_LENGTH = 384
+QA_STRIDE = 128
+QA_MAX_ANSWER_TOKENS = 15
+
+
+def runtime(name):
+    value = settings.INFERENCE_RUNTIME.get(name, 'eager')
+    if value not in RUNTIMES:
+        raise ValueError(f"Unknown inference runtime {value!r} for {name}; expected one of {RUNTIMES}")
+    return value
+
+
+def artifact_dir(model_id):
+    return os.path.join(settings.TRANSFORMERS_CACHE, 'onnx', model_id.strip('/').replace('/', '--'))
+
+
+def _quantize_linear(model):
+    import torch
+
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def _torch_onnx_export(model, args, path, **kwargs):
+    import torch
+
+    # Newer torch exports through dynamo by default; the TorchScript exporter handles these models.
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        kwargs['dynamo'] = False
+    with torch.inference_mode():
+        torch.onnx.export(model, args, path, opset_version=17, do_constant_folding=True, **kwargs)
+
+
+def _export(model_id, quantized, export):
+    """Path of the cached ONNX model, exporting it with ``export(path)`` if missing."""
+    directory = artifact_dir(model_id)
+    path = os.path.join(directory, 'model-int8.onnx' if quantized else 'model.onnx')
+    if os.path.exists(path):
+        return path
+    os.makedirs(directory, exist_ok=True)
+    # Workers may export at the same time; each writes its own file and the rename is atomic.
+    partial = f"{path}.{os.getpid()}.partial"
+    if quantized:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        quantize_dynamic(
+            _export(model_id, False, export), partial,
+            weight_type=QuantType.QInt8, op_types_to_quantize=['MatMul', 'Gemm'],
+        )
+    else:
+        logger.info(f"Exporting {model_id} to ONNX")
+        export(partial)
+    os.replace(partial, path)
+    return path
+
+
+class OnnxModel:
+    """An onnxruntime session opened lazily, once per process."""
+
+    def __init__(self, path):
+        self.path = path
+        self._session = None
+        self._pid = None
+
+    @property
+    def session(self):
+        if self._session is None or self._pid != os.getpid():
+            import onnxruntime
+
+            options = onnxruntime.SessionOptions()
+            options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+            if settings.TORCH_NUM_THREADS:
+                options.intra_op_num_threads = settings.TORCH_NUM_THREADS
+            self._session = onnxruntime.InferenceSession(self.path, options, providers=['CPUExecutionProvider'])
+            self._pid = os.getpid()
+        return self._session
+
+    def run(self, outputs, inputs):
+        return self.session.run(outputs, inputs)
+
+
+class OnnxQuestionAnswerer:
+    """Extractive QA over an ONNX DistilBERT, decoding spans like the transformers pipeline."""
+
+    def __init__(self, model, tokenizer):
+        self.model = model
+        self.tokenizer = tokenizer
+
+    @staticmethod
+    def _softmax(logits):
+        exp = np.exp(logits - logits.max())
+        return exp / exp.sum()
+
+    @staticmethod
+    def _span(encoded, window, offsets, first, last):
+        # Like the pipeline, widen the span to whole words.
+        try:
+            start = encoded.word_to_chars(window, encoded.token_to_word(window, first), sequence_index=1)[0]
+            end = encoded.word_to_chars(window, encoded.token_to_word(window, last), sequence_index=1)[1]
+            return start, end
+        except (TypeError, ValueError):
+            return int(offsets[first][0]), int(offsets[last][1])
+
+    def __call__(self, question, context):
+        encoded = self.tokenizer(
+            question, context, truncation='only_second', max_length=QA_MAX_LENGTH, stride=QA_STRIDE,
+            return_overflowing_tokens=True, return_offsets_mapping=True, padding=True, return_tensors='np',
+        )
+        start_logits, end_logits = self.model.run(['start_logits', 'end_logits'], {
+            'input_ids': encoded['input_ids'].astype(np.int64),
+            'attention_mask': encoded['attention_mask'].astype(np.int64),
+        })
+        best = (-1.0, 0, 0)
+        for window, offsets in enumerate(encoded['offset_mapping']):
+            in_context = np.array([sequence == 1 for sequence in encoded.sequence_ids(window)])
+            # Like the pipeline: [CLS] takes part in the softmax but cannot be the answer.
+            in_context[0] = True
+            start = self._softmax(np.where(in_context, start_logits[window], -10000.0))
+            end = self._softmax(np.where(in_context, end_logits[window], -10000.0))
+            start[0] = end[0] = 0.0
+            scores = np.tril(np.triu(np.outer(start, end)), QA_MAX_ANSWER_TOKENS - 1)
+            first, last = np.unravel_index(scores.argmax(), scores.shape)
+            if scores[first, last] > best[0]:
+                best = (float(scores[first, last]), *self._span(encoded, window, offsets, first, last))
+        score, start_char, end_char = best
+        return {'score': score, 'start': start_char, 'end': end_char, 'answer': context[start_char:end_char]}
+
+
+class OnnxDetector:
+    """YOLOS over ONNX, returning outputs ``post_process_object_detection`` accepts."""
+
+    def __init__(self, model, config):
+        self.model = model
+        self.config = config
+
+    def __call__(self, pixel_values, **kwargs):
+        import torch
+
+        logits, pred_boxes = self.model.run(['logits', 'pred_boxes'], {'pixel_values': pixel_values.numpy()})
+        return SimpleNamespace(logits=torch.from_numpy(logits), pred_boxes=torch.from_numpy(pred_boxes))
+
+
+def load_question_answerer(model_id, runtime_name='eager'):
+    from transformers import AutoModelForQuestionAnswering, AutoTokenizer, pipeline
+
+    if runtime_name == 'eager':
+        return pipeline('question-answering', model=model_id)
+    tokenizer = AutoTokenizer.from_pretrained(model_id)
+    if runtime_name == 'int8':
+        model = AutoModelForQuestionAnswering.from_pretrained(model_id).eval()
+        return pipeline('question-answering', model=_quantize_linear(model), tokenizer=tokenizer)
+
+    def export(path):
+        model = AutoModelForQuestionAnswering.from_pretrained(model_id).eval()
+        sample = tokenizer("What is it?", "It is an example.", return_tensors='pt')
+        dynamic = {0: 'batch', 1: 'sequence'}
+        _torch_onnx_export(
+            model, (sample['input_ids'], sample['attention_mask']), path,
+            input_names=['input_ids', 'attention_mask'], output_names=['start_logits', 'end_logits'],
+            dynamic_axes={'input_ids': dynamic, 'attention_mask': dynamic, 'start_logits': dynamic, 'end_logits': dynamic},
+        )
+
+    path = _export(model_id, runtime_name == 'onnx-int8', export)
+    return OnnxQuestionAnswerer(OnnxModel(path), tokenizer)
+
+
+def load_detector(model_id, runtime_name='eager'):
+    from transformers import AutoConfig, YolosForObjectDetection, YolosImageProcessor
+
+    image_processor = YolosImageProcessor.from_pretrained(model_id)
+    if runtime_name in ('eager', 'int8'):
+        model = YolosForObjectDetection.from_pretrained(model_id).eval()
+        return (_quantize_linear(model) if runtime_name == 'int8' else model), image_processor
+
+    def export(path):
+        import torch
+
+        model = YolosForObjectDetection.from_pretrained(model_id).eval()
+        model.config.return_dict = False
+        # Any image size works: height and width are dynamic axes.
+        side = image_processor.size.get('shortest_edge', 512)
+        _torch_onnx_export(
+            model, (torch.zeros(1, 3, side, side),), path,
+            input_names=['pixel_values'], output_names=['logits', 'pred_boxes'],
+            dynamic_axes={'pixel_values': {0: 'batch', 2: 'height', 3: 'width'}, 'logits': {0: 'batch'}, 'pred_boxes': {0: 'batch'}},
+        )
+
+    path = _export(model_id, runtime_name == 'onnx-int8', export)
+    return OnnxDetector(OnnxModel(path), AutoConfig.from_pretrained(model_id)), image_processor
+
+
+def qa_parity(baseline, candidate, samples):
+    """Share of ``(question, context)`` samples both answer identically (after stripping)."""
+    if not samples:
+        return 1.0
+    same = sum(
+        baseline(question=question, context=context)['answer'].strip()
+        == candidate(question=question, context=context)['answer'].strip()
+        for question, context in samples
+    )
+    return same / len(samples)
+
+
+def detection_parity(baseline_labels, candidate_labels):
+    """Mean Jaccard overlap of the label sets detected per image; two empty sets agree."""
+    if not baseline_labels:
+        return 1.0
+    overlaps = []
+    for expected, actual in zip(baseline_labels, candidate_labels):
+        expected, actual = set(expected), set(actual)
+        overlaps.append(len(expected & actual) / len(expected | actual) if expected | actual else 1.0)
+    return float(np.mean(overlaps))
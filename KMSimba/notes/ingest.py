@@ -0,0 +1,353 @@
+"""Background ingestion of uploaded files.
+
+``upload_and_search`` only hashes and stores the upload and queues an
+``IngestJob``; uploads whose content hash is already known are linked to the
+existing ``File`` straight away without any extraction; if it has no note, a
+job is queued to recreate it from ``File.extracted_text``. The
+``run_ingest_worker`` management command claims queued jobs from the database
+and runs them on a local process pool, one job per process. Failed jobs are
+retried with exponential backoff up to ``IngestJob.max_attempts``.
+
+A job renames its staged upload (a form upload or a finished chunked upload)
+into the file's content-addressed place rather than copying it, so saving a
+multi-GB scan costs no IO; a failed attempt renames it back for the retry.
+"""
+import logging
+import multiprocessing
+import os
+import time
+from itertools import islice
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from . import metrics, ocr
+from .metrics import timed
+from .models import File as FileModel, IngestJob
+from .ocr import ocr_pdf_pages
+from .passages import embed_passages
+from .services import NoteService
+from .tagging import generate_tag_counts
+from .utils import (
+    pdf_page_texts,
+    detect_objects,
+    doc_reader,
+    extract_text_from_image,
+    iter_pdf_pages,
+    save_file,
+    convert_png_to_jpg,
+    hash_file,
+    find_duplicate,
+    read_text_file,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def needs_note(file_instance):
+    return bool(file_instance.extracted_text.strip()) and not file_instance.notes.exists()
+
+
+def ensure_note(file_instance):
+    """Recreate the note of a stored file from its extracted text if it has none."""
+    if not needs_note(file_instance):
+        return
+    # Embedded before the row lock is taken: only the check and the insert hold it.
+    embeddings = embed_passages([file_instance.extracted_text.strip()])
+    with transaction.atomic():
+        # The row lock lets one of several concurrent duplicates add the note.
+        locked = FileModel.objects.select_for_update().filter(id=file_instance.id).first()
+        if locked is not None and not locked.notes.exists():
+            NoteService.ingest(locked.extracted_text, source_file=locked, embeddings=embeddings)
+
+
+def duplicate_job(name, content_hash):
+    """A finished job linking ``name`` to the stored file with the same content, or ``None``.
+
+    A stored file that lost its note gets it back from a queued job, so no
+    embedding runs on the request thread.
+    """
+    existing = find_duplicate(content_hash)
+    if existing is None:
+        return None
+    if needs_note(existing):
+        IngestJob.objects.create(original_name=name, content_hash=content_hash)
+    return IngestJob.objects.create(
+        original_name=name, content_hash=content_hash, status=IngestJob.DONE,
+        stage='duplicate', progress=100, result_file=existing,
+    )
+
+
+def enqueue_upload(uploaded_file):
+    content_hash = hash_file(uploaded_file)
+    job = duplicate_job(uploaded_file.name, content_hash)
+    if job is not None:
+        return job
+    return IngestJob.objects.create(original_name=uploaded_file.name, upload=uploaded_file, content_hash=content_hash)
+
+
+def job_status(job):
+    return {
+        'id': job.id,
+        'name': job.original_name,
+        'status': job.status,
+        'stage': job.stage,
+        'progress': job.progress,
+        'attempts': job.attempts,
+        'error': job.error,
+        'file_id': job.result_file_id,
+        'duplicate': job.stage == 'duplicate',
+    }
+
+
+def _report(job_id, stage, progress):
+    IngestJob.objects.filter(id=job_id).update(stage=stage, progress=progress, updated_at=timezone.now())
+
+
+def extract_text(name, path, report):
+    """Return the text extracted from an uploaded file, detected object labels appended.
+
+    Readers are given ``path`` rather than the contents, so a large upload is
+    never read into memory as a whole.
+    """
+    text = ""
+    labels = []
+    lower_name = name.lower()
+
+    if lower_name.endswith('.pdf'):
+        report('reading pdf text', 5)
+        try:
+            page_texts = pdf_page_texts(path)
+            report('ocr', 8)
+            text = "\n".join(page_text for page_text in ocr_pdf_pages(path, page_texts) if page_text)
+        except Exception as e:
+            logger.error(f"Error reading PDF: {e}")
+        try:
+            import fitz
+
+            with fitz.open(path) as doc:
+                pages = iter_pdf_pages(doc)
+                done = 0
+                while batch := list(islice(pages, settings.YOLOS_BATCH_SIZE)):
+                    for page_labels in detect_objects(batch):
+                        labels.extend(page_labels)
+                    done += len(batch)
+                    report('detecting objects', 10 + int(60 * done / doc.page_count))
+        except Exception as e:
+            logger.error(f"Error processing PDF: {e}")
+
+    elif lower_name.endswith(('.doc', '.docx')):
+        report('reading document', 10)
+        text = doc_reader(path)
+
+    elif lower_name.endswith(('.jpg', '.jpeg', '.png')):
+        report('ocr', 10)
+        text = extract_text_from_image(path)
+        image = convert_png_to_jpg(path) if lower_name.endswith('.png') else path
+        report('detecting objects', 40)
+        labels.extend(detect_objects([image])[0])
+
+    elif lower_name.endswith('.txt'):
+        text = read_text_file(path)
+
+    if labels:
+        text += " " + " ".join(labels)
+    return text
+
+
+def run_job(job_id):
+    """Process one claimed job; runs inside a pool process."""
+    try:
+        _run_job(job_id)
+    finally:
+        metrics.flush()
+
+
+@timed('ingest_job')
+def _run_job(job_id):
+    job = IngestJob.objects.get(id=job_id)
+
+    def report(stage, progress):
+        _report(job_id, stage, progress)
+
+    existing = find_duplicate(job.content_hash) if job.content_hash else None
+    if existing is not None:
+        ensure_note(existing)
+        _finish(job, existing, stage='duplicate')
+        return
+
+    file_instance = None
+    stored_name = None
+    try:
+        text = extract_text(job.original_name, job.upload.path, report)
+        report('tagging', 80)
+        tags = generate_tag_counts(text)
+        embeddings = embed_passages([text.strip()]) if text.strip() else None
+        report('saving', 90)
+        if not job.content_hash:
+            with job.upload.open('rb') as upload:
+                job.content_hash = hash_file(upload)
+        stored_name = _move_upload(job)
+        # The file and its note commit together: a retry after a failed
+        # note must not find the file and finish as a duplicate without one.
+        with transaction.atomic():
+            file_instance = save_file(
+                job.original_name, stored_name, tags,
+                content_hash=job.content_hash, extracted_text=text,
+            )
+            if file_instance is None:
+                raise RuntimeError("File could not be saved.")
+            # A concurrent job may have stored the same content, note included.
+            if text.strip() and not file_instance.notes.exists():
+                NoteService.ingest(text, source_file=file_instance, embeddings=embeddings)
+    except Exception as e:
+        logger.exception(f"Ingest job {job_id} failed")
+        if stored_name is not None and not FileModel.objects.filter(file_content=stored_name).exists():
+            _restore_upload(job, stored_name)
+        _fail(job, e)
+        return
+
+    _finish(job, file_instance)
+
+
+def _move_upload(job):
+    """Rename the staged upload of ``job`` to its content-addressed storage name and return that name."""
+    field = FileModel._meta.get_field('file_content')
+    name = field.generate_filename(FileModel(content_hash=job.content_hash), job.original_name)
+    name = field.storage.get_available_name(name, max_length=field.max_length)
+    target = field.storage.path(name)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    os.replace(job.upload.path, target)
+    return name
+
+
+def _restore_upload(job, stored_name):
+    """Move the upload back to where ``job`` expects it, for the next attempt."""
+    path = FileModel._meta.get_field('file_content').storage.path(stored_name)
+    if os.path.exists(path):
+        os.replace(path, job.upload.path)
+
+
+def _finish(job, file_instance, stage='done'):
+    job.upload.delete(save=False)
+    IngestJob.objects.filter(id=job.id).update(
+        status=IngestJob.DONE, stage=stage, progress=100, error='',
+        result_file=file_instance, locked_at=None, updated_at=timezone.now(),
+    )
+
+
+def _fail(job, error):
+    attempts = job.attempts
+    if attempts < job.max_attempts:
+        status = IngestJob.QUEUED
+        run_after = timezone.now() + timedelta(seconds=settings.INGEST_RETRY_BACKOFF * 2 ** (attempts - 1))
+    else:
+        status = IngestJob.FAILED
+        run_after = job.run_after
+    IngestJob.objects.filter(id=job.id).update(
+        status=status, error=str(error), run_after=run_after, locked_at=None, updated_at=timezone.now(),
+    )
+
+
+def claim_job():
+    """Atomically move the oldest due job to running and return its id.
+
+    Jobs left running past ``INGEST_JOB_TIMEOUT`` (e.g. a killed worker) are
+    claimed again, or failed once they are out of attempts.
+    """
+    now = timezone.now()
+    stale = now - timedelta(seconds=settings.INGEST_JOB_TIMEOUT)
+    IngestJob.objects.filter(
+        status=IngestJob.RUNNING, locked_at__lt=stale, attempts__gte=F('max_attempts'),
+    ).update(status=IngestJob.FAILED, error='Timed out.', locked_at=None, updated_at=now)
+
+    candidates = (
+        IngestJob.objects.filter(
+            Q(status=IngestJob.QUEUED, run_after__lte=now) | Q(status=IngestJob.RUNNING, locked_at__lt=stale),
+            attempts__lt=F('max_attempts'),
+        )
+        .order_by('run_after', 'id')
+        .values_list('id', 'attempts')[:10]
+    )
+    for job_id, attempts in candidates:
+        # ``attempts`` doubles as a version number so only one worker wins the claim.
+        claimed = IngestJob.objects.filter(
+            id=job_id, attempts=attempts, status__in=[IngestJob.QUEUED, IngestJob.RUNNING],
+        ).update(status=IngestJob.RUNNING, attempts=attempts + 1, locked_at=now, stage='claimed', updated_at=now)
+        if claimed:
+            return job_id
+    return None
+
+
+def _init_pool_process(processes):
+    if multiprocessing.get_start_method() != 'fork':
+        import django
+        django.setup()
+    connections.close_all()
+    # The pool's processes share the cores; OCR must not fan out to all of them from each.
+    ocr.limit_processes(max(1, (os.cpu_count() or 1) // processes))
+
+
+def _fail_lost_job(job_id, error):
+    """Retry or fail a job that ended without ``run_job`` recording the outcome."""
+    job = IngestJob.objects.filter(id=job_id, status=IngestJob.RUNNING).first()
+    if job is not None:
+        _fail(job, error)
+
+
+def run_worker(processes=None, poll_interval=1.0, once=False):
+    """Claim jobs and keep up to ``processes`` of them running until stopped.
+
+    A pool process that dies (e.g. killed for memory on a huge PDF) breaks
+    the whole pool: every job in flight counts as a failed attempt, and a new
+    pool takes over.
+    """
+    processes = processes or os.cpu_count() or 1
+    while not _run_pool(processes, poll_interval, once):
+        logger.error("Ingest process pool broke; starting a new one")
+
+
+def _run_pool(processes, poll_interval, once):
+    """Run jobs on one pool; ``False`` if it broke, ``True`` once idle with ``once``."""
+    running = {}
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_pool_process, initargs=(processes,)) as pool:
+        try:
+            while True:
+                while len(running) < processes:
+                    job_id = claim_job()
+                    if job_id is None:
+                        break
+                    logger.info(f"Starting ingest job {job_id}")
+                    # Pool processes may be forked on submit; never share a DB socket with them.
+                    connections.close_all()
+                    try:
+                        running[job_id] = pool.submit(run_job, job_id)
+                    except BrokenProcessPool as e:
+                        _fail_lost_job(job_id, e)
+                        raise
+                if once and not running:
+                    return True
+                if running:
+                    done, _ = wait(running.values(), timeout=poll_interval, return_when=FIRST_COMPLETED)
+                    for job_id, future in list(running.items()):
+                        if future not in done:
+                            continue
+                        del running[job_id]
+                        error = future.exception()
+                        if error is not None:
+                            logger.error(f"Ingest job {job_id} failed in the worker pool: {error!r}")
+                            _fail_lost_job(job_id, error)
+                            if isinstance(error, BrokenProcessPool):
+                                raise error
+                else:
+                    time.sleep(poll_interval)
+        except BrokenProcessPool as e:
+            # The pool terminates every process along with the one that died.
+            for job_id in running:
+                _fail_lost_job(job_id, e)
+            return False
@@ -0,0 +1,396 @@
+"""LLM backends for the chat search.
+
+``LLM_BACKEND`` selects one of:
+
+``gemini``
+    The Gemini REST API, streamed with ``streamGenerateContent?alt=sse``
+    through one pooled ``httpx.AsyncClient`` per event loop, closed when the
+    loop shuts down. ``GEMINI_API_BASE`` can point at
+    ``benchmarks/fake_llm_server.py``, which speaks the same protocol.
+``local``
+    A small seq2seq model (``LOCAL_LLM_MODEL``) run on CPU through the model
+    registry, so the chat works offline.
+``fake``
+    Deterministic replies echoed from the prompt after a configurable delay,
+    for tests and for benchmarking the search path without network.
+
+Every call runs against a deadline, ``LLM_REQUEST_BUDGET`` seconds after the
+question arrived unless the caller passes one, that covers queueing,
+retries and the reply itself. At most ``LLM_MAX_CONCURRENCY`` calls are in
+flight per process, counted across event loops: under WSGI every request
+runs its async code on a loop of its own (``async_to_sync``), so a limit per
+loop would not limit anything. A call that cannot get a slot within its
+budget fails instead of queueing behind the others. Retryable failures (timeouts, 429,
+5xx) are retried up to ``LLM_RETRIES`` times with full-jitter exponential
+backoff while the budget allows, but a stream is never retried once it has
+produced text. Backends that batch (``batch_size > 1``) get prompts of
+concurrent callers collected for up to ``LLM_BATCH_WAIT_MS`` and generated in
+one call. Batches only form within one event loop, so prompts of different
+requests are merged under ASGI but not under WSGI.
+"""
+import asyncio
+import json
+import logging
+import random
+import threading
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+from django.conf import settings
+
+from .metrics import timed
+from .registry import registry
+
+logger = logging.getLogger(__name__)
+
+
+class LLMError(Exception):
+    def __init__(self, message, retryable=False):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class LLMBackend:
+    batch_size = 1
+
+    async def stream(self, prompt, timeout):
+        """Yield the reply to ``prompt`` in chunks."""
+        yield (await self.generate_batch([prompt], timeout))[0]
+
+    async def generate_batch(self, prompts, timeout):
+        """Return the replies to ``prompts``, in order."""
+        raise NotImplementedError
+
+
+class GeminiBackend(LLMBackend):
+    def __init__(self):
+        self._clients = weakref.WeakKeyDictionary()
+
+    def _client(self):
+        import httpx
+
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            client = httpx.AsyncClient(
+                base_url=settings.GEMINI_API_BASE,
+                limits=httpx.Limits(
+                    max_connections=settings.LLM_MAX_CONNECTIONS,
+                    max_keepalive_connections=settings.LLM_MAX_CONNECTIONS,
+                ),
+                headers={'x-goog-api-key': settings.GEMINI_API_KEY},
+            )
+            self._clients[loop] = client
+            _close_with_loop(client)
+        return client
+
+    @staticmethod
+    def _chunk_text(payload):
+        try:
+            parts = payload['candidates'][0]['content']['parts']
+        except (KeyError, IndexError):
+            return ''
+        return ''.join(part.get('text', '') for part in parts)
+
+    async def stream(self, prompt, timeout):
+        import httpx
+
+        body = {'contents': [{'role': 'user', 'parts': [{'text': prompt}]}]}
+        url = f"/v1beta/models/{settings.GEMINI_MODEL}:streamGenerateContent"
+        try:
+            async with self._client().stream(
+                'POST', url, params={'alt': 'sse'}, json=body,
+                timeout=httpx.Timeout(timeout, connect=min(timeout, settings.LLM_CONNECT_TIMEOUT)),
+            ) as response:
+                if response.status_code != 200:
+                    await response.aread()
+                    raise LLMError(
+                        f"LLM returned {response.status_code}: {response.text[:200]}",
+                        retryable=response.status_code == 429 or response.status_code >= 500,
+                    )
+                async for line in response.aiter_lines():
+                    if line.startswith('data:'):
+                        text = self._chunk_text(json.loads(line[5:]))
+                        if text:
+                            yield text
+        except httpx.HTTPError as e:
+            raise LLMError(f"LLM request failed: {e!r}", retryable=True) from e
+
+    async def generate_batch(self, prompts, timeout):
+        return [''.join([chunk async for chunk in self.stream(prompts[0], timeout)])]
+
+
+class LocalBackend(LLMBackend):
+    def __init__(self):
+        # One batch at a time: the model already uses every core.
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='local-llm')
+
+    def _generate(self, prompts):
+        outputs = registry.get('local_llm')(
+            prompts, batch_size=len(prompts), max_new_tokens=settings.LOCAL_LLM_MAX_TOKENS,
+        )
+        return [output['generated_text'] for output in outputs]
+
+    @property
+    def batch_size(self):
+        return settings.LLM_BATCH_SIZE
+
+    async def generate_batch(self, prompts, timeout):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._generate, prompts)
+
+
+class FakeBackend(LLMBackend):
+    """Echoes up to ``FAKE_LLM_TOKENS`` words of the prompt's context."""
+
+    @property
+    def batch_size(self):
+        return settings.LLM_BATCH_SIZE
+
+    @staticmethod
+    def reply_words(prompt):
+        lines = [line for line in prompt.split('\n')[1:] if not line.startswith('Based on the above information')]
+        words = ' '.join(lines).split() or ['No', 'notes', 'matched.']
+        return (words * (settings.FAKE_LLM_TOKENS // len(words) + 1))[:settings.FAKE_LLM_TOKENS]
+
+    async def stream(self, prompt, timeout):
+        await asyncio.sleep(settings.FAKE_LLM_FIRST_TOKEN_MS / 1000)
+        for number, word in enumerate(self.reply_words(prompt)):
+            if number:
+                await asyncio.sleep(settings.FAKE_LLM_TOKEN_MS / 1000)
+            yield word + ' '
+
+    async def generate_batch(self, prompts, timeout):
+        # A batch costs about as much as one reply, like a batched forward pass.
+        await asyncio.sleep((settings.FAKE_LLM_FIRST_TOKEN_MS + settings.FAKE_LLM_TOKEN_MS * (settings.FAKE_LLM_TOKENS - 1)) / 1000)
+        return [' '.join(self.reply_words(prompt)) for prompt in prompts]
+
+
+BACKENDS = {'gemini': GeminiBackend, 'local': LocalBackend, 'fake': FakeBackend}
+
+_backends = {}
+_loop_state = weakref.WeakKeyDictionary()
+_slot_pools = {}
+
+
+def get_backend():
+    name = settings.LLM_BACKEND
+    if name not in _backends:
+        _backends[name] = BACKENDS[name]()
+    return _backends[name]
+
+
+def new_deadline():
+    return asyncio.get_running_loop().time() + settings.LLM_REQUEST_BUDGET
+
+
+def _remaining(deadline):
+    remaining = deadline - asyncio.get_running_loop().time()
+    if remaining <= 0:
+        raise LLMError("LLM request budget exhausted")
+    return remaining
+
+
+def _state():
+    # Batchers and their tasks belong to the event loop that created them.
+    loop = asyncio.get_running_loop()
+    state = _loop_state.get(loop)
+    if state is None:
+        state = {'batchers': {}, 'closers': set()}
+        _loop_state[loop] = state
+    return state
+
+
+def _close_with_loop(client):
+    # asyncio.run(), which async_to_sync uses for every WSGI request, cancels
+    # the tasks left on a loop before closing it; this one closes the client.
+    async def close_on_cancel():
+        try:
+            await asyncio.get_running_loop().create_future()
+        finally:
+            await client.aclose()
+
+    _state()['closers'].add(asyncio.get_running_loop().create_task(close_on_cancel()))
+
+
+class SlotPool:
+    """A counting semaphore that coroutines on any event loop can wait on."""
+
+    def __init__(self, size):
+        self._lock = threading.Lock()
+        self._free = size
+        self._waiters = deque()
+
+    async def acquire(self, timeout):
+        with self._lock:
+            if self._free:
+                self._free -= 1
+                return
+            future = asyncio.get_running_loop().create_future()
+            self._waiters.append(future)
+        try:
+            await asyncio.wait_for(future, timeout)
+        except BaseException:
+            with self._lock:
+                if future in self._waiters:
+                    self._waiters.remove(future)
+                    raise
+            # The slot was handed over as we gave up: pass it on.
+            self.release()
+            raise
+
+    def release(self):
+        with self._lock:
+            if not self._waiters:
+                self._free += 1
+                return
+            future = self._waiters.popleft()
+        try:
+            future.get_loop().call_soon_threadsafe(_wake, future)
+        except RuntimeError:  # its loop is closed
+            self.release()
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+def _slots():
+    size = settings.LLM_MAX_CONCURRENCY
+    if size not in _slot_pools:
+        _slot_pools.setdefault(size, SlotPool(size))
+    return _slot_pools[size]
+
+
+@asynccontextmanager
+async def _slot(deadline):
+    slots = _slots()
+    try:
+        await slots.acquire(_remaining(deadline))
+    except asyncio.TimeoutError:
+        raise LLMError("No LLM capacity within the request budget") from None
+    try:
+        yield
+    finally:
+        slots.release()
+
+
+async def _backoff(attempt, deadline, error):
+    delay = random.uniform(0, settings.LLM_RETRY_BASE_MS / 1000 * 2 ** attempt)
+    if delay >= _remaining(deadline):
+        raise error
+    logger.warning(f"Retrying LLM call after {error} (attempt {attempt + 1})")
+    await asyncio.sleep(delay)
+
+
+class PromptBatcher:
+    """Collects prompts of concurrent callers into batches for one backend."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.wait = settings.LLM_BATCH_WAIT_MS / 1000
+        self._queue = asyncio.Queue()
+        self._task = None
+        self._batches = set()
+
+    async def generate(self, prompt, deadline):
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((prompt, deadline, future))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), _remaining(deadline))
+        except asyncio.TimeoutError:
+            future.cancel()
+            raise LLMError("LLM request budget exhausted") from None
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        until = loop.time() + self.wait
+        while len(batch) < self.backend.batch_size:
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), max(until - loop.time(), 0)))
+            except asyncio.TimeoutError:
+                break
+        return [item for item in batch if not item[2].done()]
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            if batch:
+                task = asyncio.create_task(self._generate(batch))
+                self._batches.add(task)
+                task.add_done_callback(self._batches.discard)
+
+    async def _generate(self, batch):
+        deadline = max(item_deadline for _, item_deadline, _ in batch)
+        try:
+            replies = await _call_with_retries(
+                lambda timeout: self.backend.generate_batch([prompt for prompt, _, _ in batch], timeout), deadline,
+            )
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, _, future), reply in zip(batch, replies):
+            if not future.done():
+                future.set_result(reply)
+
+
+async def _call_with_retries(call, deadline):
+    for attempt in range(settings.LLM_RETRIES + 1):
+        try:
+            async with _slot(deadline):
+                remaining = _remaining(deadline)
+                try:
+                    return await asyncio.wait_for(call(remaining), remaining)
+                except asyncio.TimeoutError:
+                    raise LLMError("LLM request budget exhausted") from None
+        except LLMError as e:
+            if not e.retryable or attempt == settings.LLM_RETRIES:
+                raise
+            await _backoff(attempt, deadline, e)
+
+
+@timed('llm')
+async def stream_generate(prompt, deadline=None):
+    """Yield the reply to ``prompt`` in chunks as the backend produces them."""
+    deadline = deadline or new_deadline()
+    backend = get_backend()
+    if backend.batch_size > 1:
+        batchers = _state()['batchers']
+        if backend not in batchers:
+            batchers[backend] = PromptBatcher(backend)
+        yield await batchers[backend].generate(prompt, deadline)
+        return
+
+    for attempt in range(settings.LLM_RETRIES + 1):
+        started = False
+        try:
+            async with _slot(deadline):
+                chunks = backend.stream(prompt, _remaining(deadline)).__aiter__()
+                try:
+                    while True:
+                        try:
+                            chunk = await asyncio.wait_for(chunks.__anext__(), _remaining(deadline))
+                        except StopAsyncIteration:
+                            return
+                        except asyncio.TimeoutError:
+                            raise LLMError("LLM request budget exhausted") from None
+                        started = True
+                        yield chunk
+                finally:
+                    await chunks.aclose()
+        except LLMError as e:
+            if started or not e.retryable or attempt == settings.LLM_RETRIES:
+                raise
+            await _backoff(attempt, deadline, e)
+
+
+async def generate(prompt, deadline=None):
+    return ''.join([chunk async for chunk in stream_generate(prompt, deadline)])
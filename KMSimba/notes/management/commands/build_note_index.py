@@ -0,0 +1,69 @@
+from django.core.management.base import BaseCommand
+
+from notes import index_store
+from notes.dense_index import DenseIndex, decode_embeddings, embed_texts, encode_embedding
+from notes.models import Note, Passage
+from notes.note_search import index_backend
+from notes.passages import create_passages, with_text
+
+
+class Command(BaseCommand):
+    help = ("Rebuild the passage search index of SEMANTIC_SEARCH_BACKEND from the database "
+            "and publish it as a new generation.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000)
+        parser.add_argument('--reembed', action='store_true',
+                            help="Embed every passage again, e.g. after changing DENSE_EMBEDDING_MODEL.")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        missing = Note.objects.filter(passages__isnull=True).only('id', 'content')
+        split = 0
+        for note in missing.iterator(chunk_size=batch_size):
+            split += len(create_passages([note]))
+        if split:
+            self.stdout.write(f"Split notes without passages into {split} passages.")
+
+        index_class, root = index_backend()
+        index = index_class()
+        if isinstance(index, DenseIndex):
+            self.embed_passages(batch_size, options['reembed'])
+            passages = Passage.objects.order_by('id').values_list('id', 'embedding')
+
+            def add(ids, embeddings):
+                index.add_vectors(ids, decode_embeddings(embeddings))
+        else:
+            passages, add = with_text(Passage.objects.order_by('id')).values_list('id', 'text'), index.add_many
+        passage_ids, values = [], []
+        for passage_id, value in passages.iterator(chunk_size=batch_size):
+            passage_ids.append(passage_id)
+            values.append(value)
+            if len(passage_ids) >= batch_size:
+                add(passage_ids, values)
+                passage_ids, values = [], []
+        if passage_ids:
+            add(passage_ids, values)
+
+        generation = index_store.publish(index, root)
+        self.stdout.write(self.style.SUCCESS(f"Published generation {generation} with {len(index)} passages."))
+
+    def embed_passages(self, batch_size, reembed):
+        """Store embeddings for passages saved without one (or all of them with ``reembed``)."""
+        passages = with_text(Passage.objects.order_by('id')).only('id')
+        if not reembed:
+            passages = passages.filter(embedding__isnull=True)
+        embedded = 0
+        last_id = 0
+        while True:
+            # Paged by id rather than iterated: the rows being read are updated.
+            batch = list(passages.filter(id__gt=last_id)[:batch_size])
+            if not batch:
+                break
+            for passage, vector in zip(batch, embed_texts([passage.text for passage in batch])):
+                passage.embedding = encode_embedding(vector)
+            Passage.objects.bulk_update(batch, ['embedding'], batch_size=1000)
+            embedded += len(batch)
+            last_id = batch[-1].id
+        if embedded:
+            self.stdout.write(f"Embedded {embedded} passages.")
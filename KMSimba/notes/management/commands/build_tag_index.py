@@ -0,0 +1,17 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from notes.tag_index import TagPostingsIndex, prune_file_changes, save_snapshot
+
+
+class Command(BaseCommand):
+    help = "Rebuild the tag search index from the database and write the snapshot every worker loads."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        index = TagPostingsIndex.build(chunk_size=options['batch_size'])
+        save_snapshot(index, settings.TAG_INDEX_SNAPSHOT)
+        self.stdout.write(self.style.SUCCESS(f"Wrote tag index with {len(index)} files to {settings.TAG_INDEX_SNAPSHOT}."))
+        self.stdout.write(f"Pruned {prune_file_changes()} old file changes.")
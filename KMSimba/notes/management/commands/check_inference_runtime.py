@@ -0,0 +1,60 @@
+from itertools import islice
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from notes import inference
+from notes.models import File, Passage
+from notes.passages import with_text
+from notes.utils import detect_objects
+
+# Questions asked of every sampled passage; the answers only have to agree with eager.
+QUESTIONS = ("What is this about?", "Who is mentioned?", "When did it happen?", "Where did it happen?")
+IMAGE_SUFFIXES = ('.jpg', '.jpeg', '.png')
+
+
+class Command(BaseCommand):
+    help = ("Compare a QA / YOLOS inference runtime with eager PyTorch on stored passages and images, "
+            "and fail if the answers or detected labels drift past the thresholds.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runtime', choices=inference.RUNTIMES,
+                            help="Runtime to check; by default the one INFERENCE_RUNTIME configures for each model.")
+        parser.add_argument('--passages', type=int, default=50)
+        parser.add_argument('--images', type=int, default=20)
+        parser.add_argument('--min-exact-match', type=float, default=0.9)
+        parser.add_argument('--min-label-overlap', type=float, default=0.9)
+
+    def handle(self, *args, **options):
+        failures = []
+
+        qa_runtime = options['runtime'] or inference.runtime('qa')
+        passages = with_text(Passage.objects.order_by('?')).values_list('text', flat=True)[:options['passages']]
+        samples = [(question, text) for text in passages for question in QUESTIONS]
+        if qa_runtime != 'eager' and samples:
+            exact_match = inference.qa_parity(
+                inference.load_question_answerer(settings.QA_MODEL),
+                inference.load_question_answerer(settings.QA_MODEL, qa_runtime),
+                samples,
+            )
+            self.stdout.write(f"QA {qa_runtime}: exact match with eager {exact_match:.1%} over {len(samples)} questions.")
+            if exact_match < options['min_exact_match']:
+                failures.append(f"QA exact match {exact_match:.1%}")
+
+        yolos_runtime = options['runtime'] or inference.runtime('yolos')
+        files = File.objects.order_by('?').only('file_name', 'file_content').iterator()
+        images = [f.file_content.path for f in islice(
+            (f for f in files if f.file_name.lower().endswith(IMAGE_SUFFIXES)), options['images'],
+        )]
+        if yolos_runtime != 'eager' and images:
+            overlap = inference.detection_parity(
+                detect_objects(images, detector=inference.load_detector(settings.YOLOS_MODEL)),
+                detect_objects(images, detector=inference.load_detector(settings.YOLOS_MODEL, yolos_runtime)),
+            )
+            self.stdout.write(f"YOLOS {yolos_runtime}: label overlap with eager {overlap:.1%} over {len(images)} images.")
+            if overlap < options['min_label_overlap']:
+                failures.append(f"YOLOS label overlap {overlap:.1%}")
+
+        if failures:
+            raise CommandError("Runtime differs from eager: " + ", ".join(failures))
+        self.stdout.write(self.style.SUCCESS("Inference runtimes agree with eager."))
@@ -0,0 +1,24 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from notes import inference
+
+
+class Command(BaseCommand):
+    help = ("Export the QA and YOLOS models to ONNX, plain and int8, into TRANSFORMERS_CACHE so "
+            "workers using an ONNX INFERENCE_RUNTIME do not export them on first use.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', action='append', dest='models', choices=['qa', 'yolos'],
+                            help="Model to export (repeatable); both by default.")
+
+    def handle(self, *args, **options):
+        loaders = {
+            'qa': (inference.load_question_answerer, settings.QA_MODEL),
+            'yolos': (inference.load_detector, settings.YOLOS_MODEL),
+        }
+        for name in options['models'] or loaders:
+            load, model_id = loaders[name]
+            # The int8 export is quantized from the plain one, so this builds both.
+            load(model_id, 'onnx-int8')
+            self.stdout.write(self.style.SUCCESS(f"Exported {model_id} to {inference.artifact_dir(model_id)}."))
@@ -0,0 +1,31 @@
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+
+from notes.models import File, FileTag
+from notes.utils import bm25_term_weight, corpus_generation, corpus_stats
+
+
+class Command(BaseCommand):
+    help = "Recompute the stored BM25 weight of every file tag against the current average document length."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        avg_doc_length = corpus_stats(corpus_generation())['avg_doc_length']
+        updated = 0
+        batch = []
+        file_tags = FileTag.objects.only('id', 'term_frequency', 'file_id')
+        doc_lengths = dict(File.objects.values_list('id', 'doc_length'))
+        for file_tag in file_tags.iterator(chunk_size=options['batch_size']):
+            file_tag.weight = bm25_term_weight(file_tag.term_frequency, doc_lengths[file_tag.file_id], avg_doc_length)
+            batch.append(file_tag)
+            if len(batch) >= options['batch_size']:
+                FileTag.objects.bulk_update(batch, ['weight'])
+                updated += len(batch)
+                batch = []
+        FileTag.objects.bulk_update(batch, ['weight'])
+        updated += len(batch)
+        self.stdout.write(self.style.SUCCESS(f"Updated {updated} tag weights (average document length {avg_doc_length:.1f})."))
+        # bulk_update sends no signals; running workers reload the new snapshot instead.
+        call_command('build_tag_index', stdout=self.stdout)
@@ -0,0 +1,20 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from notes.ingest import run_worker
+
+
+class Command(BaseCommand):
+    help = "Process queued file uploads on a local pool of worker processes."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=settings.INGEST_WORKER_PROCESSES)
+        parser.add_argument('--poll-interval', type=float, default=1.0)
+        parser.add_argument('--once', action='store_true', help="Exit once the queue is empty.")
+
+    def handle(self, *args, **options):
+        run_worker(
+            processes=options['processes'],
+            poll_interval=options['poll_interval'],
+            once=options['once'],
+        )
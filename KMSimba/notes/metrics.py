@@ -0,0 +1,455 @@
+"""Timings of the expensive steps, per-view request metrics and ``/metrics``.
+
+``timed(stage)`` is a context manager and a decorator (for functions,
+coroutines and async generators) that observes how long a block or call
+takes in ``kmsimba_stage_duration_seconds{stage=...}``. A call that raises
+is still observed, and also counted in ``kmsimba_stage_errors_total``.
+Extractors, model calls and index operations are wrapped with it, so the
+time of an upload or search breaks down by stage.
+
+``MetricsMiddleware`` observes every request in
+``kmsimba_request_duration_seconds{view,method,status}``, taken until the
+view returns its response (for a streamed response, the time to its
+headers). It also observes the number of database queries the request made,
+in ``kmsimba_request_db_queries{view}``. Queries are counted by an execute
+wrapper on every connection, into a counter held in a context variable. It
+therefore includes queries made through ``sync_to_async`` and through
+executors submitted with a copied context, but not those of unrelated
+threads.
+
+Values are kept in the process, where observing one is a bucket lookup and
+two additions under a lock, well under a microsecond. Gunicorn workers and
+the ingest worker's pool processes run separately, so each process writes
+its totals to its own file in ``METRICS_DIR``, every
+``METRICS_FLUSH_INTERVAL`` seconds from a daemon thread (never on the
+observing thread, which under ASGI is the event loop) and when it exits. ``metrics_view`` sums
+the files and serves them in the Prometheus text format, so a scrape sees
+every process whichever worker answers it. The values of other processes
+are therefore up to ``METRICS_FLUSH_INTERVAL`` old. Counters are totals over
+every process that has written to the directory: on a scrape, the files of
+processes that have exited are folded into the scraping process's own file,
+so the directory holds one file per live process without counters going
+back. Pids are only meaningful on one host, so ``METRICS_DIR`` must not be
+shared between hosts. Empty it when deploying to start again from zero.
+Without ``METRICS_DIR`` each process reports only itself.
+
+``benchmarks/bench_metrics_overhead.py`` measures the cost on the search
+paths.
+"""
+import atexit
+import bisect
+import contextvars
+import functools
+import glob
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+
+from . import profiler
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help_text, label_names):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        # Label values -> recorded values
+        self.series = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(labels), list(values)] for labels, values in self.series.items()]
+
+    def _labels(self, labels, extra=()):
+        pairs = [*zip(self.label_names, labels), *extra]
+        if not pairs:
+            return ''
+        escaped = (
+            (name, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+            for name, value in pairs
+        )
+        return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+class Counter(Metric):
+    kind = 'counter'
+    size = 1
+
+    def inc(self, labels, amount=1):
+        with self._lock:
+            values = self.series.get(labels)
+            if values is None:
+                values = self.series[labels] = [0]
+            values[0] += amount
+        _start_flusher()
+
+    def value(self, labels):
+        return self.series.get(tuple(labels), [0])[0]
+
+    def render(self, series):
+        for labels, values in series:
+            yield f"{self.name}_total{self._labels(labels)} {values[0]}"
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, label_names, buckets):
+        super().__init__(name, help_text, label_names)
+        self.buckets = tuple(float(bound) for bound in buckets)
+        self.size = len(self.buckets) + 2
+
+    def observe(self, labels, value):
+        # Values are [count per bucket, count above the last bucket, sum].
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            values = self.series.get(labels)
+            if values is None:
+                values = self.series[labels] = [0] * (self.size - 1) + [0.0]
+            values[index] += 1
+            values[-1] += value
+        _start_flusher()
+
+    def count(self, labels):
+        return sum(self.series.get(tuple(labels), [0.0])[:-1])
+
+    def render(self, series):
+        for labels, values in series:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float('inf')), values):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                yield f"{self.name}_bucket{self._labels(labels, [('le', le)])} {cumulative}"
+            yield f"{self.name}_sum{self._labels(labels)} {values[-1]}"
+            yield f"{self.name}_count{self._labels(labels)} {cumulative}"
+
+
+_metrics = []
+
+REQUEST_SECONDS = Histogram(
+    'kmsimba_request_duration_seconds', "Time until the view returned its response.",
+    ['view', 'method', 'status'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+REQUEST_QUERIES = Histogram(
+    'kmsimba_request_db_queries', "Database queries made by a request.",
+    ['view'],
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500),
+)
+STAGE_SECONDS = Histogram(
+    'kmsimba_stage_duration_seconds', "Time spent in an extractor, model call or index operation.",
+    ['stage'],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300),
+)
+STAGE_ERRORS = Counter('kmsimba_stage_errors', "Stage calls that raised.", ['stage'])
+
+# This process's file in METRICS_DIR
+_file = None
+# Totals taken over from the files of exited processes: {name: {labels: values}}
+_adopted = {}
+_flush_lock = threading.Lock()
+_flusher_started = False
+_flusher_lock = threading.Lock()
+
+
+def _forked():
+    # The child starts with its parent's values, which the parent's file already reports.
+    # Threads do not survive a fork, so it also starts its own flusher.
+    global _file, _adopted, _flusher_started
+    for metric in _metrics:
+        metric.series = {}
+        metric._lock = threading.Lock()
+    _file, _adopted, _flusher_started = None, {}, False
+
+
+os.register_at_fork(after_in_child=_forked)
+
+
+def flush():
+    """Write this process's values to its file in ``METRICS_DIR``.
+
+    Pool processes end with ``os._exit``, skipping ``atexit``, so work run in
+    one flushes when it is done.
+    """
+    global _file
+    if not settings.METRICS_DIR:
+        return
+    with _flush_lock:
+        if _file is None:
+            os.makedirs(settings.METRICS_DIR, exist_ok=True)
+            _file = os.path.join(settings.METRICS_DIR, f"{os.getpid()}-{uuid.uuid4().hex[:8]}.json")
+        data = _snapshot()
+        partial = f"{_file}.partial"
+        try:
+            with open(partial, 'w') as f:
+                json.dump(data, f)
+            os.replace(partial, _file)
+        except OSError as e:
+            logger.error(f"Error writing metrics to {_file}: {e}")
+
+
+def _run_flusher():
+    while True:
+        time.sleep(settings.METRICS_FLUSH_INTERVAL)
+        flush()
+
+
+def _start_flusher():
+    global _flusher_started
+    if _flusher_started:
+        return
+    with _flusher_lock:
+        if not _flusher_started:
+            threading.Thread(target=_run_flusher, name='metrics-flush', daemon=True).start()
+            _flusher_started = True
+
+
+atexit.register(flush)
+
+
+def _add(totals, series, size):
+    for labels, values in series:
+        # Series recorded with other buckets (an older deploy) cannot be added up.
+        if len(values) == size:
+            total = totals.get(tuple(labels), [0] * size)
+            totals[tuple(labels)] = [a + b for a, b in zip(total, values)]
+
+
+def _snapshot():
+    data = {}
+    for metric in _metrics:
+        totals = dict(_adopted.get(metric.name, {}))
+        _add(totals, metric.snapshot(), metric.size)
+        data[metric.name] = [[list(labels), values] for labels, values in totals.items()]
+    return data
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _adopt_exited():
+    """Fold the files of exited processes into this process's file."""
+    sizes = {metric.name: metric.size for metric in _metrics}
+    claimed = []
+    for path in glob.glob(os.path.join(settings.METRICS_DIR, '*.json')):
+        try:
+            pid = int(os.path.basename(path).split('-', 1)[0])
+        except ValueError:
+            continue
+        if pid == os.getpid() or _alive(pid):
+            continue
+        # The rename is atomic, so only one scraping process takes a file over.
+        adopted = f"{path}.adopted-{os.getpid()}"
+        try:
+            os.rename(path, adopted)
+        except OSError:
+            continue
+        claimed.append(adopted)
+        try:
+            with open(adopted) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        with _flush_lock:
+            for name, series in data.items():
+                if name in sizes:
+                    _add(_adopted.setdefault(name, {}), series, sizes[name])
+    if claimed:
+        flush()
+        for path in claimed:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def collect():
+    """``{metric name: [[labels, values], ...]}`` summed over every process."""
+    if not settings.METRICS_DIR:
+        return {metric.name: metric.snapshot() for metric in _metrics}
+    flush()
+    if os.name == 'posix':  # os.kill(pid, 0) would terminate the process on Windows
+        _adopt_exited()
+    merged = {metric.name: {} for metric in _metrics}
+    sizes = {metric.name: metric.size for metric in _metrics}
+    for path in glob.glob(os.path.join(settings.METRICS_DIR, '*.json')):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for name, series in data.items():
+            if name in merged:
+                _add(merged[name], series, sizes[name])
+    return {name: [[list(labels), values] for labels, values in series.items()] for name, series in merged.items()}
+
+
+def render():
+    data = collect()
+    lines = []
+    for metric in _metrics:
+        lines.append(f"# HELP {metric.name} {metric.help_text}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.render(sorted(data[metric.name])))
+    return '\n'.join(lines) + '\n'
+
+
+def observe_stage(stage, seconds, failed=False):
+    STAGE_SECONDS.observe((stage,), seconds)
+    if failed:
+        STAGE_ERRORS.inc((stage,))
+
+
+class timed:
+    """Observe the duration of a ``with`` block, or of every call of a decorated function, as ``stage``."""
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.seconds = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.seconds = time.perf_counter() - self._start
+        observe_stage(self.stage, self.seconds, exc_type is not None)
+
+    def __call__(self, func):
+        stage = self.stage
+
+        if inspect.isasyncgenfunction(func):
+            # Timed until the generator is exhausted or closed; closing it early is not an error.
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                start, failed = time.perf_counter(), True
+                generator = func(*args, **kwargs)
+                try:
+                    async for item in generator:
+                        yield item
+                    failed = False
+                except GeneratorExit:
+                    failed = False
+                    raise
+                finally:
+                    await generator.aclose()
+                    observe_stage(stage, time.perf_counter() - start, failed)
+        elif inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                start, failed = time.perf_counter(), True
+                try:
+                    result = await func(*args, **kwargs)
+                    failed = False
+                    return result
+                finally:
+                    observe_stage(stage, time.perf_counter() - start, failed)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start, failed = time.perf_counter(), True
+                try:
+                    result = func(*args, **kwargs)
+                    failed = False
+                    return result
+                finally:
+                    observe_stage(stage, time.perf_counter() - start, failed)
+        return wrapper
+
+
+# ``[count]`` of queries of the current request, ``None`` outside one.
+_queries = contextvars.ContextVar('metrics_queries', default=None)
+
+
+def count_queries(execute, sql, params, many, context):
+    counter = _queries.get()
+    if counter is not None:
+        counter[0] += 1
+    return execute(sql, params, many, context)
+
+
+def install_query_counter(connection):
+    if count_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_queries)
+
+
+def _view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    # Unresolved paths share one label, so 404 scans cannot create new series.
+    return match.view_name if match else 'unmatched'
+
+
+class MetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def _record(self, request, response, start, queries, sample):
+        elapsed = time.perf_counter() - start
+        view = _view_name(request)
+        # No response means the view raised past Django's exception handling.
+        status = str(response.status_code) if response is not None else '500'
+        REQUEST_SECONDS.observe((view, request.method, status), elapsed)
+        REQUEST_QUERIES.observe((view,), queries[0])
+        if sample is not None:
+            profiler.finish(sample, elapsed, f"{request.method} {view}")
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        queries = [0]
+        token = _queries.set(queries)
+        sample = profiler.begin()
+        start, response = time.perf_counter(), None
+        try:
+            response = self.get_response(request)
+            return response
+        finally:
+            _queries.reset(token)
+            self._record(request, response, start, queries, sample)
+
+    async def __acall__(self, request):
+        queries = [0]
+        token = _queries.set(queries)
+        sample = profiler.begin()
+        start, response = time.perf_counter(), None
+        try:
+            response = await self.get_response(request)
+            return response
+        finally:
+            _queries.reset(token)
+            self._record(request, response, start, queries, sample)
+
+
+def metrics_view(request):
+    if request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+        return HttpResponseForbidden()
+    return HttpResponse(render(), content_type=CONTENT_TYPE)
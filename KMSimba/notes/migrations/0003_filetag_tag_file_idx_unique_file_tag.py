@@ -0,0 +1,34 @@
+# Generated by Django 4.2.5 on 2026-10-18 06:08
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def remove_duplicate_file_tags(apps, schema_editor):
+    FileTag = apps.get_model('notes', 'FileTag')
+    duplicates = (
+        FileTag.objects.values('file', 'tag')
+        .annotate(keep=Min('id'), rows=Count('id'))
+        .filter(rows__gt=1)
+    )
+    for row in duplicates:
+        FileTag.objects.filter(file=row['file'], tag=row['tag']).exclude(id=row['keep']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0002_file_filetag'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_file_tags, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='filetag',
+            index=models.Index(fields=['tag', 'file'], name='filetag_tag_file_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='filetag',
+            constraint=models.UniqueConstraint(fields=('file', 'tag'), name='unique_file_tag'),
+        ),
+    ]
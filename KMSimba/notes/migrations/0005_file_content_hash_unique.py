@@ -0,0 +1,81 @@
+# Generated by Django 4.2.5 on 2026-10-18 06:12
+
+from django.db import migrations, models, transaction
+import notes.models
+
+
+def merge_duplicate_files(apps, schema_editor):
+    """Keep the oldest File per content hash and move the others' tags onto it.
+
+    The stored blobs of the removed rows are deleted through the storage once
+    the migration commits, except those still referenced by a kept row, so
+    no orphaned files are left in MEDIA_ROOT.
+    """
+    File = apps.get_model('notes', 'File')
+    FileTag = apps.get_model('notes', 'FileTag')
+    storage = File._meta.get_field('file_content').storage
+    duplicates = (
+        File.objects.values('content_hash')
+        .annotate(keep=models.Min('id'), rows=models.Count('id'))
+        .filter(rows__gt=1)
+    )
+    removed_blobs = set()
+    for row in duplicates:
+        extra = File.objects.filter(content_hash=row['content_hash']).exclude(id=row['keep'])
+        kept_tags = set(FileTag.objects.filter(file_id=row['keep']).values_list('tag_id', flat=True))
+        FileTag.objects.bulk_create(
+            [
+                FileTag(file_id=row['keep'], tag_id=tag_id)
+                for tag_id in set(FileTag.objects.filter(file__in=extra).values_list('tag_id', flat=True)) - kept_tags
+            ]
+        )
+        removed_blobs.update(name for name in extra.values_list('file_content', flat=True) if name)
+        extra.delete()
+    removed_blobs -= set(File.objects.filter(file_content__in=removed_blobs).values_list('file_content', flat=True))
+
+    def delete_blobs():
+        for name in removed_blobs:
+            storage.delete(name)
+
+    transaction.on_commit(delete_blobs, using=schema_editor.connection.alias)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0004_ingestjob'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_files, migrations.RunPython.noop),
+        migrations.AddField(
+            model_name='file',
+            name='detected_labels',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='file',
+            name='extracted_text',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='ingestjob',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+        migrations.AlterField(
+            model_name='file',
+            name='content_hash',
+            field=models.CharField(max_length=64, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='file',
+            name='file_content',
+            field=models.FileField(max_length=255, upload_to=notes.models.content_addressed_path),
+        ),
+        migrations.AlterField(
+            model_name='ingestjob',
+            name='upload',
+            field=models.FileField(blank=True, upload_to='ingest/'),
+        ),
+    ]
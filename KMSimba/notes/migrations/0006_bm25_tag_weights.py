@@ -0,0 +1,55 @@
+# Generated by Django 4.2.5 on 2026-10-18 06:16
+
+from django.db import migrations, models
+from django.db.models import Avg, Count
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def backfill_bm25(apps, schema_editor):
+    """Existing links have no counts, so treat every tag as occurring once."""
+    File = apps.get_model('notes', 'File')
+    FileTag = apps.get_model('notes', 'FileTag')
+    for file in File.objects.annotate(tags=Count('filetag')).iterator():
+        File.objects.filter(id=file.id).update(doc_length=file.tags)
+    avg_doc_length = File.objects.aggregate(avg=Avg('doc_length'))['avg']
+    if not avg_doc_length:
+        return
+    for file in File.objects.filter(doc_length__gt=0).iterator():
+        length_norm = 1 - BM25_B + BM25_B * file.doc_length / avg_doc_length
+        FileTag.objects.filter(file_id=file.id).update(weight=(BM25_K1 + 1) / (1 + BM25_K1 * length_norm))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0005_file_content_hash_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file',
+            name='doc_length',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='filetag',
+            name='term_frequency',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='filetag',
+            name='weight',
+            field=models.FloatField(default=1.0),
+        ),
+        migrations.RunPython(backfill_bm25, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='filetag',
+            name='filetag_tag_file_idx',
+        ),
+        migrations.AddIndex(
+            model_name='filetag',
+            index=models.Index(fields=['tag', 'file', 'weight'], name='filetag_tag_file_weight_idx'),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 4.2.5 on 2026-10-18 06:35
+
+import hashlib
+import os
+
+from django.core.files.base import ContentFile
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def link_note_files(apps, schema_editor):
+    """Turn the text files notes pointed at by path into ``File`` rows."""
+    File = apps.get_model('notes', 'File')
+    Note = apps.get_model('notes', 'Note')
+    for note in Note.objects.exclude(file_path__isnull=True).exclude(file_path='').iterator():
+        if not os.path.isfile(note.file_path):
+            continue
+        with open(note.file_path, 'rb') as f:
+            data = f.read()
+        content_hash = hashlib.sha256(data).hexdigest()
+        file = File.objects.filter(content_hash=content_hash).first()
+        if file is None:
+            file_name = os.path.basename(note.file_path)
+            file = File(file_name=file_name[:255], content_hash=content_hash, extracted_text=note.content)
+            file.file_content.save(file_name, ContentFile(data), save=False)
+            file.save()
+        Note.objects.filter(id=note.id).update(source_file=file)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0006_bm25_tag_weights'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='note',
+            name='source_file',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='notes', to='notes.file'),
+        ),
+        migrations.RunPython(link_note_files, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='note',
+            name='file_path',
+        ),
+    ]
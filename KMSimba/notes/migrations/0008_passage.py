@@ -0,0 +1,52 @@
+# Generated by Django 4.2.5 on 2026-10-18 06:37
+
+import re
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+PASSAGE_WORDS = 200
+PASSAGE_OVERLAP_WORDS = 50
+
+
+def split_existing_notes(apps, schema_editor):
+    Note = apps.get_model('notes', 'Note')
+    Passage = apps.get_model('notes', 'Passage')
+    stride = PASSAGE_WORDS - PASSAGE_OVERLAP_WORDS
+    batch = []
+    for note in Note.objects.only('id', 'content').iterator():
+        words = [(match.start(), match.end()) for match in re.finditer(r'\S+', note.content)]
+        for position, first in enumerate(range(0, len(words), stride)):
+            last = min(first + PASSAGE_WORDS, len(words)) - 1
+            batch.append(Passage(note_id=note.id, position=position, start=words[first][0], end=words[last][1]))
+            if last == len(words) - 1:
+                break
+        if len(batch) >= 1000:
+            Passage.objects.bulk_create(batch)
+            batch = []
+    Passage.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0007_note_source_file'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Passage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveIntegerField()),
+                ('start', models.PositiveIntegerField()),
+                ('end', models.PositiveIntegerField()),
+                ('note', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='passages', to='notes.note')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='passage',
+            constraint=models.UniqueConstraint(fields=('note', 'position'), name='unique_note_passage'),
+        ),
+        migrations.RunPython(split_existing_notes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.5 on 2026-10-18 08:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0009_uploadsession'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FileChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file_id', models.IntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.5 on 2026-10-18 08:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0010_filechange'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadsession',
+            name='writing_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.5 on 2026-10-18 08:10
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0011_uploadsession_writing_until'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='file',
+            name='detected_labels',
+        ),
+    ]
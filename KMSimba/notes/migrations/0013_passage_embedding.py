@@ -0,0 +1,18 @@
+# Generated by Django 4.2.5 on 2026-10-18 08:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0012_remove_file_detected_labels'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='passage',
+            name='embedding',
+            field=models.BinaryField(null=True),
+        ),
+    ]
@@ -1,8 +1,31 @@
+import os
+import uuid
+
 from django.db import models
+from django.utils import timezone
+
+
+def content_addressed_path(instance, filename):
+    # files/ab/abcdef.../name.pdf: one directory per distinct content
+    return os.path.join('files', instance.content_hash[:2], instance.content_hash, filename)
 
 class Note(models.Model):
     content = models.TextField()
-    file_path = models.TextField(blank=True, null=True)
+    source_file = models.ForeignKey('File', on_delete=models.SET_NULL, null=True, blank=True, related_name='notes')
+
+class Passage(models.Model):
+    """A window of a note, as character offsets into ``note.content``."""
+    note = models.ForeignKey(Note, on_delete=models.CASCADE, related_name='passages')
+    position = models.PositiveIntegerField()
+    start = models.PositiveIntegerField()
+    end = models.PositiveIntegerField()
+    # float16 vector for the dense index, embedded at ingest (see notes.passages.embed_passages)
+    embedding = models.BinaryField(null=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['note', 'position'], name='unique_note_passage'),
+        ]
 
 class Tag(models.Model):
     name = models.CharField(max_length=255, unique=True)
@@ -11,15 +34,89 @@ class Tag(models.Model):
 
 class File(models.Model):
     file_name = models.CharField(max_length=255)
-    file_content = models.FileField(upload_to='')
-    content_hash = models.CharField(max_length=64)
+    file_content = models.FileField(upload_to=content_addressed_path, max_length=255)
+    content_hash = models.CharField(max_length=64, unique=True)
+    extracted_text = models.TextField(blank=True)  # Detected object labels included
+    doc_length = models.PositiveIntegerField(default=0)  # Tag occurrences, for BM25
 
     def __str__(self):
         return self.file_name
 
+class FileChange(models.Model):
+    """A file whose row or tags changed, for the tag indexes of other processes (see ``notes.tag_index``)."""
+    file_id = models.IntegerField()  # Not a foreign key: deletions are logged too
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
 class FileTag(models.Model):
     file = models.ForeignKey(File, on_delete=models.CASCADE)
     tag = models.ForeignKey(Tag, on_delete=models.CASCADE)
+    term_frequency = models.PositiveIntegerField(default=1)
+    # BM25 term factor tf * (k1 + 1) / (tf + k1 * (1 - b + b * dl / avgdl)),
+    # precomputed so a search only multiplies it by the tag's idf.
+    weight = models.FloatField(default=1.0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['file', 'tag'], name='unique_file_tag'),
+        ]
+        indexes = [
+            # Covers tag search: postings of a tag with their weights, no row lookups.
+            models.Index(fields=['tag', 'file', 'weight'], name='filetag_tag_file_weight_idx'),
+        ]
 
     def __str__(self):
         return f"{self.file} - {self.tag}"
+
+
+class IngestJob(models.Model):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    original_name = models.CharField(max_length=255)
+    upload = models.FileField(upload_to='ingest/', blank=True)
+    content_hash = models.CharField(max_length=64, blank=True, db_index=True)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=QUEUED)
+    stage = models.CharField(max_length=64, blank=True)
+    progress = models.PositiveSmallIntegerField(default=0)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=3)
+    error = models.TextField(blank=True)
+    result_file = models.ForeignKey(File, null=True, blank=True, on_delete=models.SET_NULL)
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_after'], name='ingestjob_status_run_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.original_name} ({self.status})"
+
+
+class UploadSession(models.Model):
+    """A chunked upload in progress; its bytes live in ``path`` until ``job`` takes them."""
+    token = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    original_name = models.CharField(max_length=255)
+    size = models.PositiveBigIntegerField()
+    received = models.PositiveBigIntegerField(default=0)
+    expected_hash = models.CharField(max_length=64, blank=True)  # SHA-256 declared by the client
+    content_hash = models.CharField(max_length=64, blank=True)
+    path = models.CharField(max_length=255)  # Storage name of the partial file
+    writing_until = models.DateTimeField(null=True, blank=True)  # Lease of the chunk being written
+    job = models.ForeignKey(IngestJob, null=True, blank=True, on_delete=models.SET_NULL)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.original_name} ({self.received}/{self.size})"
@@ -0,0 +1,133 @@
+"""Process-wide TF-IDF index over note passages.
+
+Rows are ``Passage`` ids (see ``notes.passages``), so a search returns the
+windows of notes that match rather than whole notes. The index is loaded from
+the published generation (see ``index_store``) on the first search and caught
+up with passages saved since, including passages saved by other processes.
+A process that never searched (e.g. an ingest worker) keeps no index and
+leaves its passages to be caught up by the web workers.
+
+Passage ids are allocated at insert but become visible at commit, so a slow
+transaction (e.g. an ingest job) can commit ids below one already indexed.
+Like ``tag_index.catch_up``, each catch-up reads the ids of the last
+``PASSAGE_INDEX_CATCH_UP_WINDOW`` passages again and indexes the ones not seen
+before, so a late passage is not skipped, nor left out of later generations.
+
+``SEMANTIC_SEARCH_BACKEND`` picks the index: exact TF-IDF cosine
+(``search_index``) or dense embeddings with approximate search
+(``dense_index``). Both publish generations through ``index_store``, each
+under its own directory. The dense index is caught up from the vectors
+stored at ingest, never by embedding on the search path.
+"""
+import logging
+import threading
+
+from django.conf import settings
+from django.db import OperationalError, ProgrammingError
+from django.db.models import Q
+
+from . import index_store
+from .models import Passage
+from .passages import with_text
+from .dense_index import DenseIndex, decode_embeddings
+from .metrics import timed
+from .search_index import IncrementalTfidfIndex
+
+logger = logging.getLogger(__name__)
+
+CATCH_UP_BATCH_SIZE = 2000
+
+passage_index = IncrementalTfidfIndex()
+_index_loaded = False
+# Ids within PASSAGE_INDEX_CATCH_UP_WINDOW of passage_index.max_doc_id already read
+_recent_ids = set()
+_publish_lock = threading.Lock()
+_sync_lock = threading.Lock()
+
+def index_backend():
+    """Return ``(index class, index directory)`` for ``SEMANTIC_SEARCH_BACKEND``."""
+    if settings.SEMANTIC_SEARCH_BACKEND == 'dense':
+        return DenseIndex, settings.DENSE_INDEX_DIR
+    return IncrementalTfidfIndex, settings.PASSAGE_INDEX_DIR
+
+@timed('passage_index_publish')
+def publish_passage_index():
+    if not _publish_lock.acquire(blocking=False):
+        return
+    try:
+        index_store.publish(passage_index, index_backend()[1])
+        load_passage_index()
+    except OSError as e:
+        logger.error(f"Error publishing passage index: {e}")
+    finally:
+        _publish_lock.release()
+
+@timed('passage_search')
+def semantic_search(query, top_k=5, offset=0, min_score=0.0):
+    """Return ``[(passage_id, score), ...]``; text is loaded by ``passages.fetch_passages``."""
+    if not len(passage_index):
+        logger.warning("Passage index is empty. Skipping search.")
+        return []
+    return passage_index.search(query, top_k, offset=offset, min_score=min_score)
+
+def load_passage_index():
+    global passage_index, _index_loaded, _recent_ids
+    index_class, root = index_backend()
+    index = index_store.load(root, index_class)
+    passage_index = index if index is not None else index_class()
+    _recent_ids = passage_index.doc_ids_above(passage_index.max_doc_id - settings.PASSAGE_INDEX_CATCH_UP_WINDOW)
+    _index_loaded = True
+    catch_up_passage_index()
+
+@timed('passage_index_catch_up')
+def catch_up_passage_index():
+    """Index passages saved after the loaded generation, e.g. by other workers."""
+    global _recent_ids
+    if not _index_loaded:
+        return
+    try:
+        with _sync_lock:
+            max_doc_id = passage_index.max_doc_id
+            low = max(max_doc_id - settings.PASSAGE_INDEX_CATCH_UP_WINDOW, 0)
+            window = list(Passage.objects.filter(id__gt=low, id__lte=max_doc_id).values_list('id', flat=True))
+            late = [passage_id for passage_id in window if passage_id not in _recent_ids]
+            passages = Passage.objects.filter(Q(id__gt=max_doc_id) | Q(id__in=late)).order_by('id')
+            if isinstance(passage_index, DenseIndex):
+                rows, add = passages.values_list('id', 'embedding'), _add_embeddings
+            else:
+                rows, add = with_text(passages).values_list('id', 'text'), passage_index.add_many
+            read, ids, values = window, [], []
+            for passage_id, value in rows.iterator(chunk_size=CATCH_UP_BATCH_SIZE):
+                ids.append(passage_id)
+                values.append(value)
+                if len(ids) >= CATCH_UP_BATCH_SIZE:
+                    add(ids, values)
+                    read.extend(ids)
+                    ids, values = [], []
+            add(ids, values)
+            read.extend(ids)
+            low = passage_index.max_doc_id - settings.PASSAGE_INDEX_CATCH_UP_WINDOW
+            _recent_ids = {passage_id for passage_id in (*_recent_ids, *read) if passage_id > low}
+            if not len(passage_index):
+                logger.info("No passages found in the database. Skipping corpus encoding.")
+    except (OperationalError, ProgrammingError) as e:
+        logger.warning(f"Database error: {e}")
+    if passage_index.delta_size >= settings.PASSAGE_INDEX_PUBLISH_EVERY and not _publish_lock.locked():
+        threading.Thread(target=publish_passage_index, daemon=True).start()
+
+def _add_embeddings(ids, embeddings):
+    stored = [(passage_id, embedding) for passage_id, embedding in zip(ids, embeddings) if embedding is not None]
+    if len(stored) < len(ids):
+        logger.warning(f"{len(ids) - len(stored)} passages have no embedding; run build_note_index to embed them")
+    if stored:
+        passage_index.add_vectors([passage_id for passage_id, _ in stored], decode_embeddings([e for _, e in stored]))
+    if ids:
+        passage_index.skip_to(ids[-1])
+
+def sync_passage_index():
+    index_class, root = index_backend()
+    if not _index_loaded or not isinstance(passage_index, index_class) \
+            or index_store.current_generation(root) != passage_index.generation:
+        load_passage_index()
+    else:
+        catch_up_passage_index()
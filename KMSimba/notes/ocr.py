@@ -0,0 +1,114 @@
+"""OCR for images and scanned PDF pages.
+
+Pages that already carry a text layer (found by ``pdfplumber``) are skipped.
+The remaining pages are rasterized and OCR'd on a process pool, one page per
+task, after being converted to grayscale, downscaled and binarized. Results
+are cached by a hash of the page pixels, so the same page is never OCR'd
+twice.
+
+OCR runs inside ingest pool processes, which already keep every core busy
+between them. Each one is limited to its share of the cores
+(``limit_processes``), so with the default of one ingest process per core
+pages are OCR'd inline rather than on N pools of N processes.
+"""
+import hashlib
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pytesseract
+from django.conf import settings
+from django.core.cache import caches
+from PIL import Image
+
+from . import metrics
+from .metrics import timed
+
+logger = logging.getLogger(__name__)
+
+# Tesseract gains little above ~3500 px on the long edge but slows down a lot.
+OCR_MAX_EDGE = 3500
+OCR_CACHE_TIMEOUT = 60 * 60 * 24 * 30
+
+if os.name == 'nt':
+    pytesseract.pytesseract.tesseract_cmd = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
+
+_max_processes = None
+
+
+def limit_processes(count):
+    """Cap the OCR processes this process starts at ``count`` (``None`` lifts the cap)."""
+    global _max_processes
+    _max_processes = count
+
+
+def _cache():
+    return caches[settings.OCR_CACHE_ALIAS]
+
+
+def preprocess(image):
+    """Grayscale, cap the long edge at ``OCR_MAX_EDGE`` and binarize."""
+    image = image.convert('L')
+    scale = OCR_MAX_EDGE / max(image.size)
+    if scale < 1:
+        image = image.resize((int(image.width * scale), int(image.height * scale)), Image.LANCZOS)
+    return image.point(lambda value: 255 if value > 160 else 0, mode='1')
+
+
+@timed('ocr')
+def ocr_image(image):
+    """OCR a PIL image, using the page-hash cache."""
+    key = 'ocr:' + hashlib.blake2b(image.tobytes(), digest_size=20).hexdigest()
+    cache = _cache()
+    text = cache.get(key)
+    if text is None:
+        text = pytesseract.image_to_string(preprocess(image))
+        cache.set(key, text, OCR_CACHE_TIMEOUT)
+    return text
+
+
+def _init_process():
+    import django
+    from django.apps import apps
+    if not apps.ready:
+        django.setup()
+
+
+def _ocr_pdf_page(path, page_number, dpi):
+    import fitz
+
+    with fitz.open(path) as doc:
+        pix = doc.load_page(page_number).get_pixmap(dpi=dpi, colorspace=fitz.csRGB, alpha=False)
+    try:
+        return ocr_image(Image.frombytes('RGB', (pix.width, pix.height), pix.samples))
+    finally:
+        metrics.flush()
+
+
+@timed('pdf_ocr')
+def ocr_pdf_pages(path, page_texts, processes=None):
+    """Return ``page_texts`` with every page lacking a text layer OCR'd.
+
+    ``page_texts`` holds the text ``pdfplumber`` found per page.
+    """
+    missing = [number for number, text in enumerate(page_texts) if not text.strip()]
+    if not missing:
+        return list(page_texts)
+
+    dpi = settings.OCR_DPI
+    processes = processes or settings.OCR_PROCESSES or os.cpu_count() or 1
+    processes = min(processes, _max_processes or processes, len(missing))
+    results = list(page_texts)
+    if processes == 1:
+        for number in missing:
+            results[number] = _ocr_pdf_page(path, number, dpi)
+        return results
+
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_process) as pool:
+        futures = {number: pool.submit(_ocr_pdf_page, path, number, dpi) for number in missing}
+        for number, future in futures.items():
+            try:
+                results[number] = future.result()
+            except Exception as e:
+                logger.error(f"Error running OCR on page {number + 1}: {e}")
+    return results
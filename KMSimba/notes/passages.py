@@ -0,0 +1,113 @@
+"""Passages: overlapping word windows over notes.
+
+Notes are split into windows of ``PASSAGE_WORDS`` words that overlap by
+``PASSAGE_OVERLAP_WORDS``; only the character offsets are stored in
+``Passage`` and the text is sliced out of the note by the database when it is
+needed. Search ranks passages, and ``build_context`` packs the best of them
+into a prompt of bounded size however long the notes are.
+
+With the dense backend every passage is also embedded as it is saved
+(``embed_passages``), which is slow enough that callers do it before opening
+their transaction.
+"""
+import math
+import re
+
+from django.conf import settings
+from django.db.models import F
+from django.db.models.functions import Substr
+
+from .dense_index import embed_texts, encode_embedding
+from .models import Passage
+
+WORD_RE = re.compile(r'\S+')
+
+
+def passage_spans(text, words=None, overlap=None):
+    """Return ``[(start, end), ...]`` character offsets of the windows over ``text``."""
+    words = words or settings.PASSAGE_WORDS
+    overlap = settings.PASSAGE_OVERLAP_WORDS if overlap is None else overlap
+    stride = max(words - overlap, 1)
+    matches = [(match.start(), match.end()) for match in WORD_RE.finditer(text)]
+    spans = []
+    for first in range(0, len(matches), stride):
+        last = min(first + words, len(matches)) - 1
+        spans.append((matches[first][0], matches[last][1]))
+        if last == len(matches) - 1:
+            break
+    return spans
+
+
+def embed_passages(contents):
+    """Stored embeddings of the passages of notes with ``contents``, or ``None`` without the dense backend."""
+    if settings.SEMANTIC_SEARCH_BACKEND != 'dense':
+        return None
+    texts = [content[start:end] for content in contents for start, end in passage_spans(content)]
+    return [encode_embedding(vector) for vector in embed_texts(texts)] if texts else []
+
+
+def create_passages(notes, embeddings=None):
+    """Bulk-create the passages of saved ``notes``, with ``embeddings`` from ``embed_passages``."""
+    if embeddings is None:
+        embeddings = embed_passages([note.content for note in notes])
+    passages = [
+        Passage(note=note, position=position, start=start, end=end)
+        for note in notes
+        for position, (start, end) in enumerate(passage_spans(note.content))
+    ]
+    if embeddings is not None:
+        for passage, embedding in zip(passages, embeddings):
+            passage.embedding = embedding
+    Passage.objects.bulk_create(passages, batch_size=1000)
+    return passages
+
+
+def with_text(passages):
+    """Annotate a ``Passage`` queryset with its ``text``, sliced by the database."""
+    return passages.annotate(text=Substr('note__content', F('start') + 1, F('end') - F('start')))
+
+
+def fetch_passages(results):
+    """Load ``[(passage_id, score), ...]`` as passages carrying ``text`` and ``score``, best first."""
+    passages = with_text(Passage.objects.only('id', 'note_id', 'start', 'end')).in_bulk([passage_id for passage_id, _ in results])
+    fetched = []
+    for passage_id, score in results:
+        if passage_id in passages:
+            passage = passages[passage_id]
+            passage.score = score
+            fetched.append(passage)
+    return fetched
+
+
+def estimate_tokens(text):
+    # English text averages roughly 4 tokens per 3 words with BPE tokenizers.
+    return math.ceil(len(WORD_RE.findall(text)) * 4 / 3)
+
+
+def build_context(passages, max_tokens=None):
+    """Join the best ``passages`` into a context of at most ``max_tokens`` tokens.
+
+    Passages are taken in score order until the budget is spent; overlapping
+    windows of the same note are merged so shared words are only sent once.
+    The result keeps the notes' reading order.
+    """
+    max_tokens = max_tokens or settings.QA_CONTEXT_TOKENS
+    selected = []
+    used = 0
+    for passage in passages:
+        tokens = estimate_tokens(passage.text)
+        if used + tokens > max_tokens:
+            continue
+        selected.append(passage)
+        used += tokens
+
+    blocks = []
+    for passage in sorted(selected, key=lambda p: (p.note_id, p.start)):
+        last = blocks[-1] if blocks else None
+        if last and last['note_id'] == passage.note_id and passage.start <= last['end']:
+            if passage.end > last['end']:
+                last['text'] += passage.text[last['end'] - passage.start:]
+                last['end'] = passage.end
+        else:
+            blocks.append({'note_id': passage.note_id, 'end': passage.end, 'text': passage.text})
+    return "\n\n".join(block['text'] for block in blocks)
@@ -0,0 +1,107 @@
+"""Sampling profiles of slow requests.
+
+Off unless ``PROFILE_SLOW_REQUEST_MS`` is set. Then ``MetricsMiddleware``
+registers the thread each request runs on with a sampler thread. Every
+``PROFILE_SAMPLE_INTERVAL_MS`` the sampler records that thread's Python stack
+from ``sys._current_frames()``. A request slower than the threshold has its
+samples written to ``PROFILE_DIR`` as collapsed stacks, one
+``frame;frame;... count`` line per stack, which flamegraph.pl and
+speedscope read. Samples of faster requests are dropped. The sampler sleeps
+while no request is in flight.
+
+An async view runs on the event loop's thread, so its profile also shows
+whatever else the loop ran in the meantime.
+"""
+import functools
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_active = set()
+_lock = threading.Lock()
+_wakeup = threading.Event()
+_sampler = None
+_sampler_pid = None
+
+
+class Sample:
+    __slots__ = ('thread_id', 'stacks')
+
+    def __init__(self, thread_id):
+        self.thread_id = thread_id
+        self.stacks = Counter()
+
+
+@functools.lru_cache(maxsize=4096)
+def _frame_name(code):
+    path = code.co_filename
+    if path.startswith(str(settings.BASE_DIR)):
+        path = os.path.relpath(path, settings.BASE_DIR)
+    else:
+        path = os.path.join(*path.split(os.sep)[-2:])
+    return f"{code.co_name} ({path}:{code.co_firstlineno})"
+
+
+def _stack(frame):
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame.f_code))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def _run():
+    while True:
+        _wakeup.wait()
+        with _lock:
+            if not _active:
+                _wakeup.clear()
+                continue
+            frames = sys._current_frames()
+            for sample in _active:
+                frame = frames.get(sample.thread_id)
+                if frame is not None:
+                    sample.stacks[_stack(frame)] += 1
+            del frames
+        time.sleep(settings.PROFILE_SAMPLE_INTERVAL_MS / 1000)
+
+
+def begin():
+    """Start sampling the current thread; ``None`` when profiling is off."""
+    global _sampler, _sampler_pid
+    if not settings.PROFILE_SLOW_REQUEST_MS:
+        return None
+    sample = Sample(threading.get_ident())
+    with _lock:
+        # Threads do not survive a fork, so each worker starts its own sampler.
+        if _sampler_pid != os.getpid():
+            _sampler = threading.Thread(target=_run, name='profiler', daemon=True)
+            _sampler.start()
+            _sampler_pid = os.getpid()
+        _active.add(sample)
+    _wakeup.set()
+    return sample
+
+
+def finish(sample, seconds, label):
+    """Stop ``sample``; write its profile if ``seconds`` is over the threshold and return the path."""
+    with _lock:
+        _active.discard(sample)
+    if seconds * 1000 < settings.PROFILE_SLOW_REQUEST_MS or not sample.stacks:
+        return None
+    os.makedirs(settings.PROFILE_DIR, exist_ok=True)
+    slug = re.sub(r'[^\w.-]+', '_', label)
+    path = os.path.join(settings.PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{slug}-{seconds * 1000:.0f}ms.folded")
+    with open(path, 'w') as f:
+        for stack, count in sample.stacks.most_common():
+            f.write(f"{stack} {count}\n")
+    logger.warning(f"Slow request {label} took {seconds * 1000:.0f} ms; profile written to {path}")
+    return path
@@ -0,0 +1,94 @@
+"""Lazily loaded, process-wide models.
+
+Nothing heavy is imported or loaded until a model is first requested with
+``registry.get(name)``; each model is then loaded exactly once per process,
+even when several threads ask for it at the same time. ``registry.preload``
+loads models up front, e.g. in the gunicorn master so forked workers share
+the weights copy-on-write (see ``gunicorn.conf.py``).
+"""
+import logging
+import threading
+
+from django.conf import settings
+
+from .metrics import timed
+
+logger = logging.getLogger(__name__)
+
+
+class ModelRegistry:
+    def __init__(self):
+        self._loaders = {}
+        self._models = {}
+        self._locks = {}
+        self._registry_lock = threading.Lock()
+
+    def register(self, name, loader):
+        with self._registry_lock:
+            self._loaders[name] = loader
+            self._locks[name] = threading.Lock()
+
+    def is_loaded(self, name):
+        return name in self._models
+
+    def get(self, name):
+        try:
+            return self._models[name]
+        except KeyError:
+            pass
+        with self._locks[name]:
+            if name not in self._models:
+                with timed(f'load_{name}') as timer:
+                    self._models[name] = self._loaders[name]()
+                logger.info(f"Loaded model '{name}' in {timer.seconds:.2f}s")
+            return self._models[name]
+
+    def preload(self, names=None):
+        for name in names if names is not None else list(self._loaders):
+            self.get(name)
+
+
+def _set_torch_threads():
+    import torch
+    if settings.TORCH_NUM_THREADS:
+        torch.set_num_threads(settings.TORCH_NUM_THREADS)
+
+
+def load_spacy():
+    import spacy
+    # Tagging only needs lemmas: tok2vec, tagger, attribute_ruler, lemmatizer.
+    return spacy.load('en_core_web_sm', disable=['parser', 'ner'])
+
+
+def load_yolos():
+    from . import inference
+    _set_torch_threads()
+    return inference.load_detector(settings.YOLOS_MODEL, inference.runtime('yolos'))
+
+
+def load_question_answerer():
+    from . import inference
+    _set_torch_threads()
+    return inference.load_question_answerer(settings.QA_MODEL, inference.runtime('qa'))
+
+
+def load_embedder():
+    from transformers import AutoModel, AutoTokenizer
+    _set_torch_threads()
+    model = AutoModel.from_pretrained(settings.DENSE_EMBEDDING_MODEL)
+    model.eval()
+    return model, AutoTokenizer.from_pretrained(settings.DENSE_EMBEDDING_MODEL)
+
+
+def load_local_llm():
+    from transformers import pipeline
+    _set_torch_threads()
+    return pipeline('text2text-generation', model=settings.LOCAL_LLM_MODEL)
+
+
+registry = ModelRegistry()
+registry.register('spacy', load_spacy)
+registry.register('yolos', load_yolos)
+registry.register('qa', load_question_answerer)
+registry.register('embedder', load_embedder)
+registry.register('local_llm', load_local_llm)
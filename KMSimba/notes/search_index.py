@@ -0,0 +1,267 @@
+import threading
+import time
+from array import array
+
+import numpy as np
+import scipy.sparse as sp
+
+REFRESH_INTERVAL = 5.0  # Seconds between background recomputes of the IDF weights
+
+
+def _row_norms(matrix, squared_idf):
+    squared = sp.csr_matrix((matrix.data ** 2, matrix.indices, matrix.indptr), shape=matrix.shape)
+    return np.sqrt(squared @ squared_idf)
+
+
+class IncrementalTfidfIndex:
+    """Append-only TF-IDF index over note passages.
+
+    Rows hold raw term counts from a HashingVectorizer, so adding a passage
+    only transforms that passage and appends one row; the corpus is never refit.
+    Document frequencies are kept as running counts. The IDF weights and row
+    norms are recomputed over the whole corpus by ``refresh``, which a search
+    starts in a background thread once writes have come in, at most every
+    ``refresh_interval`` seconds. In between, searches are served with the last
+    IDF weights, and rows added since are normed with those weights as they are
+    added. Right after a refresh the scores are the same cosine scores as
+    ``TfidfVectorizer(stop_words='english')`` fit on the full corpus (up to
+    hash collisions).
+
+    The index is split into a read-only ``base`` (which may be memory-mapped
+    from a published generation, see ``index_store``) and an in-memory delta
+    holding the passages added since.
+    """
+
+    ARRAYS = ('data', 'indices', 'indptr', 'doc_ids', 'df', 'idf', 'norms')
+
+    def __init__(self, n_features=2 ** 20, refresh_interval=REFRESH_INTERVAL):
+        self.n_features = n_features
+        self.refresh_interval = refresh_interval
+        self._vectorizer = None
+        self.generation = 0
+        self._lock = threading.RLock()
+        self._refresh_lock = threading.Lock()
+        self._refreshing = False
+        self._base = sp.csr_matrix((0, n_features), dtype=np.float64)
+        self._base_ids = np.zeros(0, dtype=np.int64)
+        self._base_norms = None
+        self._base_idf = None
+        self._delta = sp.csr_matrix((0, n_features), dtype=np.float64)
+        self._delta_ids = array('q')
+        self._max_doc_id = 0
+        self._pending = []
+        self._pending_norms = []
+        self._df = np.zeros(n_features, dtype=np.int32)
+        self._idf = None
+        self._squared_idf = None
+        # Row norms of the base and of the delta under ``_idf``
+        self._norms = None
+        self._delta_norms = np.zeros(0)
+        self._writes = 0
+        self._refreshed_writes = 0
+        self._refreshed_at = 0.0
+
+    @classmethod
+    def from_arrays(cls, arrays, meta, generation=0):
+        """Build an index whose base is backed by ``arrays`` without copying."""
+        n_features = meta['n_features']
+        index = cls(n_features=n_features)
+        index.generation = generation
+        index._base = sp.csr_matrix(
+            (arrays['data'], arrays['indices'], arrays['indptr']),
+            shape=(len(arrays['doc_ids']), n_features),
+            copy=False,
+        )
+        index._base_ids = arrays['doc_ids']
+        index._max_doc_id = int(arrays['doc_ids'].max()) if len(arrays['doc_ids']) else 0
+        index._base_norms = arrays['norms']
+        index._base_idf = arrays['idf']
+        index._df = arrays['df']
+        index._set_weights(arrays['idf'], arrays['norms'], np.zeros(0), writes=0)
+        return index
+
+    @property
+    def vectorizer(self):
+        # sklearn is imported on first use to keep Django startup fast.
+        if self._vectorizer is None:
+            from sklearn.feature_extraction.text import HashingVectorizer
+            self._vectorizer = HashingVectorizer(
+                stop_words='english',
+                n_features=self.n_features,
+                alternate_sign=False,
+                norm=None,
+            )
+        return self._vectorizer
+
+    def __len__(self):
+        return len(self._base_ids) + len(self._delta_ids)
+
+    @property
+    def max_doc_id(self):
+        return self._max_doc_id
+
+    @property
+    def delta_size(self):
+        return len(self._delta_ids)
+
+    def doc_ids_above(self, low):
+        """Return the set of indexed ids greater than ``low``."""
+        with self._lock:
+            ids = np.concatenate([self._base_ids, np.frombuffer(self._delta_ids, dtype=np.int64)])
+            return set(ids[ids > low].tolist())
+
+    def _writable_df(self):
+        if not self._df.flags.writeable:
+            self._df = np.array(self._df)
+        return self._df
+
+    def add(self, doc_id, text):
+        row = self.vectorizer.transform([text])
+        with self._lock:
+            self._writable_df()[row.indices] += 1
+            self._append(row, [doc_id])
+
+    def add_many(self, doc_ids, texts):
+        doc_ids = list(doc_ids)
+        if not doc_ids:
+            return
+        rows = self.vectorizer.transform(texts)
+        with self._lock:
+            self._writable_df()[:] += np.bincount(rows.indices, minlength=self.n_features).astype(np.int32)
+            self._append(rows, doc_ids)
+
+    def _append(self, rows, doc_ids):
+        self._pending.append(rows)
+        if self._squared_idf is not None:
+            # Normed with the last IDF weights until the next refresh.
+            self._pending_norms.append(_row_norms(rows, self._squared_idf))
+        self._delta_ids.extend(doc_ids)
+        self._max_doc_id = max(self._max_doc_id, max(doc_ids))
+        self._writes += 1
+
+    def _fold_pending(self):
+        if self._pending:
+            self._delta = sp.vstack([self._delta] + self._pending, format='csr')
+            self._pending = []
+        if self._pending_norms:
+            self._delta_norms = np.concatenate([self._delta_norms] + self._pending_norms)
+            self._pending_norms = []
+
+    def _set_weights(self, idf, norms, delta_norms, writes):
+        self._idf, self._squared_idf = idf, np.asarray(idf) ** 2
+        self._norms, self._delta_norms = norms, delta_norms
+        self._refreshed_writes = writes
+        self._refreshed_at = time.monotonic()
+
+    def refresh(self):
+        """Recompute the IDF weights and every row norm from the document frequencies.
+
+        The work is done outside the index lock, so searches carry on with
+        the previous weights meanwhile; rows added during it are normed again
+        before the new weights are swapped in.
+        """
+        with self._refresh_lock:
+            with self._lock:
+                self._fold_pending()
+                writes = self._writes
+                if not self._delta_ids and self._base_idf is not None:
+                    self._set_weights(self._base_idf, self._base_norms, np.zeros(0), writes)
+                    return
+                base, delta, df, n_docs = self._base, self._delta, np.array(self._df), len(self)
+
+            idf = np.log((1 + n_docs) / (1 + df)) + 1
+            squared_idf = idf ** 2
+            norms, delta_norms = _row_norms(base, squared_idf), _row_norms(delta, squared_idf)
+
+            with self._lock:
+                self._fold_pending()
+                added = _row_norms(self._delta[delta.shape[0]:], squared_idf)
+                self._set_weights(idf, norms, np.concatenate([delta_norms, added]), writes)
+
+    def _refresh_in_background(self):
+        try:
+            self.refresh()
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def _schedule_refresh(self):
+        """Start a background refresh when writes came in and the last one is old enough."""
+        if self._refreshing or self._writes == self._refreshed_writes:
+            return
+        if time.monotonic() - self._refreshed_at < self.refresh_interval:
+            return
+        self._refreshing = True
+        threading.Thread(target=self._refresh_in_background, daemon=True).start()
+
+    def to_arrays(self):
+        """Return base and delta merged into the arrays ``index_store`` persists."""
+        self.refresh()
+        with self._lock:
+            self._fold_pending()
+            matrix = sp.vstack([self._base, self._delta], format='csr')
+            return {
+                'data': matrix.data,
+                'indices': matrix.indices,
+                'indptr': matrix.indptr,
+                'doc_ids': np.concatenate([self._base_ids, np.frombuffer(self._delta_ids, dtype=np.int64)]),
+                'df': np.asarray(self._df),
+                'idf': self._idf,
+                'norms': np.concatenate([self._norms, self._delta_norms]),
+            }
+
+    def meta(self):
+        return {
+            'n_features': self.n_features,
+            'vectorizer': {'stop_words': 'english', 'alternate_sign': False, 'norm': None},
+        }
+
+    def search(self, query, top_k=5, offset=0, min_score=0.0):
+        """Return ``[(doc_id, score), ...]`` for the best matching notes.
+
+        Only the ``offset + top_k`` best rows are partitioned out and sorted;
+        rows scoring ``min_score`` or less are dropped.
+        """
+        query_vec = self.vectorizer.transform([query])
+        if not len(self):
+            return []
+        if self._idf is None:
+            # Nothing to serve yet: the first search waits for the weights.
+            self.refresh()
+        with self._lock:
+            self._fold_pending()
+            self._schedule_refresh()
+            base, delta, idf, df = self._base, self._delta, self._idf, self._df
+            norms = np.concatenate([self._norms, self._delta_norms])
+            base_ids, delta_ids = self._base_ids, self._delta_ids
+
+        # Terms unseen in the corpus would be dropped by a fitted vocabulary.
+        known = df[query_vec.indices] > 0
+        terms = query_vec.indices[known]
+        weights = query_vec.data[known] * idf[terms]
+        query_norm = np.linalg.norm(weights)
+        if query_norm == 0:
+            return []
+
+        column = sp.csc_matrix(
+            (weights * idf[terms], (terms, np.zeros(len(terms), dtype=np.int32))),
+            shape=(self.n_features, 1),
+        )
+        dots = np.concatenate([
+            (base @ column).toarray().ravel(),
+            (delta @ column).toarray().ravel(),
+        ])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            similarities = np.where(norms > 0, dots / (norms * query_norm), 0.0)
+
+        candidates = np.flatnonzero(similarities > min_score)
+        limit = offset + top_k
+        if len(candidates) > limit:
+            candidates = candidates[np.argpartition(-similarities[candidates], limit - 1)[:limit]]
+        ranked = candidates[np.argsort(-similarities[candidates], kind='stable')][offset:limit]
+
+        n_base = len(base_ids)
+        return [
+            (int(base_ids[idx]) if idx < n_base else delta_ids[idx - n_base], float(similarities[idx]))
+            for idx in ranked
+        ]
@@ -0,0 +1,72 @@
+"""Service layer for saving notes.
+
+Views and the ingest worker call ``NoteService`` directly instead of posting
+to the note endpoints over HTTP.
+"""
+from django.core.files.base import ContentFile
+from django.db import connection, transaction
+from django.utils import timezone
+
+from . import note_search
+from .metrics import timed
+from .models import Note
+from .passages import create_passages, embed_passages
+from .utils import save_file
+
+NOTE_BULK_BATCH_SIZE = 500
+
+
+class NoteService:
+    @staticmethod
+    @timed('save_note')
+    def ingest(text, source_file=None, embeddings=None):
+        """Save ``text`` as a note, optionally linked to the ``File`` it came from.
+
+        ``embeddings`` are those of ``passages.embed_passages([text])`` when
+        the caller already holds a transaction.
+        """
+        text = text.strip()
+        if not text:
+            raise ValueError("Note content cannot be empty.")
+        if embeddings is None:
+            embeddings = embed_passages([text])
+        with transaction.atomic():
+            note = Note.objects.create(content=text, source_file=source_file)
+            create_passages([note], embeddings)
+        transaction.on_commit(note_search.catch_up_passage_index)
+        return note
+
+    @staticmethod
+    @timed('save_notes')
+    def ingest_many(items):
+        """Save many notes and their passages with batched inserts.
+
+        ``items`` holds texts or ``(text, source_file)`` pairs; empty texts are
+        skipped. Returns the number of notes saved.
+        """
+        notes = []
+        for item in items:
+            text, source_file = item if isinstance(item, tuple) else (item, None)
+            text = text.strip()
+            if text:
+                notes.append(Note(content=text, source_file=source_file))
+        embeddings = embed_passages([note.content for note in notes])
+        with transaction.atomic():
+            if connection.features.can_return_rows_from_bulk_insert:
+                Note.objects.bulk_create(notes, batch_size=NOTE_BULK_BATCH_SIZE)
+            else:
+                # Passages need the note ids, which bulk_create cannot return here (MySQL).
+                for note in notes:
+                    note.save()
+            create_passages(notes, embeddings)
+        transaction.on_commit(note_search.catch_up_passage_index)
+        return len(notes)
+
+    @staticmethod
+    def save_text_file(text):
+        """Store ``text`` as a ``.txt`` file, reusing an identical existing one."""
+        file_name = f"note_{timezone.now().strftime('%Y-%m-%d_%H-%M-%S')}.txt"
+        file_instance = save_file(file_name, ContentFile(text.encode('utf-8'), name=file_name), {}, extracted_text=text)
+        if file_instance is None:
+            raise IOError(f"Could not save {file_name}.")
+        return file_instance
@@ -0,0 +1,54 @@
+"""Keep the in-process tag index (``notes.tag_index``) in step with writes.
+
+Changes are applied once the transaction commits, and only when the index has
+already been loaded; otherwise the next load reads them from the database.
+Every write to a file or its tags is also logged in ``FileChange`` for the
+indexes of other processes. ``bulk_create`` sends no signals, so
+``save_file_tags`` adds its rows through ``tag_index.index_file_tags``
+instead. ``FileTag`` has no delete receiver, which would stop Django from
+deleting a file's tags in one query; deleting a file logs one change for it
+and its tags, and code deleting tag rows directly logs the file itself.
+
+New database connections get the query counter of ``notes.metrics``.
+"""
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_save, pre_delete
+from django.dispatch import receiver
+
+from . import metrics, tag_index
+from .models import File, FileTag, Tag
+
+
+@receiver(connection_created)
+def connection_opened(sender, connection, **kwargs):
+    metrics.install_query_counter(connection)
+
+
+def _on_commit(method, *args):
+    index = tag_index.tag_index
+    if index is not None:
+        transaction.on_commit(lambda: getattr(index, method)(*args))
+
+
+@receiver(post_save, sender=Tag)
+def tag_saved(sender, instance, **kwargs):
+    _on_commit('add_tag', instance.id, instance.name)
+
+
+@receiver(post_save, sender=File)
+def file_saved(sender, instance, **kwargs):
+    tag_index.log_file_change(instance.id)
+    _on_commit('set_file', instance.id, instance.file_name)
+
+
+@receiver(pre_delete, sender=File)
+def file_deleted(sender, instance, **kwargs):
+    tag_index.log_file_change(instance.id)
+    _on_commit('remove_file', instance.id)
+
+
+@receiver(post_save, sender=FileTag)
+def file_tag_saved(sender, instance, **kwargs):
+    tag_index.log_file_change(instance.file_id)
+    _on_commit('add_posting', instance.tag_id, instance.file_id, instance.weight)
@@ -0,0 +1,360 @@
+"""In-memory inverted index for file tag search.
+
+Every tag id maps to a sorted ``int32`` array of the ids of the files carrying
+it, with a parallel ``float32`` array of their BM25 term weights
+(``FileTag.weight``). A search gathers the postings of the query tags, scales
+them by idf and sums them per file with NumPy, so ranking never touches the
+database.
+
+The index is loaded from the snapshot written by ``build_tag_index`` (or
+built from ``FileTag`` when there is none) on the first search. Writes made
+in this process are applied through the signals in ``notes.signals``.
+
+Every write to a file or its tags also logs the file's id in ``FileChange``,
+in the same transaction. ``catch_up``, which runs at most every
+``TAG_INDEX_SYNC_INTERVAL`` seconds, reads the changes logged since the last
+one and reloads just those files, so writes of other processes (ingest
+workers, other web workers) are picked up without scanning any table. Change
+ids are allocated at insert but become visible at commit, so a slow
+transaction can commit an id below one already read: the last
+``TAG_INDEX_CHANGE_WINDOW`` ids are read again each time, and the ones not
+seen before applied. ``build_tag_index`` prunes changes older than
+``TAG_INDEX_CHANGE_RETENTION``, and an index that has not caught up for that
+long is reloaded instead. A newer snapshot, e.g. after
+``refresh_tag_weights``, replaces the index.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from array import array
+from collections import defaultdict
+from datetime import timedelta
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .metrics import timed
+from .models import File, FileChange, FileTag, Tag
+from .utils import TAG_QUERY_BATCH_SIZE, bm25_idf
+
+logger = logging.getLogger(__name__)
+
+EMPTY_POSTINGS = (np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32))
+
+
+class TagPostingsIndex:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._tag_ids = {}
+        self._postings = {}
+        # Writes not yet merged into ``_postings``: tag id -> {file id: weight, or None if removed}.
+        self._changes = defaultdict(dict)
+        self._file_names = {}
+        # File id -> ids of its tags, so removing a file only touches its postings.
+        # Arrays as loaded, turned into sets when the file's tags are written.
+        self._file_tags = {}
+        # Ids of the changes within TAG_INDEX_CHANGE_WINDOW of the newest one applied
+        self._change_ids = set()
+        self.max_change_id = 0
+        # time.time() when the index last read FileChange
+        self.caught_up_at = 0.0
+        self.snapshot_mtime = None
+        self.synced_at = 0.0
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Build an index from postings grouped by tag (see ``to_arrays``)."""
+        index = cls()
+        tag_names = json.loads(bytes(arrays['tag_names']).decode('utf-8'))
+        index._tag_ids = dict(zip(tag_names, arrays['tag_ids'].tolist()))
+        indptr = arrays['indptr']
+        file_ids = arrays['file_ids'].astype(np.int32, copy=False)
+        weights = arrays['weights'].astype(np.float32, copy=False)
+        posting_tag_ids = arrays['posting_tag_ids']
+        for slot, tag_id in enumerate(posting_tag_ids.tolist()):
+            start, end = indptr[slot], indptr[slot + 1]
+            index._postings[tag_id] = (file_ids[start:end], weights[start:end])
+        by_file = np.argsort(file_ids, kind='stable')
+        files, starts = np.unique(file_ids[by_file], return_index=True)
+        row_tag_ids = np.repeat(posting_tag_ids, np.diff(indptr))[by_file]
+        index._file_tags = dict(zip(files.tolist(), np.split(row_tag_ids, starts[1:])))
+        file_names = json.loads(bytes(arrays['file_names']).decode('utf-8'))
+        index._file_names = dict(zip(arrays['file_name_ids'].tolist(), file_names))
+        index._change_ids = set(arrays['change_ids'].tolist())
+        index.max_change_id = max(index._change_ids, default=0)
+        index.caught_up_at = float(arrays['caught_up_at'])
+        return index
+
+    @classmethod
+    @timed('tag_index_build')
+    def build(cls, chunk_size=10000):
+        """Read every ``Tag``, ``File`` and ``FileTag`` row into a new index."""
+        # Changes are read first: any logged after that are applied by the next catch-up.
+        caught_up_at = time.time()
+        change_ids = _recent_change_ids()
+        tag_col, file_col, weights = array('q'), array('i'), array('f')
+        rows = FileTag.objects.order_by('tag_id', 'file_id').values_list('tag_id', 'file_id', 'weight')
+        for tag_id, file_id, weight in rows.iterator(chunk_size=chunk_size):
+            tag_col.append(tag_id)
+            file_col.append(file_id)
+            weights.append(weight)
+
+        tag_col = np.frombuffer(tag_col, dtype=np.int64)
+        posting_tag_ids, starts = np.unique(tag_col, return_index=True)
+        tags = list(Tag.objects.values_list('id', 'name'))
+        files = list(File.objects.values_list('id', 'file_name'))
+        return cls.from_arrays({
+            'tag_ids': np.array([tag_id for tag_id, _ in tags], dtype=np.int64),
+            'tag_names': _encode_names(name for _, name in tags),
+            'posting_tag_ids': posting_tag_ids,
+            'indptr': np.append(starts, len(tag_col)),
+            'file_ids': np.frombuffer(file_col, dtype=np.int32),
+            'weights': np.frombuffer(weights, dtype=np.float32),
+            'file_name_ids': np.array([file_id for file_id, _ in files], dtype=np.int64),
+            'file_names': _encode_names(name for _, name in files),
+            'change_ids': np.array(sorted(change_ids), dtype=np.int64),
+            'caught_up_at': caught_up_at,
+        })
+
+    def to_arrays(self):
+        with self._lock:
+            for tag_id in list(self._changes):
+                self._merged_postings(tag_id)
+            posting_tag_ids = sorted(tag_id for tag_id, (ids, _) in self._postings.items() if len(ids))
+            postings = [self._postings[tag_id] for tag_id in posting_tag_ids]
+            indptr = np.zeros(len(postings) + 1, dtype=np.int64)
+            indptr[1:] = np.cumsum([len(ids) for ids, _ in postings])
+            return {
+                'tag_ids': np.array(list(self._tag_ids.values()), dtype=np.int64),
+                'tag_names': _encode_names(self._tag_ids),
+                'posting_tag_ids': np.array(posting_tag_ids, dtype=np.int64),
+                'indptr': indptr,
+                'file_ids': np.concatenate([ids for ids, _ in postings] or [EMPTY_POSTINGS[0]]),
+                'weights': np.concatenate([weights for _, weights in postings] or [EMPTY_POSTINGS[1]]),
+                'file_name_ids': np.array(list(self._file_names), dtype=np.int64),
+                'file_names': _encode_names(self._file_names.values()),
+                'change_ids': np.array(sorted(self._change_ids), dtype=np.int64),
+                'caught_up_at': self.caught_up_at,
+            }
+
+    def __len__(self):
+        return len(self._file_names)
+
+    def add_tag(self, tag_id, name):
+        with self._lock:
+            self._tag_ids[name] = tag_id
+
+    def set_file(self, file_id, file_name):
+        with self._lock:
+            self._file_names[file_id] = file_name
+
+    def _tags_of(self, file_id):
+        tags = self._file_tags.get(file_id)
+        if not isinstance(tags, set):
+            tags = self._file_tags[file_id] = set() if tags is None else set(tags.tolist())
+        return tags
+
+    def add_posting(self, tag_id, file_id, weight):
+        with self._lock:
+            self._changes[tag_id][file_id] = weight
+            self._tags_of(file_id).add(tag_id)
+
+    def remove_posting(self, tag_id, file_id):
+        with self._lock:
+            self._changes[tag_id][file_id] = None
+            self._tags_of(file_id).discard(tag_id)
+
+    def remove_file(self, file_id):
+        with self._lock:
+            self._file_names.pop(file_id, None)
+            for tag_id in self._file_tags.pop(file_id, ()):
+                self._changes[int(tag_id)][file_id] = None
+
+    def _merged_postings(self, tag_id):
+        """Postings of ``tag_id`` with pending writes folded in."""
+        ids, weights = self._postings.get(tag_id, EMPTY_POSTINGS)
+        changes = self._changes.pop(tag_id, None)
+        if changes:
+            changed = np.fromiter(changes, dtype=np.int32, count=len(changes))
+            keep = ~np.isin(ids, changed)
+            added = {file_id: weight for file_id, weight in changes.items() if weight is not None}
+            ids = np.concatenate([ids[keep], np.fromiter(added, dtype=np.int32, count=len(added))])
+            weights = np.concatenate([weights[keep], np.fromiter(added.values(), dtype=np.float32, count=len(added))])
+            order = np.argsort(ids, kind='stable')
+            ids, weights = ids[order], weights[order]
+            self._postings[tag_id] = (ids, weights)
+        return ids, weights
+
+    def doc_freq(self, name):
+        with self._lock:
+            tag_id = self._tag_ids.get(name)
+            return 0 if tag_id is None else len(self._merged_postings(tag_id)[0])
+
+    def search(self, tag_names, offset=0, limit=50):
+        """Return ``[(file_id, file_name, score), ...]`` ranked by BM25."""
+        with self._lock:
+            doc_count = len(self._file_names)
+            file_ids, scores = [], []
+            for name in tag_names:
+                tag_id = self._tag_ids.get(name)
+                if tag_id is None:
+                    continue
+                ids, weights = self._merged_postings(tag_id)
+                if len(ids):
+                    file_ids.append(ids)
+                    scores.append(weights * bm25_idf(len(ids), max(doc_count, len(ids))))
+        if not file_ids:
+            return []
+
+        file_ids, scores = np.concatenate(file_ids), np.concatenate(scores)
+        if len(file_ids) * 8 >= file_ids.max():
+            # Dense accumulation over the id range beats sorting when postings are long.
+            files = np.flatnonzero(np.bincount(file_ids))
+            totals = np.bincount(file_ids, weights=scores)[files]
+        else:
+            files, inverse = np.unique(file_ids, return_inverse=True)
+            totals = np.bincount(inverse, weights=scores)
+        end = offset + limit
+        candidates = np.arange(len(files))
+        if len(candidates) > end:
+            candidates = np.argpartition(-totals, end - 1)[:end]
+        ranked = candidates[np.lexsort((files[candidates], -totals[candidates]))][offset:end]
+        with self._lock:
+            return [
+                (file_id, self._file_names[file_id], float(totals[idx]))
+                for idx, file_id in zip(ranked, files[ranked].tolist())
+                if file_id in self._file_names
+            ]
+
+    def reload_files(self, file_ids):
+        """Replace the name and postings of ``file_ids`` with their rows in the database."""
+        file_ids = list(file_ids)
+        files, rows = {}, []
+        for offset in range(0, len(file_ids), TAG_QUERY_BATCH_SIZE):
+            batch = file_ids[offset:offset + TAG_QUERY_BATCH_SIZE]
+            files.update(File.objects.filter(id__in=batch).values_list('id', 'file_name'))
+            rows.extend(FileTag.objects.filter(file_id__in=batch).values_list('file_id', 'tag_id', 'tag__name', 'weight'))
+        with self._lock:
+            for file_id in file_ids:
+                self.remove_file(file_id)
+            self._file_names.update(files)
+            for file_id, tag_id, name, weight in rows:
+                if file_id in files:
+                    self._tag_ids[name] = tag_id
+                    self.add_posting(tag_id, file_id, weight)
+
+    @timed('tag_index_catch_up')
+    def catch_up(self):
+        """Reload the files of changes logged (by any process) since the last catch-up."""
+        caught_up_at = time.time()
+        low = max(self.max_change_id - settings.TAG_INDEX_CHANGE_WINDOW, 0)
+        changes = list(FileChange.objects.filter(id__gt=low).values_list('id', 'file_id'))
+        changed = {file_id for change_id, file_id in changes if change_id not in self._change_ids}
+        if changed:
+            self.reload_files(changed)
+        with self._lock:
+            self.max_change_id = max([self.max_change_id, *(change_id for change_id, _ in changes)])
+            window = self.max_change_id - settings.TAG_INDEX_CHANGE_WINDOW
+            self._change_ids = {change_id for change_id, _ in changes if change_id > window}
+            self.caught_up_at = caught_up_at
+            self.synced_at = time.monotonic()
+
+
+def _recent_change_ids():
+    newest = FileChange.objects.order_by('-id').values_list('id', flat=True).first() or 0
+    return set(
+        FileChange.objects.filter(id__gt=newest - settings.TAG_INDEX_CHANGE_WINDOW).values_list('id', flat=True)
+    )
+
+
+def log_file_change(file_id):
+    """Record that ``file_id`` or its tags changed, for the indexes of other processes."""
+    FileChange.objects.create(file_id=file_id)
+
+
+def prune_file_changes():
+    """Delete changes older than ``TAG_INDEX_CHANGE_RETENTION``; return how many."""
+    cutoff = timezone.now() - timedelta(seconds=settings.TAG_INDEX_CHANGE_RETENTION)
+    return FileChange.objects.filter(created_at__lt=cutoff).delete()[0]
+
+
+def _encode_names(names):
+    return np.frombuffer(json.dumps(list(names)).encode('utf-8'), dtype=np.uint8)
+
+
+def save_snapshot(index, path):
+    """Write ``index`` to ``path`` atomically."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **index.to_arrays())
+    os.replace(tmp_path, path)
+
+
+def load_snapshot(path):
+    try:
+        mtime = os.path.getmtime(path)
+        with np.load(path, allow_pickle=False) as arrays:
+            index = TagPostingsIndex.from_arrays(arrays)
+    except FileNotFoundError:
+        return None
+    except KeyError:
+        # Written by an older version without the change log; rebuilt instead.
+        return None
+    index.snapshot_mtime = mtime
+    return index
+
+
+def _snapshot_mtime():
+    try:
+        return os.path.getmtime(settings.TAG_INDEX_SNAPSHOT)
+    except OSError:
+        return None
+
+
+tag_index = None
+_load_lock = threading.Lock()
+
+
+def get_tag_index():
+    """Return the process-wide index, loading it or catching it up when due."""
+    global tag_index
+    with _load_lock:
+        index = tag_index
+        mtime = _snapshot_mtime()
+        # Changes this old may have been pruned before the index read them.
+        stale = index is not None and time.time() - index.caught_up_at > settings.TAG_INDEX_CHANGE_RETENTION
+        if index is None or stale or (mtime is not None and mtime != index.snapshot_mtime):
+            start = time.perf_counter()
+            index = load_snapshot(settings.TAG_INDEX_SNAPSHOT)
+            if index is None or time.time() - index.caught_up_at > settings.TAG_INDEX_CHANGE_RETENTION:
+                index = TagPostingsIndex.build()
+                index.snapshot_mtime = mtime
+            index.catch_up()
+            tag_index = index
+            logger.info(f"Loaded tag index with {len(index)} files in {time.perf_counter() - start:.2f}s")
+        elif time.monotonic() - index.synced_at >= settings.TAG_INDEX_SYNC_INTERVAL:
+            index.catch_up()
+        return index
+
+
+def index_file_tags(file_instance, tag_ids, weights, log_change=True):
+    """Add bulk-created ``FileTag`` rows, which send no signals, once committed."""
+    if log_change:
+        log_file_change(file_instance.id)
+    index = tag_index
+    if index is None:
+        return
+
+    def apply():
+        index.set_file(file_instance.id, file_instance.file_name)
+        for name, tag_id in tag_ids.items():
+            index.add_tag(tag_id, name)
+        for tag_id, weight in weights.items():
+            index.add_posting(tag_id, file_instance.id, weight)
+
+    transaction.on_commit(apply)
@@ -0,0 +1,85 @@
+"""Lemma tags for documents and search queries.
+
+Only the spaCy components needed for lemmas run (parser and NER are
+disabled when the model is loaded). Long documents are split into chunks
+below ``nlp.max_length`` and streamed through ``nlp.pipe``. Query tags are
+memoized, since the same short queries come back again and again.
+"""
+import logging
+import re
+from collections import Counter
+from functools import lru_cache
+
+from django.conf import settings
+
+from .metrics import timed
+from .registry import registry
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 100000
+_boundary = re.compile(r'\s')
+
+
+def chunk_text(content, chunk_size=CHUNK_SIZE):
+    """Split ``content`` into pieces of at most ``chunk_size`` characters on whitespace."""
+    start = 0
+    while start < len(content):
+        end = start + chunk_size
+        if end < len(content):
+            # Back up to the last whitespace so no word is cut in half.
+            match = None
+            for match in _boundary.finditer(content, start + chunk_size // 2, end):
+                pass
+            if match is not None:
+                end = match.end()
+        yield content[start:end]
+        start = end
+
+
+def _tag_lemmas(docs):
+    return (
+        token.lemma_.lower()
+        for doc in docs
+        for token in doc
+        if token.is_alpha and not token.is_stop and len(token) > 2
+    )
+
+
+@timed('spacy_tags')
+def generate_tag_counts(content):
+    """Return a ``Counter`` of tag lemma -> occurrences in ``content``."""
+    try:
+        nlp = registry.get('spacy')
+        docs = nlp.pipe(
+            chunk_text(content),
+            batch_size=settings.SPACY_BATCH_SIZE,
+            n_process=settings.SPACY_N_PROCESS,
+        )
+        return Counter(_tag_lemmas(docs))
+    except Exception as e:
+        logger.error(f"Error generating tags: {e}")
+        return Counter()
+
+
+def generate_tags(content):
+    return set(generate_tag_counts(content))
+
+
+@lru_cache(maxsize=4096)
+def _query_tags(query):
+    return frozenset(_tag_lemmas([registry.get('spacy')(query)]))
+
+
+def query_tags(query):
+    """Tags of a short search query, cached per whitespace-normalized query.
+
+    The query keeps its casing, as documents do, since spaCy tags and
+    lemmatizes lowercased nouns and proper nouns differently; only the
+    lemmas are lowercased.
+    """
+    try:
+        return set(_query_tags(" ".join(query.split())))
+    except Exception as e:
+        logger.error(f"Error generating query tags: {e}")
+        return set()
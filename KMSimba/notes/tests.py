@@ -1,3 +1,1382 @@
-from django.test import TestCase
+import asyncio
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import Client, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import File, FileChange, FileTag, IngestJob, Note, Passage, Tag, UploadSession
+from . import answer_cache, dense_index, inference, ingest, llm, index_store, metrics, ocr, note_search, profiler, registry, tag_index, tagging, uploads, utils
+from .cache_backends import LRUFileBasedCache
+from .dense_index import DenseIndex
+from .downloads import parse_ranges
+from .hybrid_search import hybrid_search, reciprocal_rank_fusion
+from .passages import build_context, estimate_tokens, fetch_passages, passage_spans
+from .search_index import IncrementalTfidfIndex
+from .services import NoteService
+from .tag_index import TagPostingsIndex, get_tag_index, load_snapshot, save_snapshot
+from .utils import bm25_term_weight, perform_search, read_text_file, save_file_tags
+
+
+def create_tagged_files():
+    tags = {name: Tag.objects.create(name=name) for name in ('alpha', 'beta', 'gamma')}
+    documents = ['alpha', 'alpha beta', 'alpha beta gamma', 'gamma']
+    avg_doc_length = sum(len(names.split()) for names in documents) / len(documents)
+    for index, names in enumerate(documents):
+        names = names.split()
+        file = File.objects.create(
+            file_name=f"file{index}.txt", file_content=f"file{index}.txt", content_hash=str(index), doc_length=len(names),
+        )
+        for name in names:
+            FileTag.objects.create(file=file, tag=tags[name], weight=bm25_term_weight(1, len(names), avg_doc_length))
+
+
+@override_settings(TAG_INDEX_ENABLED=False)
+class PerformSearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        create_tagged_files()
+
+    def setUp(self):
+        cache.clear()
+
+    @mock.patch('notes.utils.query_tags', return_value={'alpha', 'beta', 'gamma'})
+    def test_ranks_by_bm25(self, _):
+        files = perform_search('alpha beta gamma')
+        # gamma is rarer than alpha, so file3 outranks file0 despite both matching one tag.
+        self.assertEqual([f.file_name for f in files], ['file2.txt', 'file1.txt', 'file3.txt', 'file0.txt'])
+        scores = [f.score for f in files]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+
+    @mock.patch('notes.utils.query_tags', return_value={'alpha', 'beta', 'gamma', 'delta', 'epsilon'})
+    def test_query_count_does_not_grow_with_tags_or_hits(self, _):
+        # corpus generation, corpus statistics and tag document frequencies (both cached per generation), ranking
+        with self.assertNumQueries(4):
+            files = perform_search('alpha beta gamma delta epsilon')
+            [f.file_name for f in files]
+
+    @mock.patch('notes.utils.query_tags', return_value={'delta'})
+    def test_new_tags_are_searchable_after_save(self, _):
+        self.assertEqual(perform_search('delta'), [])
+        file = File.objects.create(file_name="file4.txt", file_content="file4.txt", content_hash="4")
+        save_file_tags(file, {'delta': 2})
+        self.assertEqual([f.file_name for f in perform_search('delta')], ['file4.txt'])
+
+    @mock.patch('notes.utils.query_tags', return_value={'delta'})
+    def test_doc_freqs_follow_writes_of_other_processes(self, _):
+        self.assertEqual(perform_search('delta'), [])
+        # Written elsewhere: nothing in this process's cache is invalidated, only the change log grows.
+        file = File.objects.create(file_name="file4.txt", file_content="file4.txt", content_hash="4", doc_length=1)
+        FileTag.objects.create(file=file, tag=Tag.objects.create(name='delta'), weight=1.0)
+        self.assertEqual([f.file_name for f in perform_search('delta')], ['file4.txt'])
+
+    @mock.patch('notes.utils.query_tags', return_value={'alpha', 'beta', 'gamma'})
+    def test_pagination(self, _):
+        files = perform_search('alpha beta gamma', page=2, per_page=3)
+        self.assertEqual([f.file_name for f in files], ['file0.txt'])
+
+    @mock.patch('notes.utils.query_tags', return_value=set())
+    def test_empty_query_skips_database(self, _):
+        with self.assertNumQueries(0):
+            self.assertEqual(perform_search(''), [])
+
+
+@override_settings(TAG_INDEX_SNAPSHOT=os.path.join(tempfile.gettempdir(), 'missing', 'postings.npz'))
+class TagPostingsIndexTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        create_tagged_files()
+
+    def setUp(self):
+        cache.clear()
+        utils._tag_id_cache.clear()
+        self.addCleanup(setattr, tag_index, 'tag_index', None)
+
+    def search(self, query):
+        return [(name, round(score, 5)) for _, name, score in get_tag_index().search(query.split())]
+
+    def test_matches_database_ranking(self):
+        with override_settings(TAG_INDEX_ENABLED=False), mock.patch('notes.utils.query_tags', return_value={'alpha', 'beta', 'gamma'}):
+            expected = [(f.file_name, round(f.score, 5)) for f in perform_search('alpha beta gamma')]
+        self.assertEqual(self.search('alpha beta gamma'), expected)
+
+    @mock.patch('notes.utils.query_tags', return_value={'alpha', 'beta', 'gamma'})
+    def test_search_does_not_query_database_once_loaded(self, _):
+        get_tag_index()
+        with self.assertNumQueries(0):
+            files = perform_search('alpha beta gamma', page=2, per_page=3)
+        self.assertEqual([f.file_name for f in files], ['file0.txt'])
+
+    def test_signals_apply_committed_writes(self):
+        get_tag_index()
+        with self.captureOnCommitCallbacks(execute=True):
+            file = File.objects.create(file_name="file4.txt", file_content="file4.txt", content_hash="4", doc_length=1)
+            FileTag.objects.create(file=file, tag=Tag.objects.create(name='delta'), weight=1.0)
+        self.assertEqual([name for name, _ in self.search('delta')], ['file4.txt'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            file.file_name = "renamed.txt"
+            file.save()
+        self.assertEqual([name for name, _ in self.search('delta')], ['renamed.txt'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            File.objects.get(file_name="file2.txt").delete()
+        self.assertEqual([name for name, _ in self.search('gamma')], ['file3.txt'])
+
+    def test_save_file_tags_adds_bulk_created_rows(self):
+        get_tag_index()
+        file = File.objects.create(file_name="file4.txt", file_content="file4.txt", content_hash="4")
+        with self.captureOnCommitCallbacks(execute=True):
+            save_file_tags(file, {'delta': 2, 'alpha': 1})
+        self.assertEqual([name for name, _ in self.search('delta')], ['file4.txt'])
+        self.assertEqual(get_tag_index().doc_freq('alpha'), 4)
+
+    def test_catch_up_applies_writes_from_other_processes(self):
+        index = TagPostingsIndex.build()
+        # Without a loaded index in this process no signal handler touches it.
+        file = File.objects.create(file_name="file4.txt", file_content="file4.txt", content_hash="4")
+        FileTag.objects.create(file=file, tag=Tag.objects.create(name='delta'), weight=1.0)
+        File.objects.filter(file_name="file3.txt").delete()
+        index.catch_up()
+        self.assertEqual([name for _, name, _ in index.search(['delta'])], ['file4.txt'])
+        self.assertEqual([name for _, name, _ in index.search(['gamma'])], ['file2.txt'])
+
+    def test_catch_up_reloads_only_logged_files(self):
+        index = TagPostingsIndex.build()
+        file_tag = FileTag.objects.get(file__file_name="file1.txt", tag__name='beta')
+        file_tag.weight = 5.0
+        file_tag.save()
+        file2 = File.objects.get(file_name="file2.txt")
+        # Deleting tag rows sends no signal; the caller logs the file.
+        FileTag.objects.filter(file=file2, tag__name='beta').delete()
+        tag_index.log_file_change(file2.id)
+        with self.assertNumQueries(3):
+            index.catch_up()
+        self.assertEqual([(name, round(score, 5)) for _, name, score in index.search(['beta'])][0][0], 'file1.txt')
+        self.assertEqual(index.doc_freq('beta'), 1)
+        with self.assertNumQueries(1):
+            index.catch_up()
+
+    def test_deleting_a_file_logs_one_change(self):
+        index = get_tag_index()
+        file = File.objects.get(file_name="file2.txt")
+        file_id = file.id
+        FileChange.objects.all().delete()
+        with self.captureOnCommitCallbacks(execute=True):
+            file.delete()
+        self.assertEqual(list(FileChange.objects.values_list('file_id', flat=True)), [file_id])
+        self.assertEqual([name for name, _ in self.search('gamma')], ['file3.txt'])
+        self.assertEqual(index.doc_freq('alpha'), 2)
+
+    def test_saving_a_file_logs_one_change(self):
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            file = NoteService.save_text_file("alpha beta")
+        self.assertEqual(FileChange.objects.filter(file_id=file.id).count(), 1)
+
+    def test_catch_up_applies_changes_committed_late(self):
+        index = TagPostingsIndex.build()
+        file = File.objects.create(file_name="file4.txt", file_content="file4.txt", content_hash="4")
+        FileTag.objects.bulk_create([FileTag(file=file, tag=Tag.objects.create(name='delta'), weight=1.0)])
+        # The change of file4 is not visible yet when a later one is read.
+        late = FileChange.objects.filter(file_id=file.id)
+        late_ids = list(late.values_list('id', flat=True))
+        late.delete()
+        FileTag.objects.create(file=File.objects.get(file_name="file0.txt"), tag=Tag.objects.get(name='gamma'), weight=1.0)
+        index.catch_up()
+        self.assertEqual(index.search(['delta']), [])
+        FileChange.objects.bulk_create([FileChange(id=change_id, file_id=file.id) for change_id in late_ids])
+        index.catch_up()
+        self.assertEqual([name for _, name, _ in index.search(['delta'])], ['file4.txt'])
+
+    def test_snapshot_round_trip(self):
+        index = TagPostingsIndex.build()
+        index.add_posting(Tag.objects.get(name='beta').id, File.objects.get(file_name="file3.txt").id, 0.5)
+        with tempfile.TemporaryDirectory() as root:
+            path = os.path.join(root, 'postings.npz')
+            save_snapshot(index, path)
+            loaded = load_snapshot(path)
+        self.assertEqual(loaded.search(['alpha', 'beta', 'gamma']), index.search(['alpha', 'beta', 'gamma']))
+        self.assertEqual(loaded.max_change_id, index.max_change_id)
+        self.assertEqual(loaded.caught_up_at, index.caught_up_at)
+        self.assertEqual(len(loaded), 4)
+
+
+class SaveFileTagsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        utils._tag_id_cache.clear()
+        self.file = File.objects.create(file_name="doc.txt", file_content="doc.txt", content_hash="doc")
+        Tag.objects.create(name='existing')
+
+    def test_bulk_path_does_not_scale_with_tag_count(self):
+        names = {'existing'} | {f"lemma{i}" for i in range(200)}
+        # lookup, bulk insert of missing tags, id lookup of new tags, doc_length
+        # update, corpus statistics, FileTag bulk insert, change log
+        with self.assertNumQueries(7):
+            save_file_tags(self.file, names)
+        self.assertEqual(FileTag.objects.filter(file=self.file).count(), 201)
+        self.assertEqual(Tag.objects.count(), 201)
+
+    def test_stores_term_frequencies_and_doc_length(self):
+        save_file_tags(self.file, {'alpha': 3, 'beta': 1})
+        self.file.refresh_from_db()
+        self.assertEqual(self.file.doc_length, 4)
+        frequencies = dict(FileTag.objects.filter(file=self.file).values_list('tag__name', 'term_frequency'))
+        self.assertEqual(frequencies, {'alpha': 3, 'beta': 1})
+
+    def test_cached_tag_ids_skip_lookup(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            save_file_tags(self.file, {'existing', 'fresh'})
+        other = File.objects.create(file_name="other.txt", file_content="other.txt", content_hash="other")
+        # doc_length update, FileTag bulk insert and change log only
+        with self.assertNumQueries(3):
+            save_file_tags(other, {'existing', 'fresh'})
+
+
+class NoteServiceTests(TestCase):
+    def setUp(self):
+        self.file = File.objects.create(file_name="doc.pdf", file_content="doc.pdf", content_hash="doc")
+
+    def test_ingest_links_source_file(self):
+        note = NoteService.ingest("  extracted text \n", source_file=self.file)
+        self.assertEqual(note.content, "extracted text")
+        self.assertEqual(list(self.file.notes.all()), [note])
+
+    def test_ingest_rejects_empty_text(self):
+        with self.assertRaises(ValueError):
+            NoteService.ingest("   ")
+
+    def test_ingest_splits_note_into_passages(self):
+        words = [f"w{i}" for i in range(450)]
+        note = NoteService.ingest(" ".join(words))
+        spans = list(note.passages.order_by('position').values_list('start', 'end'))
+        self.assertEqual(spans, passage_spans(note.content))
+        self.assertEqual(len(spans), 3)
+
+    def test_ingest_many_inserts_in_batches(self):
+        # savepoint, notes, passages, release
+        with self.assertNumQueries(4):
+            saved = NoteService.ingest_many(["first", ("second", self.file), "  "])
+        self.assertEqual(saved, 2)
+        self.assertEqual(Note.objects.filter(source_file=self.file).get().content, "second")
+        self.assertEqual(Passage.objects.count(), 2)
+
+    def test_passages_reach_loaded_index_on_commit(self):
+        with mock.patch.object(note_search, 'passage_index', IncrementalTfidfIndex()), \
+                mock.patch.object(note_search, '_index_loaded', True):
+            with self.captureOnCommitCallbacks(execute=True):
+                single = NoteService.ingest("quantum entanglement lecture")
+            with self.captureOnCommitCallbacks(execute=True):
+                NoteService.ingest_many(["photosynthesis in plants", "quantum computing basics"])
+            passages = fetch_passages(note_search.semantic_search("quantum"))
+        self.assertEqual(len(passages), 2)
+        self.assertIn(single.id, [passage.note_id for passage in passages])
+        self.assertIn("quantum computing basics", [passage.text for passage in passages])
+
+    def test_catch_up_indexes_passages_committed_late(self):
+        with mock.patch.object(note_search, 'passage_index', IncrementalTfidfIndex()), \
+                mock.patch.object(note_search, '_index_loaded', True), \
+                mock.patch.object(note_search, '_recent_ids', set()):
+            late = NoteService.ingest("quantum entanglement lecture")
+            # The passage of ``late`` is not visible yet when a later one is indexed.
+            rows = list(Passage.objects.filter(note=late).values('id', 'note_id', 'position', 'start', 'end'))
+            Passage.objects.filter(note=late).delete()
+            NoteService.ingest("photosynthesis in plants")
+            note_search.catch_up_passage_index()
+            self.assertEqual(note_search.semantic_search("quantum"), [])
+            Passage.objects.bulk_create([Passage(**row) for row in rows])
+            note_search.catch_up_passage_index()
+            passages = fetch_passages(note_search.semantic_search("quantum"))
+            self.assertEqual(len(note_search.passage_index), 2)
+        self.assertEqual([passage.note_id for passage in passages], [late.id])
+
+    def test_save_text_file_reuses_identical_content(self):
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            first = NoteService.save_text_file("same answer")
+            second = NoteService.save_text_file("same answer")
+            self.assertEqual(first.id, second.id)
+            self.assertEqual(first.extracted_text, "same answer")
+
+
+@override_settings(PASSAGE_WORDS=4, PASSAGE_OVERLAP_WORDS=2)
+class PassageTests(TestCase):
+    def test_spans_overlap_and_cover_text(self):
+        text = "one two  three four\nfive six seven"
+        spans = passage_spans(text)
+        self.assertEqual([text[start:end] for start, end in spans], [
+            "one two  three four", "three four\nfive six", "five six seven",
+        ])
+        self.assertEqual(passage_spans("   "), [])
+
+    def test_fetch_slices_text_in_database(self):
+        note = NoteService.ingest("alpha beta gamma delta epsilon zeta")
+        passages = list(note.passages.order_by('position'))
+        fetched = fetch_passages([(passages[1].id, 0.9), (passages[0].id, 0.5), (-1, 0.1)])
+        self.assertEqual([(p.text, p.score) for p in fetched], [("gamma delta epsilon zeta", 0.9), ("alpha beta gamma delta", 0.5)])
+
+    def test_context_fits_budget_and_merges_overlaps(self):
+        note = NoteService.ingest(" ".join(f"w{i}" for i in range(12)))
+        passages = fetch_passages([(passage.id, 1.0) for passage in note.passages.order_by('position')])
+        context = build_context(passages, max_tokens=2 * estimate_tokens("w " * 4))
+        self.assertEqual(context, "w0 w1 w2 w3 w4 w5")
+        self.assertLessEqual(estimate_tokens(build_context(passages, max_tokens=20)), 20)
+
+
+TFIDF_CORPUS = [
+    "photosynthesis converts light into chemical energy in green plants",
+    "the light reactions of photosynthesis happen in the thylakoid membrane",
+    "plants store chemical energy as starch",
+    "quantum computers use qubits instead of bits",
+    "a qubit can hold a superposition of states",
+    "green tea contains antioxidants",
+    "energy markets trade electricity and gas",
+    "membrane proteins move ions across the cell",
+]
+
+
+class IncrementalTfidfIndexTests(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+
+    def build(self, texts=TFIDF_CORPUS):
+        index = IncrementalTfidfIndex()
+        index.add(1, texts[0])
+        index.add_many(range(2, len(texts) + 1), texts[1:])
+        return index
+
+    def test_scores_match_full_refit(self):
+        from sklearn.feature_extraction.text import TfidfVectorizer
+
+        index = self.build()
+        vectorizer = TfidfVectorizer(stop_words='english')
+        matrix = vectorizer.fit_transform(TFIDF_CORPUS)
+        for query in ("green plants energy", "qubit states", "light membrane"):
+            expected = (matrix @ vectorizer.transform([query]).T).toarray().ravel()
+            scores = dict(index.search(query, top_k=len(TFIDF_CORPUS)))
+            for doc_id, score in enumerate(expected, start=1):
+                self.assertAlmostEqual(scores.get(doc_id, 0.0), score, places=6)
+
+    def test_top_k_matches_full_sort(self):
+        index = self.build()
+        ranked = index.search("photosynthesis light energy green plants", top_k=len(TFIDF_CORPUS))
+        self.assertEqual(index.search("photosynthesis light energy green plants", top_k=2, offset=1), ranked[1:3])
+        self.assertEqual([score for _, score in ranked], sorted((score for _, score in ranked), reverse=True))
+
+    def test_writes_are_searched_with_last_weights_until_refresh(self):
+        index = self.build()
+        index.search("qubit states")
+        new_id = len(TFIDF_CORPUS) + 1
+        index.add(new_id, "qubits decohere quickly")
+        with mock.patch.object(index, 'refresh') as refresh, \
+                mock.patch('notes.search_index.threading.Thread') as thread:
+            self.assertEqual(index.search("decohere")[0][0], new_id)
+            index.refresh_interval = 0
+            index.search("decohere")
+        refresh.assert_not_called()
+        thread.assert_called_once_with(target=index._refresh_in_background, daemon=True)
+
+        index.refresh()
+        exact = self.build(TFIDF_CORPUS + ["qubits decohere quickly"])
+        ranked = [(doc_id, round(score, 6)) for doc_id, score in index.search("qubit decohere", top_k=3)]
+        self.assertEqual(ranked, [(doc_id, round(score, 6)) for doc_id, score in exact.search("qubit decohere", top_k=3)])
+
+    def test_publish_and_load_round_trip(self):
+        index = self.build()
+        self.assertEqual(index_store.publish(index, self.root), 1)
+        with open(os.path.join(self.root, 'CURRENT'), encoding='utf-8') as f:
+            self.assertEqual(f.read(), 'gen-000001')
+        loaded = index_store.load(self.root)
+        self.assertEqual(loaded.generation, 1)
+        self.assertIsInstance(loaded._base_ids, np.memmap)
+        self.assertEqual(loaded.search("qubit states"), index.search("qubit states"))
+
+        # Passages added on top of a mapped generation are published with it.
+        loaded.add(len(TFIDF_CORPUS) + 1, "qubits decohere quickly")
+        index_store.publish(loaded, self.root)
+        index_store.publish(index_store.load(self.root), self.root)
+        self.assertEqual(index_store.current_generation(self.root), 3)
+        self.assertEqual(
+            sorted(name for name in os.listdir(self.root) if not name.startswith('.')),
+            ['CURRENT', 'gen-000002', 'gen-000003'],
+        )
+        self.assertEqual(index_store.load(self.root).search("decohere")[0][0], len(TFIDF_CORPUS) + 1)
+
+
+class FakeToken(str):
+    is_stop = False
+
+    @property
+    def is_alpha(self):
+        return self.isalpha()
+
+    @property
+    def lemma_(self):
+        return self.rstrip('s')
+
+
+class FakeNlp:
+    def __init__(self):
+        self.texts = []
+
+    def __call__(self, text):
+        self.texts.append(text)
+        return [FakeToken(word) for word in text.split()]
+
+    def pipe(self, texts, **kwargs):
+        return (self(text) for text in texts)
+
+
+class TaggingTests(TestCase):
+    def setUp(self):
+        self.nlp = FakeNlp()
+        patch = mock.patch.object(tagging.registry, 'get', return_value=self.nlp)
+        patch.start()
+        self.addCleanup(patch.stop)
+        tagging._query_tags.cache_clear()
+        self.addCleanup(tagging._query_tags.cache_clear)
+
+    def test_chunk_text_splits_on_whitespace_without_losing_text(self):
+        content = "\n".join(" ".join(f"word{i}" for i in range(line, line + 7)) for line in range(0, 500, 7))
+        chunks = list(tagging.chunk_text(content, chunk_size=100))
+        self.assertEqual("".join(chunks), content)
+        self.assertTrue(all(len(chunk) <= 100 for chunk in chunks))
+        self.assertTrue(all(chunk[-1].isspace() for chunk in chunks[:-1]))
+        # Only a run without whitespace is cut mid-word.
+        self.assertEqual(list(tagging.chunk_text("x" * 250, chunk_size=100)), ["x" * 100, "x" * 100, "x" * 50])
+
+    def test_counts_merge_across_chunks(self):
+        content = "Apples pears apple " * 50
+        chunk_text = tagging.chunk_text
+        with mock.patch('notes.tagging.chunk_text', lambda text: chunk_text(text, chunk_size=40)):
+            counts = tagging.generate_tag_counts(content)
+        self.assertGreater(len(self.nlp.texts), 1)
+        self.assertEqual(counts, {'apple': 100, 'pear': 50})
+
+    def test_query_keeps_its_casing(self):
+        self.assertEqual(tagging.query_tags("  Apples   Lisbon "), {'apple', 'lisbon'})
+        self.assertEqual(tagging.query_tags("Apples Lisbon"), {'apple', 'lisbon'})
+        self.assertEqual(self.nlp.texts, ["Apples Lisbon"])
+
+
+class ModelRegistryTests(TestCase):
+    def test_model_is_loaded_once_on_first_use(self):
+        loads = []
+
+        def loader():
+            time.sleep(0.05)
+            loads.append(1)
+            return object()
+
+        models = registry.ModelRegistry()
+        models.register('model', loader)
+        self.assertFalse(models.is_loaded('model'))
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            results = list(pool.map(lambda _: models.get('model'), range(8)))
+        self.assertEqual(len(loads), 1)
+        self.assertTrue(all(result is results[0] for result in results))
+        self.assertTrue(models.is_loaded('model'))
+
+
+class PdfRasterTests(TestCase):
+    def test_pages_are_rasterized_in_memory(self):
+        import fitz
+
+        doc = fitz.open()
+        for color in ((1, 0, 0), (0, 0, 1)):
+            page = doc.new_page(width=72, height=144)
+            page.draw_rect(page.rect, color=color, fill=color)
+        data = doc.tobytes()
+
+        with mock.patch('tempfile.NamedTemporaryFile', side_effect=AssertionError), \
+                mock.patch('tempfile.mkstemp', side_effect=AssertionError):
+            pages = list(utils.iter_pdf_pages(data, dpi=72))
+            self.assertEqual(len(list(utils.iter_pdf_pages(io.BytesIO(data), dpi=144))), 2)
+        self.assertEqual([page.shape for page in pages], [(144, 72, 3), (144, 72, 3)])
+        self.assertEqual(pages[0].dtype, np.uint8)
+        self.assertEqual(pages[0][72, 36].tolist(), [255, 0, 0])
+        self.assertEqual(pages[1][72, 36].tolist(), [0, 0, 255])
+
+
+class StubDetector:
+    """YOLOS stand-in whose only "label" for an image is its first pixel value."""
+    config = mock.Mock(id2label={value: f"label{value}" for value in range(256)})
+
+    def __init__(self):
+        self.batches = []
+
+    def __call__(self, pixel_values):
+        self.batches.append(len(pixel_values))
+        return pixel_values
+
+    def post_process_object_detection(self, outputs, threshold, target_sizes):
+        import torch
+
+        return [{"labels": torch.tensor([value])} for value in outputs]
+
+
+class DetectObjectsTests(TestCase):
+    def test_micro_batches_keep_one_label_list_per_image_in_order(self):
+        stub = StubDetector()
+        image_processor = mock.Mock(side_effect=lambda images, return_tensors: {
+            'pixel_values': [int(np.asarray(image)[0, 0, 0]) for image in images],
+        })
+        image_processor.post_process_object_detection = stub.post_process_object_detection
+        pages = [np.full((8, 6, 3), value, dtype=np.uint8) for value in (5, 3, 9, 1, 7)]
+        labels = utils.detect_objects(pages, batch_size=2, detector=(stub, image_processor))
+        self.assertEqual(labels, [["label5"], ["label3"], ["label9"], ["label1"], ["label7"]])
+        self.assertEqual(stub.batches, [2, 2, 1])
+
+
+def fake_embed(texts):
+    # Bag of hashed words: passages sharing words get a high cosine.
+    vectors = np.zeros((len(texts), 32), dtype=np.float32)
+    for row, text in enumerate(texts):
+        for word in text.split():
+            vectors[row, sum(word.encode()) % 32] += 1
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+class DenseIndexTests(TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        vectors = rng.normal(size=(400, 16)).astype(np.float32)
+        self.vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+
+    def publish_and_load(self, index):
+        with mock.patch.object(dense_index, 'IVF_MIN_ROWS', 100):
+            index_store.publish(index, self.root)
+        return index_store.load(self.root, DenseIndex)
+
+    def test_ivf_matches_exact_search_when_probing_every_list(self):
+        index = DenseIndex(dtype='float16', encode=fake_embed)
+        index.add_vectors(list(range(1, 401)), self.vectors)
+        loaded = self.publish_and_load(index)
+        self.assertEqual(loaded._centroids.shape, (20, 16))
+        self.assertEqual(len(loaded), 400)
+
+        query = self.vectors[7]
+        exact = [doc_id for doc_id, _ in index.search_vector(query, top_k=10)]
+        loaded.n_probe = 20
+        self.assertEqual([doc_id for doc_id, _ in loaded.search_vector(query, top_k=10)], exact)
+        loaded.n_probe = 1
+        self.assertEqual(loaded.search_vector(query, top_k=1)[0][0], 8)
+
+    def test_int8_vectors_and_delta_rows_are_searched(self):
+        index = DenseIndex(dtype='int8', encode=fake_embed)
+        index.add_vectors(list(range(1, 401)), self.vectors)
+        loaded = self.publish_and_load(index)
+        self.assertEqual(loaded._vectors.dtype, np.int8)
+        loaded.add_vectors([1000], self.vectors[:1] * -1)
+        (doc_id, score), = loaded.search_vector(-self.vectors[0], top_k=1)
+        self.assertEqual((doc_id, round(score, 3)), (1000, 1.0))
+        self.assertEqual(loaded.max_doc_id, 1000)
+
+    def test_generation_of_another_model_is_not_loaded(self):
+        index = DenseIndex(encode=fake_embed)
+        index.add_vectors([1], self.vectors[:1])
+        index_store.publish(index, self.root)
+        with override_settings(DENSE_EMBEDDING_MODEL='another-model'):
+            self.assertIsNone(index_store.load(self.root, DenseIndex))
+
+    def test_semantic_search_uses_configured_backend(self):
+        embed = mock.Mock(side_effect=fake_embed)
+        with override_settings(SEMANTIC_SEARCH_BACKEND='dense', DENSE_INDEX_DIR=self.root), \
+                mock.patch('notes.passages.embed_texts', fake_embed), \
+                mock.patch.object(dense_index, 'embed_texts', embed), \
+                mock.patch.object(note_search, 'passage_index', IncrementalTfidfIndex()), \
+                mock.patch.object(note_search, '_index_loaded', False):
+            note = NoteService.ingest("photosynthesis in green plants")
+            NoteService.ingest("quantum computing basics")
+            note_search.sync_passage_index()
+            self.assertIsInstance(note_search.passage_index, DenseIndex)
+            passages = fetch_passages(note_search.semantic_search("green plants photosynthesis", top_k=1))
+        self.assertEqual(passages[0].note_id, note.id)
+        # Passages were embedded at ingest; the search path only embeds the query.
+        embed.assert_called_once_with(["green plants photosynthesis"])
+
+    def test_build_note_index_embeds_passages_saved_without_embeddings(self):
+        note = NoteService.ingest("photosynthesis in green plants")
+        self.assertIsNone(Passage.objects.get(note=note).embedding)
+        with override_settings(SEMANTIC_SEARCH_BACKEND='dense', DENSE_INDEX_DIR=self.root), \
+                mock.patch.object(dense_index, 'embed_texts', fake_embed):
+            call_command('build_note_index', stdout=StringIO())
+            index = index_store.load(self.root, DenseIndex)
+        self.assertIsNotNone(Passage.objects.get(note=note).embedding)
+        self.assertEqual(len(index), 1)
+
+
+@override_settings(TAG_INDEX_ENABLED=False, PASSAGE_INDEX_DIR=os.path.join(tempfile.gettempdir(), 'missing'))
+class HybridSearchTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        create_tagged_files()
+        self.files = list(File.objects.order_by('id'))
+        self.both = NoteService.ingest("alpha beta results", source_file=self.files[2])
+        NoteService.ingest("alpha beta lecture", source_file=self.files[3])
+        NoteService.ingest("alpha beta lecture again", source_file=self.files[3])
+        self.loose = NoteService.ingest("alpha beta summary")
+        patches = [
+            mock.patch('notes.utils.query_tags', return_value={'alpha', 'beta'}),
+            mock.patch.object(note_search, 'passage_index', IncrementalTfidfIndex()),
+            mock.patch.object(note_search, '_index_loaded', True),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_rrf_sums_reciprocal_ranks(self):
+        fused = reciprocal_rank_fusion([['a', 'b'], ['b', 'c']], k=1)
+        self.assertEqual([key for key, _ in fused], ['b', 'a', 'c'])
+        self.assertAlmostEqual(fused[0][1], 1 / 3 + 1 / 2)
+
+    def test_fuses_both_retrievers_and_collapses_notes_of_a_file(self):
+        response = hybrid_search("alpha beta")
+        results = response['results']
+        self.assertEqual(response['total'], 5)
+        self.assertEqual(results[0]['file_id'], self.files[2].id)
+        self.assertEqual(results[0]['note_id'], self.both.id)
+        self.assertEqual(results[0]['snippet'], "alpha beta results")
+        self.assertIsNotNone(results[0]['tag_rank'])
+        self.assertIsNotNone(results[0]['passage_rank'])
+        self.assertEqual([r['file_id'] for r in results].count(self.files[3].id), 1)
+        self.assertIn({'type': 'note', 'note_id': self.loose.id}, [
+            {'type': r['type'], 'note_id': r['note_id']} for r in results if r['file_id'] is None
+        ])
+        self.assertEqual(set(response['timings']), {'tags', 'passages', 'fuse', 'total'})
+
+        second = hybrid_search("alpha beta", page=2, per_page=2)
+        self.assertEqual([r['score'] for r in second['results']], [r['score'] for r in results[2:4]])
+
+    def test_view_returns_json_page(self):
+        self.assertEqual(self.client.get(reverse('hybrid_search')).status_code, 400)
+        response = self.client.get(reverse('hybrid_search'), {'query': "alpha beta", 'page': 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['results'][0]['file_name'], "file2.txt")
+
+    def test_upload_page_lists_fused_results(self):
+        response = self.client.post(reverse('upload'), {'action': 'search', 'query': "alpha beta"})
+        self.assertEqual(response.context['results'][0]['file_name'], "file2.txt")
+        self.assertContains(response, "alpha beta results")
+        self.assertContains(response, "alpha beta summary")
+
+    @mock.patch('notes.views.SEARCH_PAGE_SIZE', 2)
+    def test_results_page_links_to_next_and_previous_pages(self):
+        response = self.client.post(reverse('upload'), {'action': 'search', 'query': "alpha beta"})
+        self.assertEqual(len(response.context['results']), 2)
+        self.assertContains(response, 'href="?query=alpha%20beta&page=2"')
+        self.assertNotContains(response, "Previous")
+
+        response = self.client.get(reverse('upload'), {'query': "alpha beta", 'page': 3})
+        self.assertEqual(len(response.context['results']), 1)
+        self.assertContains(response, 'href="?query=alpha%20beta&page=2"')
+        self.assertNotContains(response, "Next")
+
+
+LOCMEM_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'answers': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'answers'},
+}
+
+
+async def fake_reply(prompt, deadline=None):
+    for word in ("the", "answer", "is", "forty", "two"):
+        yield word + " "
+
+
+@override_settings(CACHES=LOCMEM_CACHES, PASSAGE_INDEX_DIR=os.path.join(tempfile.gettempdir(), 'missing'))
+class ChatSearchTests(TransactionTestCase):
+    def setUp(self):
+        answer_cache._cache().clear()
+        self.note = NoteService.ingest("the answer to everything is forty two")
+        self.llm = mock.Mock(side_effect=fake_reply)
+        patches = [
+            mock.patch.object(note_search, 'passage_index', IncrementalTfidfIndex()),
+            mock.patch.object(note_search, '_index_loaded', True),
+            mock.patch('notes.llm.stream_generate', self.llm),
+            mock.patch('notes.chat.registry.get', return_value=mock.Mock(return_value={'answer': "42"})),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def ask(self, question):
+        return self.client.post(reverse('search_notes'), {'message': question}).json()['response']
+
+    def test_repeated_question_is_answered_from_cache(self):
+        # The counters are process totals, kept across tests.
+        before = self.client.get(reverse('answer_cache_stats')).json()
+        self.assertEqual(self.ask("What is the answer to everything?"), "42")
+        self.assertEqual(self.ask("  what is the answer to  everything "), "42")
+        self.assertEqual(self.llm.call_count, 1)
+        stats = self.client.get(reverse('answer_cache_stats')).json()
+        self.assertEqual((stats['hits'] - before['hits'], stats['misses'] - before['misses']), (1, 1))
+        self.assertGreaterEqual(stats['saved_seconds'], before['saved_seconds'])
+
+    def test_changed_note_is_not_served_from_cache(self):
+        self.ask("what is the answer to everything")
+        Note.objects.filter(id=self.note.id).update(content="the answer to everything is forty one")
+        self.ask("what is the answer to everything")
+        self.assertEqual(self.llm.call_count, 2)
+
+    async def test_stream_sends_tokens_then_answer(self):
+        response = await self.async_client.post(reverse('search_notes_stream'), {'message': "the answer to everything"})
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        body = b''.join([chunk async for chunk in response.streaming_content]).decode()
+        events = [block.split('\n') for block in body.strip().split('\n\n')]
+        self.assertEqual([lines[0] for lines in events], ['event: token'] * 5 + ['event: answer'])
+        self.assertEqual(events[-1][1], 'data: {"text": "42"}')
+
+        response = await self.async_client.post(reverse('search_notes_stream'), {'message': "the answer to everything"})
+        body = b''.join([chunk async for chunk in response.streaming_content]).decode()
+        self.assertEqual(body, 'event: answer\ndata: {"text": "42"}\n\n')
+
+
+@override_settings(LLM_BACKEND='gemini', LLM_RETRY_BASE_MS=1)
+class LLMClientTests(TestCase):
+    def use_transport(self, handler):
+        import httpx
+
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler), base_url='http://llm')
+        patch = mock.patch.object(llm.get_backend(), '_client', return_value=client)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    @staticmethod
+    def sse_response(*words):
+        import httpx
+
+        events = ''.join(
+            f"data: {{\"candidates\": [{{\"content\": {{\"parts\": [{{\"text\": \"{word}\"}}]}}}}]}}\r\n\r\n"
+            for word in words
+        )
+        return httpx.Response(200, text=events, headers={'content-type': 'text/event-stream'})
+
+    async def test_joins_streamed_chunks(self):
+        def handler(request):
+            self.assertEqual(request.url.params['alt'], 'sse')
+            return self.sse_response("Hello ", "world")
+
+        self.use_transport(handler)
+        self.assertEqual(await llm.generate("hi"), "Hello world")
+
+    async def test_retries_server_errors(self):
+        import httpx
+
+        responses = [httpx.Response(503, text="overloaded"), self.sse_response("Hello")]
+        handler = mock.Mock(side_effect=lambda request: responses.pop(0))
+        self.use_transport(handler)
+        self.assertEqual(await llm.generate("hi"), "Hello")
+        self.assertEqual(handler.call_count, 2)
+
+    async def test_errors_are_raised_as_llm_error(self):
+        import httpx
+
+        handler = mock.Mock(return_value=httpx.Response(400, text="bad request"))
+        self.use_transport(handler)
+        with self.assertRaisesMessage(llm.LLMError, "400"):
+            await llm.generate("hi")
+        self.assertEqual(handler.call_count, 1)
+
+        self.use_transport(lambda request: httpx.Response(503, text="overloaded"))
+        with self.assertRaisesMessage(llm.LLMError, "503"):
+            await llm.generate("hi")
+
+    def test_client_is_closed_with_its_event_loop(self):
+        async def open_client():
+            return llm.get_backend()._client()
+
+        self.assertTrue(async_to_sync(open_client)().is_closed)
+
+
+@override_settings(LLM_BACKEND='fake', LLM_BATCH_SIZE=1, FAKE_LLM_TOKENS=4)
+class FakeLLMBackendTests(TestCase):
+    prompt = "Today's date and time is: now\nalpha beta\n\nBased on the above information, what?"
+
+    async def test_replies_are_deterministic(self):
+        self.assertEqual(await llm.generate(self.prompt), "alpha beta alpha beta ")
+        self.assertEqual(await llm.generate(self.prompt), "alpha beta alpha beta ")
+
+    @override_settings(FAKE_LLM_FIRST_TOKEN_MS=1000)
+    async def test_gives_up_when_the_budget_runs_out(self):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        with self.assertRaisesMessage(llm.LLMError, "budget"):
+            await llm.generate(self.prompt, deadline=start + 0.05)
+        self.assertLess(loop.time() - start, 0.5)
+
+    @override_settings(FAKE_LLM_FIRST_TOKEN_MS=300, LLM_MAX_CONCURRENCY=1)
+    async def test_fails_fast_without_capacity(self):
+        deadline = asyncio.get_running_loop().time() + 0.1
+        slow = asyncio.create_task(llm.generate(self.prompt))
+        await asyncio.sleep(0)
+        with self.assertRaisesMessage(llm.LLMError, "capacity"):
+            await llm.generate(self.prompt, deadline=deadline)
+        self.assertEqual(await slow, "alpha beta alpha beta ")
+
+    @override_settings(FAKE_LLM_FIRST_TOKEN_MS=300, LLM_MAX_CONCURRENCY=1)
+    def test_capacity_is_shared_by_event_loops(self):
+        # Under WSGI each request runs on an event loop of its own.
+        async def generate_within(seconds):
+            return await llm.generate(self.prompt, deadline=asyncio.get_running_loop().time() + seconds)
+
+        with ThreadPoolExecutor(3) as pool:
+            slow = pool.submit(async_to_sync(generate_within), 5)
+            time.sleep(0.1)
+            starved = pool.submit(async_to_sync(generate_within), 0.1)
+            waiting = pool.submit(async_to_sync(generate_within), 5)
+            with self.assertRaisesMessage(llm.LLMError, "capacity"):
+                starved.result()
+            self.assertEqual(slow.result(), "alpha beta alpha beta ")
+            self.assertEqual(waiting.result(), "alpha beta alpha beta ")
+
+    @override_settings(LLM_BATCH_SIZE=4, LLM_BATCH_WAIT_MS=50)
+    async def test_batches_concurrent_prompts(self):
+        backend = llm.get_backend()
+        with mock.patch.object(backend, 'generate_batch', side_effect=backend.generate_batch) as generate_batch:
+            replies = await asyncio.gather(*[llm.generate(f"date\nword{number}") for number in range(4)])
+        self.assertEqual(replies, [" ".join([f"word{number}"] * 4) for number in range(4)])
+        self.assertEqual(generate_batch.call_count, 1)
+
+
+class LRUFileBasedCacheTests(TestCase):
+    def test_culls_least_recently_used_entries(self):
+        with tempfile.TemporaryDirectory() as location:
+            cache = LRUFileBasedCache(location, {'OPTIONS': {'MAX_ENTRIES': 3, 'CULL_FREQUENCY': 3}})
+            for age, key in enumerate(['a', 'b', 'c']):
+                cache.set(key, key)
+                os.utime(cache._key_to_file(key), (1000 + age, 1000 + age))
+            self.assertEqual(cache.get('a'), 'a')
+            cache.set('d', 'd')
+            self.assertIsNone(cache.get('b'))
+            self.assertEqual([cache.get(key) for key in 'acd'], ['a', 'c', 'd'])
+
+
+class ChunkedUploadTests(TestCase):
+    data = bytes(range(256)) * 40
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        patch = override_settings(MEDIA_ROOT=media_root)
+        patch.enable()
+        self.addCleanup(patch.disable)
+
+    def start(self, **fields):
+        response = self.client.post(reverse('upload_session_start'), {'name': "scan.txt", 'size': len(self.data), **fields})
+        return response.status_code, response.json()
+
+    def put(self, session, start, end):
+        return self.client.put(
+            reverse('upload_session', args=[session['id']]), self.data[start:end],
+            content_type='application/octet-stream', HTTP_CONTENT_RANGE=f"bytes {start}-{end - 1}/{len(self.data)}",
+        )
+
+    def test_chunks_are_hashed_and_queued_in_place(self):
+        _, session = self.start()
+        for start in range(0, len(self.data), 4096):
+            response = self.put(session, start, min(start + 4096, len(self.data)))
+            self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()['complete'])
+        job = IngestJob.objects.get()
+        self.assertEqual(job.content_hash, hashlib.sha256(self.data).hexdigest())
+        self.assertEqual(job.original_name, "scan.txt")
+        with job.upload.open('rb') as upload:
+            self.assertEqual(upload.read(), self.data)
+
+    def test_resumes_from_received_offset(self):
+        _, session = self.start()
+        self.put(session, 0, 1000)
+        response = self.put(session, 2000, 3000)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['received'], 1000)
+        self.assertEqual(self.client.get(reverse('upload_session', args=[session['id']])).json()['received'], 1000)
+        self.put(session, 1000, len(self.data))
+        self.assertEqual(IngestJob.objects.get().content_hash, hashlib.sha256(self.data).hexdigest())
+
+    def test_chunks_in_other_processes_hash_once_at_completion(self):
+        _, session = self.start()
+        with mock.patch('notes.uploads._hash_received', wraps=uploads._hash_received) as hash_received:
+            for start in range(0, len(self.data), 2048):
+                # Every chunk reaches a process without the running digest.
+                uploads._digests.clear()
+                self.assertEqual(self.put(session, start, min(start + 2048, len(self.data))).status_code, 200)
+        self.assertEqual(hash_received.call_count, 1)
+        self.assertEqual(IngestJob.objects.get().content_hash, hashlib.sha256(self.data).hexdigest())
+
+    def test_chunk_being_written_holds_its_offset(self):
+        _, session = self.start()
+        lease = timezone.now() + timedelta(minutes=5)
+        UploadSession.objects.update(writing_until=lease)
+        response = self.put(session, 0, 1000)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['received'], 0)
+        # An expired lease is taken over.
+        UploadSession.objects.update(writing_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(self.put(session, 0, 1000).status_code, 200)
+        self.assertIsNone(UploadSession.objects.get().writing_until)
+
+    def test_known_hash_is_rejected_before_upload(self):
+        content_hash = hashlib.sha256(self.data).hexdigest()
+        existing = File.objects.create(file_name="old.txt", file_content="old.txt", content_hash=content_hash)
+        status, session = self.start(sha256=content_hash.upper())
+        self.assertEqual(status, 201)
+        self.assertTrue(session['complete'])
+        self.assertEqual(session['job']['file_id'], existing.id)
+        self.assertTrue(session['job']['duplicate'])
+        self.assertEqual(self.put(session, 0, 10).status_code, 409)
+
+    def test_mismatched_hash_discards_upload(self):
+        _, session = self.start(sha256='0' * 64)
+        response = self.put(session, 0, len(self.data))
+        self.assertEqual(response.status_code, 422)
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertFalse(IngestJob.objects.exists())
+
+    def test_rejects_bad_ranges(self):
+        _, session = self.start()
+        url = reverse('upload_session', args=[session['id']])
+        response = self.client.put(url, b'abc', content_type='application/octet-stream', HTTP_CONTENT_RANGE='bytes 0-9/10240')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.put(url, b'abc', content_type='application/octet-stream', HTTP_CONTENT_RANGE='bytes 0-2/3')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.start(size=0)[0], 413)
+
+    def test_requires_csrf_token(self):
+        self.client = Client(enforce_csrf_checks=True)
+        response = self.client.post(reverse('upload_session_start'), {'name': "scan.txt", 'size': len(self.data)})
+        self.assertEqual(response.status_code, 403)
+        self.client.get(reverse('upload'))
+        token = self.client.cookies[settings.CSRF_COOKIE_NAME].value
+        response = self.client.post(
+            reverse('upload_session_start'), {'name': "scan.txt", 'size': len(self.data)}, HTTP_X_CSRFTOKEN=token,
+        )
+        self.assertEqual(response.status_code, 201)
+        session = response.json()
+        url = reverse('upload_session', args=[session['id']])
+        range_header = f"bytes 0-{len(self.data) - 1}/{len(self.data)}"
+        response = self.client.put(url, self.data, content_type='application/octet-stream', HTTP_CONTENT_RANGE=range_header)
+        self.assertEqual(response.status_code, 403)
+        response = self.client.put(
+            url, self.data, content_type='application/octet-stream', HTTP_CONTENT_RANGE=range_header, HTTP_X_CSRFTOKEN=token,
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def test_read_text_file_falls_back_to_latin1(self):
+        path = os.path.join(settings.MEDIA_ROOT, 'note.txt')
+        with open(path, 'wb') as f:
+            f.write("café".encode('latin-1'))
+        self.assertEqual(read_text_file(path), "café")
+        open(path, 'wb').close()
+        self.assertEqual(read_text_file(path), "")
+
+
+class IngestJobTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        patch = override_settings(MEDIA_ROOT=self.media_root)
+        patch.enable()
+        self.addCleanup(patch.disable)
+        patch = mock.patch('notes.ingest.generate_tag_counts', return_value={'alpha': 1})
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def queue(self, data=b"alpha notes"):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+
+        return ingest.enqueue_upload(SimpleUploadedFile("notes.txt", data))
+
+    def test_file_and_note_are_saved_together(self):
+        job = self.queue()
+        IngestJob.objects.filter(id=job.id).update(status=IngestJob.RUNNING, attempts=1)
+        with mock.patch.object(NoteService, 'ingest', side_effect=RuntimeError("note failed")):
+            ingest.run_job(job.id)
+        job.refresh_from_db()
+        self.assertEqual(job.status, IngestJob.QUEUED)
+        self.assertFalse(File.objects.exists())
+        self.assertEqual([names for _, _, names in os.walk(os.path.join(self.media_root, 'files')) if names], [])
+
+        ingest.run_job(job.id)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.stage), (IngestJob.DONE, 'done'))
+        self.assertEqual(Note.objects.get().source_file, job.result_file)
+
+    def test_upload_is_moved_into_place_not_copied(self):
+        job = self.queue()
+        staged = os.stat(job.upload.path).st_ino
+        IngestJob.objects.filter(id=job.id).update(status=IngestJob.RUNNING, attempts=1)
+        ingest.run_job(job.id)
+        stored = File.objects.get()
+        self.assertEqual(os.stat(stored.file_content.path).st_ino, staged)
+        self.assertTrue(stored.file_content.name.startswith(f"files/{stored.content_hash[:2]}/{stored.content_hash}/"))
+        self.assertFalse(os.path.exists(job.upload.path))
+
+    def test_duplicate_restores_a_missing_note_from_extracted_text(self):
+        job = self.queue()
+        IngestJob.objects.filter(id=job.id).update(status=IngestJob.RUNNING, attempts=1)
+        ingest.run_job(job.id)
+        stored = File.objects.get()
+        self.assertEqual(stored.extracted_text, "alpha notes")
+        Note.objects.all().delete()
+
+        with mock.patch('notes.ingest.extract_text') as extract_text, \
+                mock.patch.object(NoteService, 'ingest', wraps=NoteService.ingest) as save_note:
+            duplicate = self.queue()
+            save_note.assert_not_called()
+            self.assertEqual((duplicate.stage, duplicate.result_file_id), ('duplicate', stored.id))
+            rebuild = IngestJob.objects.get(status=IngestJob.QUEUED)
+            ingest.run_job(rebuild.id)
+        extract_text.assert_not_called()
+        rebuild.refresh_from_db()
+        self.assertEqual((rebuild.status, rebuild.stage, rebuild.result_file_id), (IngestJob.DONE, 'duplicate', stored.id))
+        self.assertEqual(Note.objects.get().content, "alpha notes")
+        self.queue()
+        self.assertFalse(IngestJob.objects.filter(status=IngestJob.QUEUED).exists())
+        self.assertEqual(Note.objects.count(), 1)
+
+
+class IngestQueueTests(TransactionTestCase):
+    def create_job(self, **fields):
+        return IngestJob.objects.create(original_name="notes.txt", **fields)
+
+    def test_claims_due_jobs_oldest_first(self):
+        now = timezone.now()
+        later = self.create_job(run_after=now - timedelta(seconds=1))
+        first = self.create_job(run_after=now - timedelta(seconds=2))
+        self.create_job(run_after=now + timedelta(hours=1))
+        self.assertEqual([ingest.claim_job(), ingest.claim_job(), ingest.claim_job()], [first.id, later.id, None])
+        first.refresh_from_db()
+        self.assertEqual((first.status, first.attempts), (IngestJob.RUNNING, 1))
+
+    def test_reclaims_abandoned_jobs_until_out_of_attempts(self):
+        stale = timezone.now() - timedelta(seconds=settings.INGEST_JOB_TIMEOUT + 1)
+        job = self.create_job(status=IngestJob.RUNNING, attempts=1, locked_at=stale)
+        spent = self.create_job(status=IngestJob.RUNNING, attempts=3, locked_at=stale)
+        self.assertEqual(ingest.claim_job(), job.id)
+        self.assertIsNone(ingest.claim_job())
+        job.refresh_from_db()
+        spent.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (IngestJob.RUNNING, 2))
+        self.assertEqual((spent.status, spent.error), (IngestJob.FAILED, "Timed out."))
+
+    def test_failed_attempts_back_off_then_fail(self):
+        job = self.create_job()
+        for attempt in range(1, job.max_attempts + 1):
+            IngestJob.objects.filter(id=job.id).update(run_after=timezone.now())
+            self.assertEqual(ingest.claim_job(), job.id)
+            before = timezone.now()
+            ingest._fail(IngestJob.objects.get(id=job.id), RuntimeError("boom"))
+            job.refresh_from_db()
+            self.assertEqual((job.attempts, job.error), (attempt, "boom"))
+            if attempt < job.max_attempts:
+                self.assertEqual(job.status, IngestJob.QUEUED)
+                self.assertGreaterEqual(job.run_after, before + timedelta(seconds=settings.INGEST_RETRY_BACKOFF * 2 ** (attempt - 1)))
+        self.assertEqual(job.status, IngestJob.FAILED)
+        self.assertIsNone(ingest.claim_job())
+
+    def test_broken_pool_fails_the_attempt_and_restarts(self):
+        from concurrent.futures import Future
+        from concurrent.futures.process import BrokenProcessPool
+
+        class BrokenPool:
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc_info):
+                pass
+
+            def submit(self, fn, *args):
+                future = Future()
+                future.set_exception(BrokenProcessPool("killed"))
+                return future
+
+        job = self.create_job()
+        with mock.patch('notes.ingest.ProcessPoolExecutor', side_effect=lambda **kwargs: BrokenPool()) as pool:
+            ingest.run_worker(processes=1, poll_interval=0, once=True)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts, job.error), (IngestJob.QUEUED, 1, "killed"))
+        self.assertEqual(pool.call_count, 2)
+
+
+@override_settings(OCR_CACHE_ALIAS='default', OCR_PROCESSES=None)
+class OcrTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(ocr.limit_processes, None)
+
+    @mock.patch('notes.ocr.preprocess', side_effect=lambda image: image)
+    @mock.patch('notes.ocr.pytesseract')
+    def test_pages_are_ocrd_once(self, pytesseract, _):
+        pytesseract.image_to_string.return_value = "scanned text"
+        page = mock.Mock(tobytes=mock.Mock(return_value=b'pixels'))
+        self.assertEqual([ocr.ocr_image(page), ocr.ocr_image(page)], ["scanned text", "scanned text"])
+        pytesseract.image_to_string.assert_called_once_with(page)
+
+    @mock.patch('notes.ocr.ProcessPoolExecutor')
+    @mock.patch('notes.ocr._ocr_pdf_page', side_effect=lambda path, number, dpi: f"page {number}")
+    def test_ingest_processes_split_the_cores(self, ocr_pdf_page, pool):
+        with mock.patch('notes.ingest.connections'), mock.patch('os.cpu_count', return_value=8):
+            ingest._init_pool_process(8)
+            self.assertEqual(ocr.ocr_pdf_pages('scan.pdf', ["text", "", " "]), ["text", "page 1", "page 2"])
+            pool.assert_not_called()
+
+            ingest._init_pool_process(2)
+            ocr.ocr_pdf_pages('scan.pdf', [""] * 10)
+            self.assertEqual(pool.call_args.kwargs['max_workers'], 4)
+
+
+class DownloadTests(TestCase):
+    data = bytes(range(100))
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        patch = override_settings(MEDIA_ROOT=media_root)
+        patch.enable()
+        self.addCleanup(patch.disable)
+        os.makedirs(os.path.join(media_root, 'files'))
+        with open(os.path.join(media_root, 'files', 'scan.pdf'), 'wb') as f:
+            f.write(self.data)
+        self.file = File.objects.create(file_name="scan.pdf", file_content='files/scan.pdf', content_hash='abc123')
+        self.url = reverse('download_file', args=[self.file.id])
+
+    def test_parse_ranges(self):
+        self.assertEqual(parse_ranges('bytes=0-9,5-19,30-', 100), [(0, 19), (30, 99)])
+        self.assertEqual(parse_ranges('bytes=-10', 100), [(90, 99)])
+        self.assertEqual(parse_ranges('bytes=200-300', 100), [])
+        self.assertIsNone(parse_ranges('bytes=9-1', 100))
+        self.assertIsNone(parse_ranges('items=0-9', 100))
+        with self.settings(DOWNLOAD_MAX_RANGES=2):
+            self.assertIsNone(parse_ranges('bytes=0-1,3-4,6-7', 100))
+
+    def test_full_download_has_validators(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.data)
+        self.assertEqual(response['ETag'], '"abc123"')
+        self.assertEqual(response['Content-Length'], '100')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertIn('Last-Modified', response)
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="scan.pdf"')
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH='"abc123"')
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_single_range(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/100')
+        self.assertEqual(b''.join(response.streaming_content), self.data[10:20])
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=10-19', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(self.url, HTTP_RANGE='bytes=500-').status_code, 416)
+
+    def test_multiple_ranges(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-4,90-')
+        self.assertEqual(response.status_code, 206)
+        boundary = response['Content-Type'].split('boundary=')[1]
+        body = b''.join(response.streaming_content)
+        self.assertEqual(int(response['Content-Length']), len(body))
+        parts = body.split(f"--{boundary}".encode())[1:-1]
+        self.assertEqual([part.split(b'\r\n\r\n', 1)[1][:-2] for part in parts], [self.data[:5], self.data[90:]])
+        self.assertIn(b'Content-Range: bytes 90-99/100', parts[1])
+
+    @override_settings(DOWNLOAD_BLOCK_SIZE=16)
+    async def test_streams_blocks_under_asgi(self):
+        response = await self.async_client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_async)
+        blocks = [block async for block in response.streaming_content]
+        self.assertEqual(len(blocks), 7)
+        self.assertEqual(b''.join(blocks), self.data)
+        self.assertEqual(response['Content-Length'], '100')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="scan.pdf"')
+
+        response = await self.async_client.get(self.url, headers={'Range': 'bytes=0-4,60-'})
+        self.assertEqual(response.status_code, 206)
+        self.assertTrue(response.is_async)
+        body = b''.join([block async for block in response.streaming_content])
+        self.assertEqual(int(response['Content-Length']), len(body))
+        self.assertIn(self.data[60:], body)
+
+    @override_settings(DOWNLOAD_OFFLOAD='x-accel-redirect', DOWNLOAD_ACCEL_PREFIX='/protected/')
+    def test_offload_to_web_server(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response['X-Accel-Redirect'], '/protected/files/scan.pdf')
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response['ETag'], '"abc123"')
+
+
+class InferenceRuntimeTests(TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+
+    def test_runtime_setting(self):
+        with override_settings(INFERENCE_RUNTIME={'qa': 'onnx-int8'}):
+            self.assertEqual(inference.runtime('qa'), 'onnx-int8')
+            self.assertEqual(inference.runtime('yolos'), 'eager')
+        with override_settings(INFERENCE_RUNTIME={'qa': 'tensorrt'}):
+            with self.assertRaises(ValueError):
+                inference.runtime('qa')
+
+    def test_export_is_cached(self):
+        exports = []
+
+        def export(path):
+            exports.append(path)
+            with open(path, 'w') as f:
+                f.write('onnx')
+
+        with override_settings(TRANSFORMERS_CACHE=self.cache_dir):
+            path = inference._export('hustvl/yolos-tiny', False, export)
+            self.assertEqual(path, os.path.join(self.cache_dir, 'onnx', 'hustvl--yolos-tiny', 'model.onnx'))
+            self.assertEqual(inference._export('hustvl/yolos-tiny', False, export), path)
+        self.assertEqual(len(exports), 1)
+        self.assertEqual(os.listdir(os.path.dirname(path)), ['model.onnx'])
+
+    def test_qa_parity(self):
+        samples = [("Who?", "Ada wrote it."), ("When?", "In 1843.")]
+        baseline = lambda question, context: {'answer': context.split()[0]}
+        candidate = lambda question, context: {'answer': ' Ada ' if question == "Who?" else 'In 1843'}
+        self.assertEqual(inference.qa_parity(baseline, baseline, samples), 1.0)
+        self.assertEqual(inference.qa_parity(baseline, candidate, samples), 0.5)
+
+    def test_detection_parity(self):
+        baseline = [['cat', 'dog'], [], ['car']]
+        self.assertEqual(inference.detection_parity(baseline, baseline), 1.0)
+        self.assertAlmostEqual(inference.detection_parity(baseline, [['cat'], [], ['bus']]), 0.5)
+
+
+class MetricsTests(TestCase):
+    def test_timed_block_and_functions(self):
+        before = {stage: metrics.STAGE_SECONDS.count((stage,)) for stage in ('test_block', 'test_function', 'test_stream')}
+        with metrics.timed('test_block') as timer:
+            pass
+        self.assertGreaterEqual(timer.seconds, 0)
+        self.assertEqual(metrics.STAGE_SECONDS.count(('test_block',)), before['test_block'] + 1)
+
+        @metrics.timed('test_function')
+        def fail():
+            raise ValueError
+
+        errors = metrics.STAGE_ERRORS.value(('test_function',))
+        with self.assertRaises(ValueError):
+            fail()
+        self.assertEqual(metrics.STAGE_SECONDS.count(('test_function',)), before['test_function'] + 1)
+        self.assertEqual(metrics.STAGE_ERRORS.value(('test_function',)), errors + 1)
+
+        @metrics.timed('test_stream')
+        async def stream():
+            for word in ('a', 'b', 'c'):
+                yield word
+
+        async def first_word():
+            chunks = stream()
+            word = await chunks.__anext__()
+            await chunks.aclose()
+            return word
+
+        self.assertEqual(asyncio.run(first_word()), 'a')
+        self.assertEqual(metrics.STAGE_SECONDS.count(('test_stream',)), before['test_stream'] + 1)
+        self.assertEqual(metrics.STAGE_ERRORS.value(('test_stream',)), 0)
+
+    def test_request_metrics(self):
+        labels = ('ingest_jobs', 'GET', '200')
+        before = metrics.REQUEST_SECONDS.count(labels)
+        queries = metrics.REQUEST_QUERIES.series.get(('ingest_jobs',), [0.0])[-1]
+        self.client.get(reverse('ingest_jobs'))
+        self.assertEqual(metrics.REQUEST_SECONDS.count(labels), before + 1)
+        self.assertEqual(metrics.REQUEST_QUERIES.series[('ingest_jobs',)][-1], queries + 1)
+
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'kmsimba_request_duration_seconds_bucket{view="ingest_jobs",method="GET",status="200"', response.content)
+        self.assertEqual(self.client.get(reverse('metrics'), REMOTE_ADDR='10.0.0.1').status_code, 403)
+
+    def test_collect_sums_processes(self):
+        metrics_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, metrics_dir)
+        histogram = metrics.Histogram('test_seconds', "Test.", ['stage'], buckets=(1, 2))
+        self.addCleanup(metrics._metrics.remove, histogram)
+        histogram.observe(('a',), 0.5)
+        with open(os.path.join(metrics_dir, '1-other.json'), 'w') as f:
+            f.write('{"test_seconds": [[["a"], [0, 1, 1, 7.5]], [["b"], [1, 0]]]}')
+
+        with override_settings(METRICS_DIR=metrics_dir), mock.patch.object(metrics, '_file', None):
+            text = metrics.render()
+            self.assertEqual(len(os.listdir(metrics_dir)), 2)
+        self.assertIn('test_seconds_bucket{stage="a",le="1.0"} 1\n', text)
+        self.assertIn('test_seconds_bucket{stage="a",le="2.0"} 2\n', text)
+        self.assertIn('test_seconds_bucket{stage="a",le="+Inf"} 3\n', text)
+        self.assertIn('test_seconds_sum{stage="a"} 8.0\n', text)
+        self.assertIn('test_seconds_count{stage="a"} 3\n', text)
+        # Recorded with other buckets
+        self.assertNotIn('stage="b"', text)
+
+    def test_files_of_exited_processes_are_folded_in(self):
+        metrics_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, metrics_dir)
+        counter = metrics.Counter('test_events', "Test.", ['kind'])
+        self.addCleanup(metrics._metrics.remove, counter)
+        counter.inc(('a',))
+        for name, count in (('1-live.json', 2), ('999999-exited.json', 4)):
+            with open(os.path.join(metrics_dir, name), 'w') as f:
+                f.write(f'{{"test_events": [[["a"], [{count}]]]}}')
+
+        alive = mock.patch.object(metrics, '_alive', side_effect=lambda pid: pid != 999999)
+        with override_settings(METRICS_DIR=metrics_dir), mock.patch.object(metrics, '_file', None), \
+                mock.patch.object(metrics, '_adopted', {}), alive:
+            self.assertIn('test_events_total{kind="a"} 7\n', metrics.render())
+            own = os.path.basename(metrics._file)
+            self.assertEqual(sorted(os.listdir(metrics_dir)), sorted(['1-live.json', own]))
+            self.assertIn('test_events_total{kind="a"} 7\n', metrics.render())
+            counter.inc(('a',))
+            self.assertIn('test_events_total{kind="a"} 8\n', metrics.render())
+
+    def test_observing_never_flushes_on_the_calling_thread(self):
+        with mock.patch.object(metrics, 'flush') as flush, mock.patch.object(metrics, '_flusher_started', False), \
+                mock.patch('notes.metrics.threading.Thread') as thread:
+            metrics.observe_stage('test_flush', 0.1, failed=True)
+            metrics.observe_stage('test_flush', 0.1)
+        flush.assert_not_called()
+        thread.assert_called_once_with(target=metrics._run_flusher, name='metrics-flush', daemon=True)
+
+    def test_slow_request_profile(self):
+        profile_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, profile_dir)
+
+        def busy_view():
+            deadline = time.perf_counter() + 0.1
+            while time.perf_counter() < deadline:
+                pass
+
+        with override_settings(PROFILE_SLOW_REQUEST_MS=50, PROFILE_SAMPLE_INTERVAL_MS=1, PROFILE_DIR=profile_dir):
+            sample = profiler.begin()
+            busy_view()
+            self.assertIsNone(profiler.finish(profiler.begin(), 0.01, 'GET fast'))
+            path = profiler.finish(sample, 0.1, 'GET notes:busy')
+        with open(path) as f:
+            self.assertIn('busy_view', f.read())
+        self.assertEqual(os.listdir(profile_dir), [os.path.basename(path)])
@@ -0,0 +1,241 @@
+"""Chunked, resumable uploads.
+
+A client opens a session with the file's name and size, and optionally its
+SHA-256, then sends the bytes in order as raw request bodies, each with a
+``Content-Range: bytes start-end/size`` header. A chunk is copied from the
+request into the session's file in ``UPLOAD_STREAM_BLOCK`` pieces, so a
+request holds one block in memory whatever the size of the file. The body is
+never read as a whole, so ``DATA_UPLOAD_MAX_MEMORY_SIZE`` does not apply. An
+interrupted client asks the session for ``received`` and continues from
+there.
+
+A chunk is written without holding a transaction or row lock. A conditional
+update of the session claims the chunk's offset with a lease of
+``UPLOAD_CHUNK_LEASE`` seconds, so no other request writes there
+meanwhile. Another conditional update then commits ``received``; a lease
+that expired mid-chunk and was taken over fails the chunk.
+
+The SHA-256 is updated as the bytes arrive. hashlib state cannot be stored,
+so each process keeps the running digests of the sessions it receives. Once
+a chunk reaches a process without the digest at the right offset (another
+worker, or a restart), the running digest is dropped and the file is hashed
+once when it is complete, rather than rehashing the bytes on disk for every
+chunk.
+
+A declared hash that matches a stored file finishes the session as a
+duplicate before any byte is sent. Otherwise the final hash is checked
+against the declared one and against stored files. A new file is then queued
+for ingestion where it lies, without a copy.
+
+Sessions idle for ``UPLOAD_SESSION_TTL`` are deleted with their bytes.
+"""
+import logging
+import os
+import re
+import threading
+from datetime import timedelta
+from hashlib import sha256
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.text import get_valid_filename
+
+from .ingest import duplicate_job, job_status
+from .metrics import timed
+from .models import IngestJob, UploadSession
+from .utils import HASH_CHUNK_SIZE, rename_file_if_too_long
+
+logger = logging.getLogger(__name__)
+
+CONTENT_RANGE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
+# Running digests by session id, as (offset, hash object).
+_digests = {}
+_digests_lock = threading.Lock()
+
+
+class UploadError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_content_range(header):
+    """Return ``(start, end, size)`` of a ``bytes start-end/size`` header; ``end`` is inclusive."""
+    match = CONTENT_RANGE.match(header or '')
+    if not match:
+        raise UploadError("Content-Range must be 'bytes start-end/size'.")
+    start, end, size = (int(group) for group in match.groups())
+    if end < start or end >= size:
+        raise UploadError("Content-Range is out of bounds.", status=416)
+    return start, end, size
+
+
+def session_status(session):
+    return {
+        'id': str(session.token),
+        'name': session.original_name,
+        'size': session.size,
+        'received': session.received,
+        'complete': session.job_id is not None,
+        'job': job_status(session.job) if session.job_id else None,
+    }
+
+
+def _full_path(session):
+    return default_storage.path(session.path)
+
+
+def _discard(session):
+    with _digests_lock:
+        _digests.pop(session.id, None)
+    default_storage.delete(session.path)
+
+
+def expire_sessions():
+    """Delete sessions idle for longer than ``UPLOAD_SESSION_TTL``, with any bytes not handed to a job."""
+    cutoff = timezone.now() - timedelta(seconds=settings.UPLOAD_SESSION_TTL)
+    for session in UploadSession.objects.filter(updated_at__lt=cutoff):
+        if session.job_id is None:
+            _discard(session)
+        session.delete()
+
+
+def start_upload(name, size, expected_hash=''):
+    name = os.path.basename(name or '').strip()
+    if not name:
+        raise UploadError("File name cannot be empty.")
+    name = get_valid_filename(name)
+    if size <= 0 or size > settings.UPLOAD_MAX_SIZE:
+        raise UploadError(f"File size must be between 1 and {settings.UPLOAD_MAX_SIZE} bytes.", status=413)
+    expected_hash = expected_hash.lower()
+    if expected_hash and not re.fullmatch(r'[0-9a-f]{64}', expected_hash):
+        raise UploadError("sha256 must be 64 hex digits.")
+
+    expire_sessions()
+    session = UploadSession(original_name=name, size=size, expected_hash=expected_hash)
+    job = duplicate_job(name, expected_hash) if expected_hash else None
+    if job is not None:
+        session.job = job
+        session.content_hash = expected_hash
+    else:
+        # ingest/<token>-<name> keeps the extension the extractors go by.
+        session.path = f"ingest/{session.token.hex}-{rename_file_if_too_long(name, max_length=50)}"
+        full_path = _full_path(session)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        open(full_path, 'wb').close()
+    session.save()
+    return session
+
+
+def _hash_received(session):
+    digest = sha256()
+    remaining = session.received
+    with open(_full_path(session), 'rb') as f:
+        while remaining:
+            block = f.read(min(HASH_CHUNK_SIZE, remaining))
+            if not block:
+                raise UploadError("Upload data is missing; start a new upload.", status=410)
+            digest.update(block)
+            remaining -= len(block)
+    return digest
+
+
+def _claim(token, start, size):
+    """Lease the session for writing the chunk at ``start``; return it and the lease's expiry."""
+    now = timezone.now()
+    lease = now + timedelta(seconds=settings.UPLOAD_CHUNK_LEASE)
+    claimed = UploadSession.objects.filter(
+        Q(writing_until__isnull=True) | Q(writing_until__lt=now),
+        token=token, job__isnull=True, size=size, received=start,
+    ).update(writing_until=lease, updated_at=now)
+    session = UploadSession.objects.get(token=token)
+    if not claimed:
+        if session.job_id is not None:
+            raise UploadError("Upload is already complete.", status=409)
+        if size != session.size:
+            raise UploadError("Size does not match the session.")
+        if start != session.received:
+            raise UploadError(f"Expected a chunk starting at byte {session.received}.", status=409)
+        raise UploadError("Another chunk of this upload is being written.", status=409)
+    return session, lease
+
+
+@timed('upload_chunk')
+def write_chunk(token, content_range, stream, length):
+    """Append ``length`` bytes read from ``stream`` to the session at the offset given by ``content_range``."""
+    start, end, size = parse_content_range(content_range)
+    if end - start + 1 != length:
+        raise UploadError("Content-Length does not match Content-Range.")
+    if length > settings.UPLOAD_CHUNK_MAX_SIZE:
+        raise UploadError(f"Chunks may be at most {settings.UPLOAD_CHUNK_MAX_SIZE} bytes.", status=413)
+
+    # The bytes are copied outside any transaction; the lease keeps other requests off this offset.
+    session, lease = _claim(token, start, size)
+    with _digests_lock:
+        offset, digest = _digests.pop(session.id, (None, None))
+    if offset != start:
+        # Earlier chunks went to another process: the file is hashed once it is complete.
+        digest = None
+    remaining = length
+    try:
+        with open(_full_path(session), 'r+b') as out:
+            out.seek(start)
+            while remaining:
+                block = stream.read(min(settings.UPLOAD_STREAM_BLOCK, remaining))
+                if not block:
+                    break
+                out.write(block)
+                if digest is not None:
+                    digest.update(block)
+                remaining -= len(block)
+    finally:
+        # A chunk cut short by the client keeps what arrived; the client resumes from ``received``.
+        session.received = start + length - remaining
+        committed = UploadSession.objects.filter(id=session.id, received=start, writing_until=lease).update(
+            received=session.received, writing_until=None, updated_at=timezone.now(),
+        )
+    if not committed:
+        raise UploadError("The chunk took too long and was taken over by another request.", status=409)
+    if session.received < session.size:
+        if digest is not None:
+            with _digests_lock:
+                _digests[session.id] = (session.received, digest)
+        return session
+
+    content_hash = (digest or _hash_received(session)).hexdigest()
+    with transaction.atomic():
+        matches = _complete(session, content_hash)
+    if not matches:
+        raise UploadError("Upload does not match the declared sha256.", status=422)
+    return session
+
+
+def _complete(session, content_hash):
+    """Queue the finished upload; ``False`` (and the session deleted) if it is not what was declared."""
+    if session.expected_hash and content_hash != session.expected_hash:
+        _discard(session)
+        session.delete()
+        return False
+    session.content_hash = content_hash
+    session.job = duplicate_job(session.original_name, content_hash)
+    if session.job is not None:
+        _discard(session)
+    else:
+        session.job = IngestJob.objects.create(
+            original_name=session.original_name, upload=session.path, content_hash=content_hash,
+        )
+    session.save(update_fields=['content_hash', 'job', 'updated_at'])
+    logger.info(f"Upload {session.token} complete: {session.size} bytes, sha256 {content_hash}")
+    return True
+
+
+def abort_upload(token):
+    with transaction.atomic():
+        session = UploadSession.objects.select_for_update().get(token=token)
+        if session.job_id is None:
+            _discard(session)
+        session.delete()
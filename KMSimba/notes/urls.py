@@ -7,11 +7,17 @@ urlpatterns = [
     path('search/', views.search_notes_view, name='search_notes'),
     path('save/', views.save_note_view, name='save_note'),
     path('save_response/', views.save_plain_text_response_view, name='save_plain_text_response'),  # Ensure this is correct
+    path('search/stream/', views.search_notes_stream_view, name='search_notes_stream'),  # Answer streamed as SSE
+    path('search/cache/', views.answer_cache_stats_view, name='answer_cache_stats'),  # Answer cache hit rate
+    path('retrieve/', views.hybrid_search_view, name='hybrid_search'),  # Files and notes ranked together (JSON)
     path('upload/', views.upload_and_search, name='upload'),  # For uploading files and searching
-    path('search/', views.upload_and_search, name='search'),  # For searching files
     path('download/<int:file_id>/', views.download_file, name='download_file'),  # For downloading files
     path('delete/<int:file_id>/', views.delete_file, name='delete_file'),  # For deleting files
     path('rename/<int:file_id>/', views.rename_file, name='rename_file'),  # For renaming files
     path('files/', views.upload_and_search, name='files'),  # To fetch the list of files
+    path('jobs/', views.ingest_jobs, name='ingest_jobs'),  # Recent ingestion jobs
+    path('jobs/<int:job_id>/', views.ingest_job_status, name='ingest_job_status'),  # Status and progress of one job
+    path('uploads/', views.upload_session_start_view, name='upload_session_start'),  # Open a chunked, resumable upload
+    path('uploads/<uuid:token>/', views.upload_session_view, name='upload_session'),  # Progress, chunks (PUT) and abort (DELETE)
 
 ]
@@ -1,77 +1,99 @@
 import io
+import logging
 from django.shortcuts import render, get_object_or_404, redirect
 from django.http import HttpResponse, FileResponse, JsonResponse
-from .models import File, Tag, FileTag
+from .models import File, FileChange, Tag, FileTag
 from .forms import UploadFileForm, SearchForm
+from .metrics import timed
+from .ocr import ocr_image
+from .registry import registry
+from .tagging import query_tags
 from hashlib import sha256
-import pdfplumber
-import textract
-import docx2txt
-import spacy
 from PIL import Image
-import pytesseract
 import os
 import uuid
 from django.views.decorators.http import require_http_methods
-from django.db.models import Count
-from collections import defaultdict
+from django.db import IntegrityError, transaction
+from django.core.cache import cache
+from django.db.models import Avg, Case, Count, F, FloatField, Max, Sum, Value, When
+from collections import Counter, OrderedDict
+import math
+import mmap
 import re
 import json
 from django.conf import settings
-from transformers import YolosImageProcessor, YolosForObjectDetection
-import torch
-import fitz
-import tempfile
+import numpy as np
+import threading
 
-# Lazy model loading
+logger = logging.getLogger(__name__)
+
+# Heavy libraries (torch, transformers, spaCy, fitz, ...) are imported where
+# they are used and models come from the registry, so importing this module
+# stays cheap.
 def get_yolos_model():
-    if not hasattr(get_yolos_model, "model") or not hasattr(get_yolos_model, "image_processor"):
-        get_yolos_model.model = YolosForObjectDetection.from_pretrained('hustvl/yolos-tiny')
-        get_yolos_model.image_processor = YolosImageProcessor.from_pretrained('hustvl/yolos-tiny')
-    return get_yolos_model.model, get_yolos_model.image_processor
+    return registry.get('yolos')
 
-# Conditional Tesseract path for Windows
-if os.name == 'nt':
-    pytesseract.pytesseract.tesseract_cmd = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
+def iter_pdf_pages(source, dpi=None):
+    """Yield each page of a PDF as an RGB ``numpy`` array, one page at a time.
 
-# Load spaCy NLP model
-nlp = spacy.load('en_core_web_sm')
+    ``source`` may be a path, raw bytes, a file object or an open ``fitz``
+    document. Nothing is written to disk and only the current page's pixels
+    are held in memory.
+    """
+    import fitz
 
-import tempfile
+    dpi = dpi or settings.PDF_RASTER_DPI
+    if isinstance(source, fitz.Document):
+        doc, owned = source, False
+    elif isinstance(source, (bytes, bytearray)):
+        doc, owned = fitz.open(stream=source, filetype="pdf"), True
+    elif hasattr(source, "read"):
+        source.seek(0)
+        doc, owned = fitz.open(stream=source.read(), filetype="pdf"), True
+    else:
+        doc, owned = fitz.open(source), True
 
-def extract_images_from_pdf(pdf_path):
-    doc = fitz.open(pdf_path)
-    image_paths = []
+    try:
+        for page in doc:
+            with timed('pdf_rasterize'):
+                pix = page.get_pixmap(dpi=dpi, colorspace=fitz.csRGB, alpha=False)
+            yield np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+    finally:
+        if owned:
+            doc.close()
 
-    with tempfile.TemporaryDirectory() as temp_dir:
-        for page_num in range(len(doc)):
-            page = doc.load_page(page_num)
-            pix = page.get_pixmap()
-            img_path = os.path.join(temp_dir, f"page_{page_num + 1}.jpg")
-            pix.save(img_path)
-            # Immediately process the image and keep data in memory
-            image_paths.append(img_path)
+def _as_rgb_image(image):
+    if isinstance(image, Image.Image):
+        return image.convert("RGB")
+    if hasattr(image, "__array_interface__"):
+        return Image.fromarray(image).convert("RGB")
+    return Image.open(image).convert("RGB")
 
-        # Move or copy images out of the temp directory before it closes
-        persistent_paths = []
-        for path in image_paths:
-            final_path = os.path.join(settings.MEDIA_ROOT, "pdf_images", os.path.basename(path))
-            os.makedirs(os.path.dirname(final_path), exist_ok=True)
-            with open(path, "rb") as src, open(final_path, "wb") as dst:
-                dst.write(src.read())
-            persistent_paths.append(final_path)
+@timed('yolos')
+def detect_objects(images, batch_size=None, threshold=0.9, detector=None):
+    """Return the detected label names for each of ``images``.
 
-        return persistent_paths
+    ``images`` may hold PIL images, arrays, paths or file objects; they are run
+    through YOLOS in micro-batches of ``batch_size`` under inference mode.
+    ``detector`` is a ``(model, image_processor)`` pair, the shared one by default.
+    """
+    import torch
 
+    batch_size = batch_size or settings.YOLOS_BATCH_SIZE
+    model, image_processor = detector or get_yolos_model()
+    labels = []
+    for start in range(0, len(images), batch_size):
+        batch = [_as_rgb_image(image) for image in images[start:start + batch_size]]
+        with torch.inference_mode():
+            inputs = image_processor(images=batch, return_tensors="pt")
+            outputs = model(**inputs)
+        target_sizes = torch.tensor([image.size[::-1] for image in batch])
+        results = image_processor.post_process_object_detection(outputs, threshold=threshold, target_sizes=target_sizes)
+        labels.extend([model.config.id2label[label.item()] for label in result["labels"]] for result in results)
+    return labels
 
 def Obj_Detect_Name(image_path):
-    image = Image.open(image_path)
-    model, image_processor = get_yolos_model()
-    inputs = image_processor(images=image, return_tensors="pt")
-    outputs = model(**inputs)
-    target_sizes = torch.tensor([image.size[::-1]])
-    results = image_processor.post_process_object_detection(outputs, threshold=0.9, target_sizes=target_sizes)[0]
-    return [model.config.id2label[label.item()] for label in results["labels"]]
+    return detect_objects([image_path])[0]
 
 def convert_png_to_jpg(png_path):
     img = Image.open(png_path)
@@ -84,40 +106,38 @@ def convert_png_to_jpg(png_path):
 def extract_text_from_image(image):
     try:
         img = Image.open(image)
-        return pytesseract.image_to_string(img)
+        return ocr_image(img)
     except Exception as e:
         return f"Error extracting text from image: {e}"
 
+@timed('pdf_text')
+def pdf_page_texts(file):
+    """Text layer of every page, ``""`` for pages without one (e.g. scans)."""
+    import pdfplumber
+
+    with pdfplumber.open(file) as pdf:
+        return [page.extract_text() or "" for page in pdf.pages]
+
 def pdf_reader(file):
     try:
-        with pdfplumber.open(file) as pdf:
-            all_text = ""
-            for page in pdf.pages:
-                text = page.extract_text()
-                all_text += text + "\n" if text else ""
-            return all_text
+        return "".join(text + "\n" for text in pdf_page_texts(file) if text)
     except Exception as e:
         return f"Error reading PDF: {e}"
 
-def doc_reader(file):
+@timed('doc_text')
+def doc_reader(path):
     try:
-        if file.name.endswith('.doc'):
-            text = textract.process(file).decode('utf-8')
+        import docx2txt
+        import textract
+
+        if path.endswith('.doc'):
+            text = textract.process(path).decode('utf-8')
         else:
-            text = docx2txt.process(file)
+            text = docx2txt.process(path)
         return text
     except Exception as e:
         return f"Error reading document: {e}"
 
-def generate_tags(content):
-    try:
-        doc = nlp(content)
-        tags = {token.lemma_.lower() for token in doc if token.is_alpha and not token.is_stop and len(token) > 2}
-        return tags
-    except Exception as e:
-        print(f"Error generating tags: {e}")
-        return set()
-
 def rename_file_if_too_long(file_name, max_length=50):
     name, ext = os.path.splitext(file_name)
     if len(file_name) > max_length:
@@ -125,39 +145,254 @@ def rename_file_if_too_long(file_name, max_length=50):
         return trimmed_name
     return file_name
 
-def save_file(file_name, file_content, tags):
-    try:
-        file_name = rename_file_if_too_long(file_name, max_length=50)
-        content_hash = sha256(file_content.read()).hexdigest()
+# Bounded LRU of tag name -> id shared by every request in this process
+TAG_ID_CACHE_SIZE = 50000
+TAG_QUERY_BATCH_SIZE = 500
+_tag_id_cache = OrderedDict()
+_tag_id_cache_lock = threading.Lock()
+
+def _remember_tag_ids(tag_ids):
+    with _tag_id_cache_lock:
+        for name, tag_id in tag_ids.items():
+            _tag_id_cache[name] = tag_id
+            _tag_id_cache.move_to_end(name)
+        while len(_tag_id_cache) > TAG_ID_CACHE_SIZE:
+            _tag_id_cache.popitem(last=False)
+
+def resolve_tag_ids(tag_names):
+    """Return ``{name: id}`` for ``tag_names``, creating missing tags in bulk."""
+    names = {name[:255] for name in tag_names if name}
+    tag_ids = {}
+    with _tag_id_cache_lock:
+        for name in names:
+            if name in _tag_id_cache:
+                _tag_id_cache.move_to_end(name)
+                tag_ids[name] = _tag_id_cache[name]
+    missing = sorted(names - tag_ids.keys())
+    if not missing:
+        return tag_ids
+
+    found = {}
+    for start in range(0, len(missing), TAG_QUERY_BATCH_SIZE):
+        batch = missing[start:start + TAG_QUERY_BATCH_SIZE]
+        found.update(Tag.objects.filter(name__in=batch).values_list('name', 'id'))
+    new_names = [name for name in missing if name not in found]
+    if new_names:
+        Tag.objects.bulk_create([Tag(name=name) for name in new_names], ignore_conflicts=True, batch_size=TAG_QUERY_BATCH_SIZE)
+        for start in range(0, len(new_names), TAG_QUERY_BATCH_SIZE):
+            batch = new_names[start:start + TAG_QUERY_BATCH_SIZE]
+            found.update(Tag.objects.filter(name__in=batch).values_list('name', 'id'))
+
+    # Only cache ids once they are committed, a rollback would leave them dangling.
+    transaction.on_commit(lambda: _remember_tag_ids(found))
+    tag_ids.update(found)
+    return tag_ids
+
+# === BM25 ranking of tag search ===
+BM25_K1 = 1.2
+BM25_B = 0.75
+CORPUS_STATS_TIMEOUT = 600
+
+def bm25_term_weight(term_frequency, doc_length, avg_doc_length):
+    length_norm = 1 - BM25_B + BM25_B * doc_length / avg_doc_length if avg_doc_length else 1
+    return term_frequency * (BM25_K1 + 1) / (term_frequency + BM25_K1 * length_norm)
+
+def bm25_idf(doc_freq, doc_count):
+    return math.log(1 + (doc_count - doc_freq + 0.5) / (doc_freq + 0.5))
+
+def corpus_generation():
+    """Id of the last ``FileChange``, which every write to a file or its tags logs.
+
+    Corpus statistics are cached per process under the generation they were
+    read at, so a file tagged by the ingest worker changes the keys every
+    web process looks up.
+    """
+    return FileChange.objects.aggregate(last=Max('id'))['last'] or 0
+
+def corpus_stats(generation=None):
+    """Number of files and their average tag length.
+
+    Cached under ``generation``, or for a few minutes without one: weighting
+    the tags of a new file only needs the average roughly.
+    """
+    key = 'file_corpus_stats' if generation is None else f"file_corpus_stats:{generation}"
+    stats = cache.get(key)
+    if stats is None:
+        stats = File.objects.aggregate(doc_count=Count('id'), avg_doc_length=Avg('doc_length'))
+        stats['avg_doc_length'] = stats['avg_doc_length'] or 0
+        cache.set(key, stats, CORPUS_STATS_TIMEOUT)
+    return stats
+
+def save_file_tags(file_instance, tags, log_change=True):
+    """Link ``tags`` (names, or a mapping of name -> term frequency) to a file.
+
+    ``log_change=False`` skips the ``FileChange`` row when the caller's
+    transaction has already logged one for the file.
+    """
+    from .tag_index import index_file_tags
+
+    counts = Counter()
+    if isinstance(tags, dict):
+        for name, term_frequency in tags.items():
+            counts[name[:255]] += term_frequency
+    else:
+        counts.update(name[:255] for name in set(tags))
+    counts.pop('', None)
+
+    tag_ids = resolve_tag_ids(counts)
+    doc_length = sum(counts.values())
+    if file_instance.doc_length != doc_length:
+        file_instance.doc_length = doc_length
+        # No post_save: the file and its tags are logged as one change.
+        File.objects.filter(id=file_instance.id).update(doc_length=doc_length)
+    avg_doc_length = corpus_stats()['avg_doc_length'] or doc_length
+    weights = {
+        tag_ids[name]: bm25_term_weight(term_frequency, doc_length, avg_doc_length)
+        for name, term_frequency in counts.items()
+    }
+    FileTag.objects.bulk_create(
+        [
+            FileTag(file=file_instance, tag_id=tag_ids[name], term_frequency=term_frequency, weight=weights[tag_ids[name]])
+            for name, term_frequency in counts.items()
+        ],
+        ignore_conflicts=True,
+        batch_size=TAG_QUERY_BATCH_SIZE,
+    )
+    index_file_tags(file_instance, tag_ids, weights, log_change=log_change)
+    return tag_ids
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+@timed('hash_file')
+def hash_file(file_content):
+    """SHA-256 of a file object, read in chunks so it is never fully in memory."""
+    digest = sha256()
+    if hasattr(file_content, 'chunks'):
+        for chunk in file_content.chunks(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    else:
         file_content.seek(0)
+        for chunk in iter(lambda: file_content.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    file_content.seek(0)
+    return digest.hexdigest()
+
+@timed('text_file')
+def read_text_file(path):
+    """Decode a text file as UTF-8, falling back to Latin-1, straight from a memory map."""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ''
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            try:
+                return str(data, 'utf-8')
+            except UnicodeDecodeError:
+                return str(data, 'latin-1')
 
-        file_instance = File(file_name=file_name, file_content=file_content, content_hash=content_hash)
-        file_instance.save()
-        # After saving file_instance
-        print(f"Associating tags: {tags} with file: {file_instance.file_name}")  # DEBUG
+def find_duplicate(content_hash):
+    return File.objects.filter(content_hash=content_hash).first()
 
+@timed('save_file')
+def save_file(file_name, file_content, tags, content_hash=None, extracted_text=''):
+    try:
+        file_name = rename_file_if_too_long(file_name, max_length=50)
+        content_hash = content_hash or hash_file(file_content)
 
-        saved_file_path = file_instance.file_content.path
-        print(f"File saved at: {saved_file_path}")
+        file_instance = File(
+            file_name=file_name,
+            file_content=file_content,
+            content_hash=content_hash,
+            extracted_text=extracted_text,
+        )
+        try:
+            with transaction.atomic():
+                file_instance.save()
+                saved_file_path = file_instance.file_content.path
+                logger.debug(f"Saved {file_instance.file_name} at {saved_file_path} with tags {tags}")
 
-        if not os.path.exists(saved_file_path):
-            print(f"Error: File was saved but does not exist at path: {saved_file_path}")
-            return
+                if not os.path.exists(saved_file_path):
+                    logger.error(f"File was saved but does not exist at path: {saved_file_path}")
+                    return
 
-        for tag_name in tags:
-            tag, _ = Tag.objects.get_or_create(name=tag_name)
-            FileTag.objects.create(file=file_instance, tag=tag)
+                # post_save of the file has logged its change in this transaction.
+                save_file_tags(file_instance, tags, log_change=False)
+        except IntegrityError:
+            # The same content was stored concurrently; link to that copy instead.
+            file_instance.file_content.delete(save=False)
+            return find_duplicate(content_hash)
+        return file_instance
     except Exception as e:
-        print(f"Error saving file: {e}")
-
-def perform_search(query):
-    search_tags = generate_tags(query)
-    print(f"Generated tags from query: {search_tags}") 
-    file_hit_count = defaultdict(int)
-    for tag in search_tags:
-        tag_file_hits = FileTag.objects.filter(tag__name=tag).values_list('file', flat=True).distinct()
-        for file_hit in tag_file_hits:
-            file_hit_count[file_hit] += 1
-    sorted_file_hits = sorted(file_hit_count.items(), key=lambda x: x[1], reverse=True)
-    print(sorted_file_hits)
-    return [File.objects.get(id=file_id) for file_id, _ in sorted_file_hits]
\ No newline at end of file
+        logger.error(f"Error saving file: {e}")
+
+def tag_doc_freqs(tag_names, generation=None):
+    """Map tag name -> (id, number of files), cached like ``corpus_stats``."""
+    if generation is None:
+        generation = corpus_generation()
+    keys = {f"tag_df:{generation}:{name}": name for name in tag_names}
+    cached = cache.get_many(keys)
+    doc_freqs = {keys[key]: value for key, value in cached.items()}
+    missing = [name for key, name in keys.items() if key not in cached]
+    if missing:
+        rows = Tag.objects.filter(name__in=missing).annotate(doc_freq=Count('filetag')).values_list('name', 'id', 'doc_freq')
+        found = {name: (tag_id, doc_freq) for name, tag_id, doc_freq in rows}
+        for name in missing:
+            doc_freqs[name] = found.get(name, (None, 0))
+        cache.set_many({key: doc_freqs[name] for key, name in keys.items() if key not in cached}, CORPUS_STATS_TIMEOUT)
+    return doc_freqs
+
+SEARCH_PAGE_SIZE = 50
+
+# Not timed: on the in-memory tag index a search takes about 0.1 ms, and timing
+# it cost over 1% of that (benchmarks/bench_metrics_overhead.py).
+def perform_search(query, page=1, per_page=SEARCH_PAGE_SIZE):
+    """Rank files by BM25 over their tags.
+
+    With ``TAG_INDEX_ENABLED`` the in-process postings in ``notes.tag_index``
+    are scored and the database is not queried. Otherwise query tags are
+    weighted by idf from cached document frequencies, then the matching
+    ``FileTag`` rows are scored as sum(idf * weight) per file, ordered and
+    paginated in a single query that only walks the (tag, file) index.
+    """
+    search_tags = query_tags(query)
+    if not search_tags:
+        return []
+    start = (max(page, 1) - 1) * per_page
+    if settings.TAG_INDEX_ENABLED:
+        from .tag_index import get_tag_index
+
+        files = []
+        for file_id, file_name, file_score in get_tag_index().search(search_tags, offset=start, limit=per_page):
+            file = File.from_db(File.objects.db, ['id', 'file_name'], (file_id, file_name))
+            file.score = file_score
+            files.append(file)
+        return files
+
+    generation = corpus_generation()
+    doc_count = corpus_stats(generation)['doc_count']
+    idf = {
+        tag_id: bm25_idf(doc_freq, max(doc_count, doc_freq))
+        for tag_id, doc_freq in tag_doc_freqs(search_tags, generation).values() if doc_freq
+    }
+    if not idf:
+        return []
+
+    score = Sum(
+        Case(
+            *[When(tag_id=tag_id, then=F('weight') * Value(tag_idf)) for tag_id, tag_idf in idf.items()],
+            default=Value(0.0),
+            output_field=FloatField(),
+        )
+    )
+    ranked = (
+        FileTag.objects.filter(tag_id__in=idf)
+        .values('file_id', 'file__file_name')
+        .annotate(score=score)
+        .order_by('-score', 'file_id')
+        .values_list('file_id', 'file__file_name', 'score')[start:start + per_page]
+    )
+    files = []
+    for file_id, file_name, file_score in ranked:
+        file = File.from_db(ranked.db, ['id', 'file_name'], (file_id, file_name))
+        file.score = file_score
+        files.append(file)
+    return files
@@ -3,81 +3,37 @@ import os
 import re
 import json
 import logging
-from datetime import datetime
 
 # === Django Imports ===
 from django.shortcuts import render, get_object_or_404
-from django.http import JsonResponse, HttpResponse, FileResponse
-from django.utils import timezone
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
-from django.core.cache import cache
-from django.core.files.storage import default_storage
 from django.conf import settings
 
 # === Third-Party Libraries ===
-import requests
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
-from django.db import OperationalError, ProgrammingError
-
-from transformers import pipeline, AutoTokenizer, AutoModelForCausalLM
-import google.generativeai as genai
+from django.db import transaction
 
 # === App-Specific Imports ===
-from .models import Note, Tag, File
+from .models import Tag, File, IngestJob, UploadSession
+from .answer_cache import cache_stats
+from .chat import answer, retrieve_passages, stream_answer
+from .downloads import serve_file
+from .hybrid_search import hybrid_search
+from .ingest import enqueue_upload, job_status
+from .llm import new_deadline
+from .services import NoteService
+from .uploads import UploadError, abort_upload, session_status, start_upload, write_chunk
 from .utils import (
+    SEARCH_PAGE_SIZE,
     UploadFileForm,
     SearchForm,
-    pdf_reader,
-    doc_reader,
-    extract_text_from_image,
-    extract_images_from_pdf,
-    Obj_Detect_Name,
-    generate_tags,
-    save_file,
-    perform_search,
-    convert_png_to_jpg,
+    resolve_tag_ids,
     rename_file_if_too_long,
 )
 
 # === Configuration ===
-GEMINI_API_KEY = "GeminiKey"
-now = datetime.now().strftime("%B %d, %Y %H:%M:%S")
 logger = logging.getLogger(__name__)
-url = 'http://127.0.0.1:8000/notes/save/'
-
-# === Setup Gemini API ===
-genai.configure(api_key=GEMINI_API_KEY)
-gemini_model = genai.GenerativeModel("gemini-1.5-flash-latest")
-
-def ask_gemini(query, context):
-    prompt = f"Today's date and time is: {now}\n{context}\n\nBased on the above information, {query}"
-    response = gemini_model.generate_content(prompt)
-    return response.text
-
-# === HuggingFace QA Model ===
-question_answerer = pipeline("question-answering", model='distilbert-base-cased-distilled-squad')
-
-# === Semantic Search Setup ===
-tfidf_vectorizer = TfidfVectorizer(stop_words='english')
-corpus_matrix = None
-notes_corpus = []
-
-def encode_corpus(notes):
-    if not notes or all(not note.strip() for note in notes):
-        raise ValueError("Input 'notes' is empty or contains only whitespace.")
-    return tfidf_vectorizer.fit_transform(notes)
-
-def semantic_search(query, top_k=5):
-    global corpus_matrix
-    if corpus_matrix is None:
-        logger.warning("Corpus matrix is not initialized. Skipping search.")
-        return []
-    query_vec = tfidf_vectorizer.transform([query])
-    similarities = cosine_similarity(query_vec, corpus_matrix).flatten()
-    top_indices = similarities.argsort()[::-1][:top_k]
-    return [(notes_corpus[idx], similarities[idx]) for idx in top_indices if similarities[idx] > 0]
 
 # === Notes Views ===
 @csrf_exempt
@@ -88,8 +44,7 @@ def save_note_view(request):
             return JsonResponse({'response': 'Note content cannot be empty.'}, status=400)
 
         try:
-            Note.objects.create(content=content)
-            update_corpus()
+            NoteService.ingest(content)
             return JsonResponse({'response': 'Note saved successfully.'})
         except Exception as e:
             logger.error(f"Error saving note: {e}")
@@ -97,23 +52,17 @@ def save_note_view(request):
 
     return JsonResponse({'response': 'Invalid request method.'}, status=400)
 
-@csrf_exempt
-def search_notes_view(request):
+async def search_notes_view(request):
     if request.method == 'POST':
         query = request.POST.get('message', '').strip()
         if not query:
             return JsonResponse({'response': 'Query cannot be empty.'}, status=400)
 
-        if corpus_matrix is None or not notes_corpus:
-            load_existing_notes()
-
         try:
-            results = semantic_search(query)
-            if results:
-                relevant_notes = "\n\n".join([f"{note}" for note, _ in results])
-                response = ask_gemini(query, relevant_notes)
-                result = question_answerer(question=query, context=response)
-                return JsonResponse({'response': result['answer']})
+            deadline = new_deadline()
+            passages = await retrieve_passages(query)
+            if passages:
+                return JsonResponse({'response': await answer(query, passages, deadline)})
             return JsonResponse({'response': 'No relevant notes found.'})
         except Exception as e:
             logger.error(f"Error during semantic search: {e}")
@@ -121,6 +70,62 @@ def search_notes_view(request):
 
     return JsonResponse({'response': 'Invalid request method.'}, status=400)
 
+def _sse(event, text):
+    return f"event: {event}\ndata: {json.dumps({'text': text})}\n\n"
+
+async def search_notes_stream_view(request):
+    """Answer like ``search_notes_view``, streaming the LLM reply as server-sent events.
+
+    Emits ``token`` events with pieces of the reply as they arrive, then one
+    ``answer`` (or ``error``) event.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'response': 'Invalid request method.'}, status=400)
+    query = request.POST.get('message', '').strip()
+    if not query:
+        return JsonResponse({'response': 'Query cannot be empty.'}, status=400)
+
+    async def events():
+        try:
+            deadline = new_deadline()
+            passages = await retrieve_passages(query)
+            if not passages:
+                yield _sse('answer', 'No relevant notes found.')
+                return
+            async for event, text in stream_answer(query, passages, deadline):
+                yield _sse(event, text)
+        except Exception as e:
+            logger.error(f"Error during streamed search: {e}")
+            yield _sse('error', 'An error occurred during the search.')
+
+    response = StreamingHttpResponse(events(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+# csrf_exempt cannot wrap coroutine views before Django 5.0.
+search_notes_view.csrf_exempt = True
+search_notes_stream_view.csrf_exempt = True
+
+@require_http_methods(["GET", "POST"])
+def hybrid_search_view(request):
+    query = (request.POST.get('query') or request.GET.get('query') or '').strip()
+    if not query:
+        return JsonResponse({'response': 'Query cannot be empty.'}, status=400)
+    try:
+        page = int(request.POST.get('page') or request.GET.get('page') or 1)
+    except ValueError:
+        page = 1
+
+    try:
+        return JsonResponse(hybrid_search(query, page=page))
+    except Exception as e:
+        logger.error(f"Error during hybrid search: {e}")
+        return JsonResponse({'response': 'An error occurred during the search.'}, status=500)
+
+def answer_cache_stats_view(request):
+    return JsonResponse(cache_stats())
+
 @csrf_exempt
 def save_plain_text_response_view(request):
     if request.method == 'POST':
@@ -129,8 +134,7 @@ def save_plain_text_response_view(request):
             return JsonResponse({'response': 'Note content cannot be empty.'}, status=400)
 
         try:
-            file_path = save_note_to_file(content)
-            Note.objects.create(content=content, file_path=file_path)
+            NoteService.ingest(content, source_file=NoteService.save_text_file(content))
             return JsonResponse({'response': 'Note saved successfully.'})
         except Exception as e:
             logger.error(f"Error saving plain text note: {e}")
@@ -138,26 +142,6 @@ def save_plain_text_response_view(request):
 
     return JsonResponse({'response': 'Invalid request method.'}, status=400)
 
-def save_note_to_file(content):
-    notes_directory = os.path.abspath(settings.NOTES_DIR)
-    os.makedirs(notes_directory, exist_ok=True)
-
-    timestamp = timezone.now().strftime('%Y-%m-%d_%H-%M-%S')
-    file_name = f"note_{timestamp}.txt"
-    file_path = os.path.join(notes_directory, file_name)
-
-    if not file_path.startswith(notes_directory):
-        raise ValueError("Invalid file path.")
-
-    try:
-        with open(file_path, 'w', encoding='utf-8') as file:
-            file.write(content)
-    except IOError as e:
-        logger.error(f"Error saving file: {e}")
-        raise
-
-    return file_path
-
 def extract_plain_text(response):
     text = re.sub(r'[#*><\[\]\(\)_`]', '', response)
     text = re.sub(r'<[^>]+>', '', text)
@@ -165,42 +149,17 @@ def extract_plain_text(response):
     return text.strip()
 
 def extract_tags(content):
+    from sklearn.feature_extraction.text import TfidfVectorizer
+
     vectorizer = TfidfVectorizer(max_features=90, stop_words='english')
     tfidf_matrix = vectorizer.fit_transform([content])
     features = vectorizer.get_feature_names_out()
     scores = tfidf_matrix.toarray()[0]
     word_scores = sorted(zip(features, scores), key=lambda x: x[1], reverse=True)
     top_tags = [word[:255] for word, _ in word_scores if len(word) <= 255][:90]
-    return [Tag.objects.get_or_create(name=tag)[0] for tag in top_tags]
-
-def load_existing_notes():
-    global corpus_matrix, notes_corpus
-    cached_corpus = cache.get('notes_corpus')
-    if cached_corpus:
-        corpus_matrix, notes_corpus = cached_corpus
-        return
-
-    try:
-        notes = list(Note.objects.all().values_list('content', flat=True))
-        if notes:
-            corpus_matrix = encode_corpus(notes)
-            notes_corpus = notes
-            cache.set('notes_corpus', (corpus_matrix, notes_corpus), timeout=3600)
-        else:
-            logger.info("No notes found in the database. Skipping corpus encoding.")
-    except (OperationalError, ProgrammingError) as e:
-        logger.warning(f"Database error: {e}")
-
-def update_corpus():
-    global corpus_matrix, notes_corpus
-    try:
-        notes = list(Note.objects.all().values_list('content', flat=True))
-        if notes:
-            corpus_matrix = encode_corpus(notes)
-            notes_corpus = notes
-            cache.set('notes_corpus', (corpus_matrix, notes_corpus), timeout=3600)
-    except Exception as e:
-        logger.error(f"Error updating corpus: {e}")
+    with transaction.atomic():
+        tag_ids = resolve_tag_ids(top_tags)
+    return [Tag(id=tag_ids[tag], name=tag) for tag in top_tags]
 
 def chat_interface(request):
     return render(request, 'notes/chat_interface.html')
@@ -209,8 +168,13 @@ def chat_interface(request):
 def upload_and_search(request):
     upload_form = UploadFileForm()
     search_form = SearchForm()
-    files = []
+    found = None
+    job = None
     query = ""
+    try:
+        page = int(request.POST.get('page') or request.GET.get('page') or 1)
+    except ValueError:
+        page = 1
 
     if request.method == 'POST':
         query = request.POST.get('query', '')
@@ -219,56 +183,84 @@ def upload_and_search(request):
         if action == 'upload':
             upload_form = UploadFileForm(request.POST, request.FILES)
             if upload_form.is_valid():
-                file = request.FILES['file']
-                text = ""
-
-                if file.name.endswith('.pdf'):
-                    text = pdf_reader(file)
-                    pdf_rel_path = default_storage.save("temp_uploaded.pdf", file)
-                    pdf_abs_path = default_storage.path(pdf_rel_path)
-
-                    try:
-                        image_paths = extract_images_from_pdf(pdf_abs_path)
-                        for img_path in image_paths:
-                            text += " " + " ".join(Obj_Detect_Name(img_path))
-                    except Exception as e:
-                        logger.error(f"Error processing PDF: {e}")
-                    finally:
-                        default_storage.delete(pdf_abs_path)
-
-                elif file.name.endswith(('.doc', '.docx')):
-                    text = doc_reader(file)
-
-                elif file.name.lower().endswith(('.jpg', '.jpeg', '.png')):
-                    text = extract_text_from_image(file)
-                    if file.name.lower().endswith('.png'):
-                        file = convert_png_to_jpg(file)
-                    text += " " + " ".join(Obj_Detect_Name(file))
-
-                elif file.name.endswith('.txt'):
-                    try:
-                        text = file.read().decode('utf-8')
-                    except UnicodeDecodeError:
-                        text = file.read().decode('latin-1')
-
-                requests.post(url, data={'message': text})
-                tags = generate_tags(text)
-                save_file(file.name, file, tags)
-                files = perform_search(query)
+                job = enqueue_upload(request.FILES['file'])
+                if request.headers.get('x-requested-with') == 'XMLHttpRequest':
+                    return JsonResponse(job_status(job), status=202)
+                if query:
+                    found = hybrid_search(query, page=page, per_page=SEARCH_PAGE_SIZE)
 
         elif action == 'search':
             search_form = SearchForm(request.POST)
             if search_form.is_valid():
                 query = search_form.cleaned_data['query']
-                files = perform_search(query)
+                # Files and notes ranked together, as served as JSON by notes/retrieve/
+                found = hybrid_search(query, page=page, per_page=SEARCH_PAGE_SIZE)
+
+    elif request.GET.get('query'):
+        # Previous/next page links
+        query = request.GET['query']
+        found = hybrid_search(query, page=page, per_page=SEARCH_PAGE_SIZE)
 
     return render(request, 'notes/upload.html', {
         'upload_form': upload_form,
         'search_form': SearchForm(initial={'query': query}),
-        'files': files,
+        'results': found['results'] if found else [],
         'query': query,
+        'page': page,
+        'has_next': bool(found) and found['total'] > page * SEARCH_PAGE_SIZE,
+        'job': job,
     })
 
+def ingest_job_status(request, job_id):
+    job = get_object_or_404(IngestJob, id=job_id)
+    return JsonResponse(job_status(job))
+
+def ingest_jobs(request):
+    jobs = IngestJob.objects.order_by('-id')[:50]
+    return JsonResponse({'jobs': [job_status(job) for job in jobs]})
+
+@require_http_methods(["POST"])
+def upload_session_start_view(request):
+    """Open a chunked upload for ``name`` of ``size`` bytes, with an optional ``sha256``."""
+    try:
+        size = int(request.POST.get('size', ''))
+    except ValueError:
+        return JsonResponse({'response': 'size must be an integer.'}, status=400)
+    try:
+        session = start_upload(request.POST.get('name', ''), size, request.POST.get('sha256', '').strip())
+    except UploadError as e:
+        return JsonResponse({'response': str(e)}, status=e.status)
+    return JsonResponse(session_status(session), status=201)
+
+@require_http_methods(["GET", "PUT", "DELETE"])
+def upload_session_view(request, token):
+    """GET reports progress, PUT appends the chunk in the body (see ``notes.uploads``), DELETE aborts."""
+    if request.method == 'DELETE':
+        try:
+            abort_upload(token)
+        except UploadSession.DoesNotExist:
+            return JsonResponse({'response': 'Upload not found.'}, status=404)
+        return JsonResponse({'response': 'Upload aborted.'})
+    if request.method == 'PUT':
+        try:
+            session = write_chunk(
+                token, request.headers.get('Content-Range'), request, int(request.META.get('CONTENT_LENGTH') or 0),
+            )
+        except UploadSession.DoesNotExist:
+            return JsonResponse({'response': 'Upload not found.'}, status=404)
+        except UploadError as e:
+            response = {'response': str(e)}
+            if e.status == 409:
+                session = UploadSession.objects.filter(token=token).first()
+                response.update(session_status(session) if session else {})
+            return JsonResponse(response, status=e.status)
+        except OSError as e:
+            logger.error(f"Error writing upload {token}: {e}")
+            return JsonResponse({'response': 'An error occurred while storing the chunk.'}, status=500)
+        return JsonResponse(session_status(session))
+    session = get_object_or_404(UploadSession, token=token)
+    return JsonResponse(session_status(session))
+
 @require_http_methods(["POST"])
 def rename_file(request, file_id):
     try:
@@ -316,21 +308,17 @@ def delete_file(request, file_id):
         logger.error(f"Error deleting file: {e}")
         return JsonResponse({'success': False, 'message': str(e)}, status=500)
 
+@require_http_methods(["GET", "HEAD"])
 def download_file(request, file_id):
+    file_instance = get_object_or_404(File, id=file_id)
     try:
-        file_instance = get_object_or_404(File, id=file_id)
         file_path = file_instance.file_content.path
         file_name = file_instance.file_name
 
         if not os.path.exists(file_path):
             return HttpResponse(f"Error: The requested file does not exist at path: {file_path}", status=404)
 
-        response = FileResponse(open(file_path, 'rb'))
-        response['Content-Disposition'] = f'attachment; filename="{file_name}"'
-        return response
+        return serve_file(request, file_path, file_name, file_instance.content_hash)
     except Exception as e:
         logger.error(f"Error downloading file: {e}")
         return HttpResponse(f"Error downloading file: {str(e)}", status=500)
-
-# Load notes into memory on server start
-load_existing_notes()
\ No newline at end of file